@@ -0,0 +1,97 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Compares the operations per second of DatabaseHandler with the former behaviour of opening a new sqlite
+connection for every call. Run from the project root with `python -m benchmarks.bench_database`.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from util.database import DatabaseHandler
+
+USERS = 200
+FEEDS = 50
+OPERATIONS = 2000
+
+
+def legacy_get_users_for_url(database_path, url):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT user.*, web_user.alias FROM user, web_user WHERE web_user.telegram_id = user.telegram_id AND "
+        "web_user.url ='" + str(url) + "';")
+    result = cursor.fetchall()
+
+    conn.commit()
+    conn.close()
+    return result
+
+
+def legacy_get_urls_for_user(database_path, telegram_id):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT web.url, web_user.alias, web.last_updated FROM web, web_user WHERE web_user.url = web.url AND "
+        "web_user.telegram_id =" + str(telegram_id) + ";")
+    result = cursor.fetchall()
+
+    conn.commit()
+    conn.close()
+    return result
+
+
+def legacy_update_user_bookmark(database_path, telegram_id, url, alias):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    cursor.execute("UPDATE web_user SET alias=(?) WHERE telegram_id=(?) AND url=(?)", (alias, telegram_id, url))
+
+    conn.commit()
+    conn.close()
+
+
+def populate(db):
+    for telegram_id in range(USERS):
+        db.add_user(telegram_id=telegram_id, username="user%d" % telegram_id, firstname="John", lastname="Snow",
+                    language_code="DE", is_bot=False, is_active=True)
+        for feed in range(telegram_id % 5):
+            db.add_user_bookmark(telegram_id=telegram_id, url="http://example.com/%d" % ((telegram_id + feed) % FEEDS),
+                                 alias="feed%d" % feed)
+
+
+def measure(name, operation):
+    time_started = time.perf_counter()
+    for i in range(OPERATIONS):
+        operation(i)
+    duration = time.perf_counter() - time_started
+    print("%-32s %10.0f ops/s" % (name, OPERATIONS / duration))
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    database_path = os.path.join(directory, "bench.db")
+    db = DatabaseHandler(database_path)
+    populate(db)
+
+    measure("legacy get_users_for_url", lambda i: legacy_get_users_for_url(
+        database_path, "http://example.com/%d" % (i % FEEDS)))
+    measure("pooled get_users_for_url", lambda i: db.get_users_for_url(
+        "http://example.com/%d" % (i % FEEDS)))
+    measure("legacy get_urls_for_user", lambda i: legacy_get_urls_for_user(database_path, i % USERS))
+    measure("pooled get_urls_for_user", lambda i: db.get_urls_for_user(i % USERS))
+    measure("legacy update_user_bookmark", lambda i: legacy_update_user_bookmark(
+        database_path, i % USERS, "http://example.com/%d" % (i % FEEDS), "renamed"))
+    measure("pooled update_user_bookmark", lambda i: db.update_user_bookmark(
+        i % USERS, "http://example.com/%d" % (i % FEEDS), "renamed"))
+
+    db.close()
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Compares DateHandler with its former implementation on dates as they appear in real feeds. Run from the
+project root with `python -m benchmarks.bench_datehandler`.
+"""
+import datetime
+import time
+import warnings
+
+import pytz
+from dateutil import parser
+
+from util.datehandler import DateHandler, _parse_datetime_cached
+
+# Formats seen in the wild: RSS pubDate (RFC 822), Atom updated (RFC 3339) and the values stored in web
+CORPUS = [
+    "Mon, 01 Jan 2024 10:00:00 GMT",
+    "Tue, 10 Jun 2003 04:00:00 +0000",
+    "Wed, 02 Oct 2002 13:00:00 -0000",
+    "Sun, 7 Jan 2024 09:05:03 +0100",
+    "Thu, 04 Jan 2024 12:00 GMT",
+    "Fri, 12 Jan 2024 17:45:12 -0500",
+    "Sat, 13 Jan 2024 08:00:00 +0530",
+    "2024-01-01T10:00:00Z",
+    "2024-01-01T10:00:00+02:00",
+    "2024-01-01T10:00:00.123456Z",
+    "2003-12-13T18:30:02.25+01:00",
+    "2024-01-05T10:00:00-08:00",
+    "2024-01-01 00:00:00+01:00",
+    "2024-01-01",
+]
+ROUNDS = 2000
+
+
+def legacy_get_datetime_now():
+    date_string = str(
+        datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+    naive_date = datetime.datetime.utcnow().strptime(date_string, "%Y-%m-%d %H:%M:%S")
+
+    aware_date = pytz.utc.localize(naive_date)
+    return aware_date.astimezone(pytz.timezone("Europe/Berlin"))
+
+
+def legacy_parse_datetime(timestamp):
+    result = parser.parse(timestamp)
+
+    if result.tzinfo is None:
+        aware_date = pytz.utc.localize(result)
+        result = aware_date.astimezone(pytz.timezone("Europe/Berlin"))
+    return result
+
+
+def measure(name, operation, calls):
+    time_started = time.perf_counter()
+    operation()
+    duration = time.perf_counter() - time_started
+    print("%-36s %12.0f calls/s" % (name, calls / duration))
+
+
+def parse_all(parse):
+    def operation():
+        for _ in range(ROUNDS):
+            for timestamp in CORPUS:
+                parse(timestamp)
+    return operation
+
+
+def main():
+    warnings.simplefilter("ignore")
+    calls = ROUNDS * len(CORPUS)
+
+    measure("legacy get_datetime_now", lambda: [legacy_get_datetime_now() for _ in range(calls)], calls)
+    measure("get_datetime_now", lambda: [DateHandler.get_datetime_now() for _ in range(calls)], calls)
+
+    measure("legacy parse_datetime", parse_all(legacy_parse_datetime), calls)
+    _parse_datetime_cached.cache_clear()
+    measure("parse_datetime (cached)", parse_all(DateHandler.parse_datetime), calls)
+    measure("parse_datetime (uncached)", parse_all(_parse_datetime_cached.__wrapped__), calls)
+
+
+if __name__ == '__main__':
+    main()
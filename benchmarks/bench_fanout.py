@@ -0,0 +1,75 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Shows that the work of one polling cycle grows with the number of distinct feeds and not with the number
+of subscriptions. Run from the project root with `python -m benchmarks.bench_fanout`.
+"""
+import asyncio
+import contextlib
+import io
+import time
+from unittest import mock
+
+from feedparser import FeedParserDict
+
+from util.feedhandler import FeedEntry
+from util.processing import BatchProcess
+
+
+class FakeDatabase(object):
+
+    def __init__(self, feeds, subscribers):
+        self.feeds = [("http://example.com/feed/%d" % i, None, None, None, 0) for i in range(feeds)]
+        self.users = [(i, "alias", False) for i in range(subscribers)]
+        self.messages = 0
+
+    def get_all_urls(self):
+        return self.feeds
+
+    def get_active_users_for_urls(self, urls):
+        return {url: self.users for url in urls}
+
+    def update_url(self, url, **kwargs):
+        pass
+
+    def get_failing_hosts(self):
+        return {}
+
+    def get_seen_entries(self, url):
+        # Pretend one entry of every feed was seen before, so the other three are sent
+        return {FeedEntry("http://example.com/0", "http://example.com/0", "0").entry_id}
+
+    def add_seen_entries(self, url, entry_ids, news=None):
+        for messages in (news or {}).values():
+            self.add_outbox(messages)
+        return list(news or {})
+
+    def add_outbox(self, messages):
+        self.messages += len(messages)
+
+
+async def run(feeds, subscribers):
+    db = FakeDatabase(feeds, subscribers)
+    process = BatchProcess(database=db, update_interval=0)
+    posts = [FeedEntry("http://example.com/%d" % i, "http://example.com/%d" % i, str(i)) for i in range(4)]
+    feed = FeedParserDict(entries=posts)
+
+    with mock.patch("util.processing.FeedHandler.fetch_feed_async", new_callable=mock.AsyncMock,
+                    return_value=feed) as fetch_feed:
+        time_started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await process.parse_parallel(queue=db.get_all_urls())
+        duration = time.perf_counter() - time_started
+
+    return fetch_feed.call_count, db.messages, duration
+
+
+def main():
+    print("%8s %12s %8s %10s %10s" % ("feeds", "subscribers", "fetches", "messages", "seconds"))
+    for feeds, subscribers in ((10, 1), (10, 100), (10, 1000), (1000, 1), (1000, 10)):
+        fetches, messages, duration = asyncio.run(run(feeds, subscribers))
+        print("%8d %12d %8d %10d %10.3f" % (feeds, subscribers, fetches, messages, duration))
+
+
+if __name__ == '__main__':
+    main()
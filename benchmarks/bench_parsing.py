@@ -0,0 +1,71 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Shows how the parse throughput of the poller scales with the number of parser processes, compared to
+parsing in a thread pool where the GIL allows only one core, and what cutting a huge feed after its newest
+entries saves. Run from the project root with `python -m benchmarks.bench_parsing`.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from util.feedhandler import MAX_ENTRIES, parse_records
+from util.feedstream import EntryLimiter
+
+ITEM = """<item><title>Entry %(i)d of feed %(feed)d</title><link>http://example.com/%(feed)d/%(i)d</link>
+<guid>http://example.com/%(feed)d/%(i)d</guid><pubDate>Mon, 01 Jan 2024 10:%(minute)02d:00 GMT</pubDate>
+<description>&lt;p&gt;Some &lt;b&gt;html&lt;/b&gt; content of the entry, as most feeds send it.&lt;/p&gt;</description>
+</item>"""
+
+
+def make_feed(feed, entries):
+    items = "".join(ITEM % {"i": i, "feed": feed, "minute": i % 60} for i in range(entries))
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Feed %d</title>'
+            '<ttl>60</ttl>%s</channel></rss>' % (feed, items)).encode("utf-8")
+
+
+def run(executor, bodies):
+    time_started = time.perf_counter()
+    entries = sum(len(records[0]) for records in executor.map(parse_records, bodies))
+    return entries, time.perf_counter() - time_started
+
+
+def limit(body, chunk_size=65536):
+    limiter = EntryLimiter(MAX_ENTRIES)
+    for i in range(0, len(body), chunk_size):
+        if limiter.feed(body[i:i + chunk_size]):
+            break
+    return limiter.truncate(body)
+
+
+def main():
+    bodies = [make_feed(feed, 100) for feed in range(200)]
+    cores = os.cpu_count() or 1
+
+    print("%-10s %8s %10s %12s" % ("executor", "workers", "feeds/s", "entries/s"))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        entries, duration = run(executor, bodies)
+    print("%-10s %8d %10.1f %12.1f" % ("threads", 4, len(bodies) / duration, entries / duration))
+
+    for workers in sorted({1, 2, 4, cores}):
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Start the processes before measuring
+            list(executor.map(parse_records, bodies[:workers]))
+            entries, duration = run(executor, bodies)
+        print("%-10s %8d %10.1f %12.1f" % ("processes", workers, len(bodies) / duration, entries / duration))
+
+    # A podcast feed listing every episode ever, parsed whole or cut after the newest entries while downloading
+    body = make_feed(0, 5000)
+    print()
+    print("%-10s %10s %10s %10s" % ("feed", "bytes", "entries", "seconds"))
+    for name, prepare in (("whole", bytes), ("limited", limit)):
+        time_started = time.perf_counter()
+        content = prepare(body)
+        entries = len(parse_records(content)[0])
+        print("%-10s %10d %10d %10.3f" % (name, len(content), entries, time.perf_counter() - time_started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Runs the whole pipeline offline: the poller fetches synthetic feeds from a local server, writes the news to
+the outbox of a real database and the outbox worker delivers them to a fake bot. Every scale runs in a process
+of its own, so the peak memory is its own. Run from the project root with
+`python -m benchmarks.bench_pipeline`, e.g. `--scales 100000 --latency 0.05` for a large, slow setup.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from benchmarks.harness import FakeBot, FeedServer, populate
+from util import metrics
+from util.database import DatabaseHandler
+from util.delivery import MessageQueue, OutboxWorker
+from util.feedhandler import FeedHandler
+from util.fetcher import Fetcher
+from util.processing import BatchProcess
+
+
+async def drive(db, options):
+    bot = FakeBot(latency=options.bot_latency)
+    queue = MessageQueue(bot, senders=options.senders, global_rate=1e9)
+    # Only the cost of the pipeline is measured, not the flood limits of telegram
+    queue.PRIVATE_RATE = queue.GROUP_RATE = 1e9
+    outbox = OutboxWorker(db, queue, batch_size=1000, max_in_flight=10000, interval=0.1)
+    process = BatchProcess(database=db, update_interval=300, outbox=outbox, concurrency=options.concurrency)
+
+    queue.start()
+    try:
+        async with FeedHandler.create_client() as client:
+            process.client = client
+            with contextlib.redirect_stdout(io.StringIO()):
+                # The first cycle downloads every feed and marks the entries in it as seen
+                await process.parse_parallel(queue=db.iter_urls())
+
+                db_ops = metrics.DB_SECONDS.get_total_count()
+                messages = metrics.OUTBOX_MESSAGES.get()
+                time_started = time.perf_counter()
+                await process.parse_parallel(queue=db.iter_urls())
+                poll_seconds = time.perf_counter() - time_started
+            messages = metrics.OUTBOX_MESSAGES.get() - messages
+
+        time_started = time.perf_counter()
+        task = asyncio.ensure_future(outbox.run())
+        while bot.sent < messages and not task.done():
+            await asyncio.sleep(0.01)
+        deliver_seconds = time.perf_counter() - time_started
+        outbox.set_running(False)
+        outbox.notify()
+        await task
+    finally:
+        await queue.stop()
+
+    return poll_seconds, bot.sent, deliver_seconds, metrics.DB_SECONDS.get_total_count() - db_ops
+
+
+def run(feeds, options):
+    directory = tempfile.mkdtemp()
+    try:
+        with FeedServer(entries=options.entries, change_rate=options.change_rate, latency=options.latency,
+                        error_rate=options.error_rate) as server:
+            db = DatabaseHandler(os.path.join(directory, "datastore.db"))
+            populate(db, [server.url(feed) for feed in range(feeds)], users=max(feeds // 10, 1),
+                     subscriptions_per_feed=options.subscriptions)
+            # All feeds live on one host, which must not cap the concurrency of the poller
+            FeedHandler.fetcher = Fetcher(per_host=options.concurrency, max_connections=options.concurrency)
+
+            poll_seconds, sent, deliver_seconds, db_ops = asyncio.run(drive(db, options))
+            db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return feeds / poll_seconds, sent, sent / deliver_seconds if sent else 0.0, peak, db_ops
+
+
+def _run_in_process(results, feeds, options):
+    results.put(run(feeds, options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1000,10000", help="comma separated numbers of feeds")
+    parser.add_argument("--subscriptions", type=int, default=1, help="subscribers per feed")
+    parser.add_argument("--entries", type=int, default=10, help="entries per feed")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="share of feeds with a new entry per poll")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the server takes per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fetches failing with 500")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="seconds the fake bot takes per message")
+    parser.add_argument("--concurrency", type=int, default=50, help="feeds polled concurrently")
+    parser.add_argument("--senders", type=int, default=4, help="messages sent concurrently")
+    options = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print("%8s %10s %10s %10s %10s %10s" % ("feeds", "feeds/s", "messages", "msgs/s", "peak MB", "db ops"))
+    for feeds in [int(scale) for scale in options.scales.split(",")]:
+        results = context.Queue()
+        child = context.Process(target=_run_in_process, args=(results, feeds, options))
+        child.start()
+        feeds_per_second, sent, messages_per_second, peak, db_ops = results.get()
+        child.join()
+        print("%8d %10.1f %10d %10.1f %10.1f %10d" % (feeds, feeds_per_second, sent, messages_per_second,
+                                                      peak, db_ops))
+
+
+if __name__ == '__main__':
+    main()
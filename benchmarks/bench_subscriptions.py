@@ -0,0 +1,89 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Measures the memory a subscription takes in the SubscriptionIndex, compared to holding the rows read from the
+database, and how long looking up the subscribers of a batch of feeds takes in memory and in sqlite. Run from
+the project root with `python -m benchmarks.bench_subscriptions`.
+"""
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.harness import populate
+from util.database import DatabaseHandler
+from util.subscriptions import SubscriptionIndex
+
+ALIASES = ["news", "blog", "tech", "podcast", "sports", "world", "science", "music"]
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return value, size
+
+
+def build_rows(feeds, users, subscriptions_per_feed):
+    # What the rows of the database would take, as get_active_users_for_urls returns them
+    rows = {}
+    for i in range(feeds):
+        rows["http://example.com/feed/%d" % i] = [((i * subscriptions_per_feed + j) % users,
+                                                   ALIASES[(i + j) % len(ALIASES)], False)
+                                                  for j in range(subscriptions_per_feed)]
+    return rows
+
+
+def build_index(feeds, users, subscriptions_per_feed):
+    index = SubscriptionIndex()
+    for i in range(feeds):
+        for j in range(subscriptions_per_feed):
+            index.add("http://example.com/feed/%d" % i, (i * subscriptions_per_feed + j) % users,
+                      ALIASES[(i + j) % len(ALIASES)])
+    # Only chats known to be active users are served
+    for user in range(users):
+        index.update_user(user, is_active=True)
+    return index
+
+
+def lookup(feeds):
+    directory = tempfile.mkdtemp()
+    try:
+        database = DatabaseHandler(os.path.join(directory, "datastore.db"))
+        urls = ["http://example.com/feed/%d" % i for i in range(feeds)]
+        populate(database, urls, users=max(feeds // 10, 1), subscriptions_per_feed=10)
+        index = SubscriptionIndex.load(database)
+
+        batch = urls[:500]
+        timings = []
+        for source in (database, index):
+            time_started = time.perf_counter()
+            for _ in range(20):
+                source.get_active_users_for_urls(batch)
+            timings.append((time.perf_counter() - time_started) / 20)
+        database.close()
+        return timings
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    print("%8s %14s %14s %14s" % ("feeds", "subscriptions", "rows B/sub", "index B/sub"))
+    for feeds, subscriptions_per_feed in ((1000, 10), (10000, 10), (100000, 1)):
+        users = max(feeds * subscriptions_per_feed // 10, 1)
+        subscriptions = feeds * subscriptions_per_feed
+        rows, rows_size = measure(lambda: build_rows(feeds, users, subscriptions_per_feed))
+        index, index_size = measure(lambda: build_index(feeds, users, subscriptions_per_feed))
+        print("%8d %14d %14.1f %14.1f" % (feeds, subscriptions, rows_size / subscriptions,
+                                          index_size / subscriptions))
+
+    sqlite_seconds, index_seconds = lookup(10000)
+    print()
+    print("Subscribers of 500 feeds: sqlite %.2f ms, index %.2f ms" % (sqlite_seconds * 1000, index_seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Building blocks of the offline benchmarks: a local server of synthetic feeds, a fake telegram bot and a fast way
+to fill a database with feeds and subscriptions.
+"""
+import asyncio
+import multiprocessing
+import random
+import re
+import time
+
+from util.database import Feed, User, WebUser
+from util.datehandler import DateHandler
+
+FEED_PATH = re.compile(r"^/feed/(\d+)$")
+
+# 2024-01-01 00:00:00 UTC
+EPOCH = 1704067200
+
+RSS_ITEM = "<item><title>Entry %(i)d</title><link>http://example.com/%(feed)d/%(i)d</link>" \
+           "<guid>http://example.com/%(feed)d/%(i)d</guid>" \
+           "<pubDate>%(date)s</pubDate><description>Text of entry %(i)d of feed %(feed)d</description></item>"
+
+ATOM_ENTRY = "<entry><title>Entry %(i)d</title><link href=\"http://example.com/%(feed)d/%(i)d\"/>" \
+             "<id>http://example.com/%(feed)d/%(i)d</id><updated>%(iso)s</updated>" \
+             "<summary>Text of entry %(i)d of feed %(feed)d</summary></entry>"
+
+
+class FeedServer(object):
+
+    def __init__(self, entries=10, change_rate=0.1, latency=0.0, error_rate=0.0, seed=0):
+        """Serves synthetic feeds on http://127.0.0.1:<port>/feed/<n> from a process of its own, so it doesn't
+        take CPU time or memory from the process being measured. Even feeds are RSS, odd ones Atom
+
+        Args:
+            entries (int): The number of entries of every feed.
+            change_rate (float): The probability that a feed got a new entry when it is fetched.
+            latency (float): The seconds every response is delayed by.
+            error_rate (float): The probability that a fetch fails with 500 Internal Server Error.
+            seed (int): Seeds the random changes and errors, so runs are reproducible.
+        """
+        self.options = {"entries": int(entries), "change_rate": float(change_rate), "latency": float(latency),
+                        "error_rate": float(error_rate), "seed": seed}
+        self.process = None
+        self.port = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(target=_serve, args=(sender, self.options), daemon=True)
+        self.process.start()
+        self.port = receiver.recv()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def url(self, feed):
+        return "http://127.0.0.1:%d/feed/%d" % (self.port, feed)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class FakeBot(object):
+
+    def __init__(self, latency=0.0):
+        """Stands in for telegram.Bot, counting the messages instead of sending them
+
+        Args:
+            latency (float): The seconds every call of the Bot API takes.
+        """
+        self.latency = float(latency)
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+def populate(db, urls, users, subscriptions_per_feed=1, chunk_size=100):
+    """Fills the database with users and feeds, every feed subscribed by subscriptions_per_feed users
+
+    Args:
+        db (DatabaseHandler): The database to fill.
+        urls (list): The urls of the feeds.
+        users (int): The number of users the subscriptions are spread over.
+        subscriptions_per_feed (int): The number of subscribers of every feed.
+        chunk_size (int): The number of rows inserted with one statement.
+    """
+    now = DateHandler.get_datetime_now()
+    user_rows = [(telegram_id, "user%d" % telegram_id, "John", "Snow", "en", False, True)
+                 for telegram_id in range(users)]
+    feed_rows = [(url, now) for url in urls]
+    subscription_rows = [(url, (i * subscriptions_per_feed + j) % users, "feed%d" % i)
+                         for i, url in enumerate(urls) for j in range(min(subscriptions_per_feed, users))]
+
+    with db.db.atomic():
+        for i in range(0, len(user_rows), chunk_size):
+            User.insert_many(user_rows[i:i + chunk_size],
+                             fields=[User.telegram_id, User.username, User.firstname, User.lastname, User.language,
+                                     User.is_bot, User.is_active]).execute()
+        for i in range(0, len(feed_rows), chunk_size):
+            Feed.insert_many(feed_rows[i:i + chunk_size], fields=[Feed.url, Feed.last_updated]).execute()
+        for i in range(0, len(subscription_rows), chunk_size):
+            WebUser.insert_many(subscription_rows[i:i + chunk_size],
+                                fields=[WebUser.url, WebUser.telegram_id, WebUser.alias]).on_conflict_ignore().execute()
+
+
+def render_feed(feed, head, entries):
+    """Returns the body of a feed whose newest entry is number head"""
+    items = []
+    for i in range(head, max(head - entries, 0), -1):
+        # Entry i was published i minutes after the start of 2024
+        published = time.gmtime(EPOCH + i * 60)
+        values = {"i": i, "feed": feed,
+                  "date": time.strftime("%a, %d %b %Y %H:%M:%S GMT", published),
+                  "iso": time.strftime("%Y-%m-%dT%H:%M:%SZ", published)}
+        items.append((ATOM_ENTRY if feed % 2 else RSS_ITEM) % values)
+
+    if feed % 2:
+        return ('<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                '<title>Feed %d</title><id>urn:feed:%d</id>%s</feed>' % (feed, feed, "".join(items))).encode("utf-8")
+    return ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Feed %d</title>'
+            '<link>http://example.com/%d</link>%s</channel></rss>' % (feed, feed, "".join(items))).encode("utf-8")
+
+
+def _serve(sender, options):
+    asyncio.run(_run_server(sender, options))
+
+
+async def _run_server(sender, options):
+    rng = random.Random(options["seed"])
+    heads = {}
+
+    def respond(path, headers):
+        match = FEED_PATH.match(path)
+        if match is None:
+            return 404, b"", {}
+        if rng.random() < options["error_rate"]:
+            return 500, b"", {}
+
+        feed = int(match.group(1))
+        head = heads.get(feed, options["entries"])
+        if rng.random() < options["change_rate"]:
+            head += 1
+        heads[feed] = head
+
+        etag = '"%d-%d"' % (feed, head)
+        if headers.get("if-none-match") == etag:
+            return 304, b"", {"ETag": etag}
+        content_type = "application/atom+xml" if feed % 2 else "application/rss+xml"
+        return 200, render_feed(feed, head, options["entries"]), {"ETag": etag, "Content-Type": content_type}
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                lines = request.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                if options["latency"]:
+                    await asyncio.sleep(options["latency"])
+                status, body, extra = respond(path, headers)
+
+                head = ["HTTP/1.1 %d X" % status, "Content-Length: %d" % len(body)]
+                head.extend("%s: %s" % item for item in extra.items())
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, backlog=4096)
+    sender.send(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
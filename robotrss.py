@@ -1,17 +1,25 @@
 # /bin/bash/python
 # encoding: utf-8
+import asyncio
 import os
+import signal
 
 from telegram import Update, Chat
 from telegram.constants import ParseMode
-from telegram.error import TelegramError, Forbidden
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
+from util.asynchandler import AsyncHandler
 from util.database import DatabaseHandler
+from util.delivery import MessageQueue, OutboxWorker
+from util.feedcache import FeedCache
 from util.feedhandler import FeedHandler
+from util import metrics
+from util.fetcher import Fetcher, MAX_BODY_SIZE
 from util.filehandler import FileHandler
 from util.processing import BatchProcess
+from util.subscriptions import SubscriptionIndex
 from util.telegram_helpers import extract_status_change
+from util.tracing import Tracer
 
 
 async def greet_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -88,12 +96,14 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
               "/get <entryname> [optional: <count 1-10>] - Manually parses your subscription, sending you the last " \
               "elements.\n" \
               "/list - Shows all your subscriptions as a list.\n" \
+              "/digest <on|off> - Bundles all news of an update into as few messages as possible.\n" \
               "/about - Shows some information about RobotRSS Bot\n" \
               "/help - Shows the help menu\n\n" \
               "If you need help with handling the commands, please have a look at " \
               "https://github.com/cbrgm/telegram-robot-rss. There I have summarized " \
               "everything necessary for you!"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=message, disable_web_page_preview=True)
+    await context.bot_data["message_queue"].send_message(
+        chat_id=update.effective_chat.id, text=message, disable_web_page_preview=True)
 
 
 async def about_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -106,27 +116,46 @@ async def about_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
               "contact me at http://cbrgm.de or @cbrgm or create an issue on " \
               "https://github.com/cbrgm/telegram-robot-rss. There you will also find my source " \
               "code, if you are interested in how I work!"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+    await context.bot_data["message_queue"].send_message(chat_id=update.effective_chat.id, text=message)
 
 
 class RobotRss(object):
 
-    def __init__(self, telegram_token, update_interval):
+    def __init__(self, telegram_token, update_interval, fetch_concurrency=10, min_interval=60, max_interval=86400,
+                 senders=4, fetch_per_host=4, fetch_timeout=30, max_feed_size=MAX_BODY_SIZE, max_failures=5,
+                 parse_workers=0, external_workers=False, metrics_port=None, trace_file=None, trace_top=10,
+                 admin_ids=()):
 
         # Initialize bot internals
         self.db = DatabaseHandler("resources/datastore.db")
         self.fh = FileHandler("..")
+        self.admin_ids = set(admin_ids)
+        FeedHandler.fetcher = Fetcher(timeout=fetch_timeout, per_host=fetch_per_host, max_body_size=max_feed_size)
+        if metrics_port:
+            metrics.start_server(metrics_port)
+
+        # Collapse feeds stored under different spellings of the same url, the urls themselves are kept
+        self.db.canonicalize_urls(FeedHandler.canonicalize_url)
+
+        # Command handlers reach the database and the feeds through thread pools, so a slow feed or query
+        # doesn't block the event loop and the commands of other users
+        self.database = AsyncHandler(self.db, max_workers=4, name="database")
+        self.feeds = AsyncHandler(FeedHandler, max_workers=8, name="feeds")
 
         # Register webhook to telegram bot
         #persistence = PicklePersistence(filepath="bot_data")
         #self.application = ApplicationBuilder().token(telegram_token).persistence(persistence=persistence).build()
-        self.application = ApplicationBuilder().token(telegram_token).build()
+        self.application = ApplicationBuilder().token(telegram_token) \
+            .post_init(self.post_init) \
+            .post_stop(self.post_stop) \
+            .build()
         # Regular commands
         self.application.add_handler(CommandHandler("start", self.start))
         self.application.add_handler(CommandHandler("stop", self.stop))
         self.application.add_handler(CommandHandler("help", help_handler))
         self.application.add_handler(CommandHandler("about", about_handler))
         self.application.add_handler(CommandHandler("list", self.list))
+        self.application.add_handler(CommandHandler("digest", self.digest))
 
         # Feed related commands
         self.application.add_handler(CommandHandler(
@@ -150,16 +179,71 @@ class RobotRss(object):
         # Keep track of which chats the bot is in
         # self.application.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
         self.application.add_handler(CommandHandler("show_chats", self.show_chats))
+        self.application.add_handler(CommandHandler("profile", self.profile))
         # self.application.add_handler(ChatMemberHandler(greet_chat_members, ChatMemberHandler.CHAT_MEMBER))
         # self.application.add_handler(MessageHandler(filters.ALL, self.start_private_chat))
 
-        self.processing = BatchProcess(
-             database=self.db, update_interval=update_interval, bot=self.application.bot)
-
-        self.processing.start()
-        # Start the Bot
+        # All outgoing messages go through one rate limited queue
+        self.queue = MessageQueue(
+            bot=self.application.bot, senders=senders,
+            on_forbidden=lambda chat_id: self.db.update_user(telegram_id=chat_id, is_active=0))
+        self.application.bot_data["message_queue"] = self.queue
+
+        # News are written to the outbox by the poller and delivered from there. Workers in other processes
+        # can't wake the outbox up, so it is read more often when they poll the feeds
+        self.outbox = OutboxWorker(database=self.db, queue=self.queue, interval=5 if external_workers else 60)
+        self.outbox_task = None
+
+        # Feeds parsed by /add and /get are reused by each other and by the next poll
+        self.feed_cache = FeedCache()
+
+        # With external workers (see worker.py) the bot only answers commands and delivers the news
+        self.processing = None
+        if not external_workers:
+            # The poller finds the subscribers of a feed in memory, the database keeps the index up to date
+            self.db.subscriptions = SubscriptionIndex.load(self.db)
+            self.processing = BatchProcess(
+                database=self.db, update_interval=update_interval, outbox=self.outbox, cache=self.feed_cache,
+                concurrency=fetch_concurrency, min_interval=min_interval, max_interval=max_interval,
+                max_failures=max_failures, parse_workers=parse_workers,
+                tracer=Tracer(path=trace_file, top=trace_top) if trace_file else None,
+                subscriptions=self.db.subscriptions)
+        self.processing_task = None
+
+        # Start the Bot, the feed poller is started inside its event loop by post_init
         self.application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    async def post_init(self, application) -> None:
+        """
+        Starts the message queue, the outbox and the feed poller in the event loop of the application
+        """
+
+        self.queue.start()
+        self.outbox_task = asyncio.get_running_loop().create_task(self.outbox.run())
+        if self.processing is not None:
+            self.processing_task = asyncio.get_running_loop().create_task(self.processing.run())
+            # kill -USR1 <pid> profiles the next polling cycle
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.processing.profiler.request)
+
+    async def post_stop(self, application) -> None:
+        """
+        Stops the feed poller, the outbox and the message queue when the application shuts down
+        """
+
+        if self.processing is not None:
+            self.processing.set_running(False)
+        self.outbox.set_running(False)
+        tasks = [task for task in (self.processing_task, self.outbox_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        # Let the tasks run their cleanup before the executors they use go away
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.queue.stop()
+        self.feeds.shutdown(wait=False)
+        # Waiting for the database thread would block the loop, queries already running still finish
+        self.database.shutdown(wait=False)
+        FeedHandler.fetcher.close()
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Send a message when the command /start is issued.
@@ -168,23 +252,23 @@ class RobotRss(object):
         telegram_user = update.message.from_user
 
         # Add new User if not exists
-        if not self.db.get_user(telegram_id=telegram_user.id):
+        if not await self.database.get_user(telegram_id=telegram_user.id):
             message = "Hello! I don't think we've met before! I am an RSS News Bot and would like to help you to " \
                       "receive your favourite news in the future! Let me first set up a few things before we start..."
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
-            self.db.add_user(telegram_id=telegram_user.id,
-                             username=telegram_user.username,
-                             firstname=telegram_user.first_name,
-                             lastname=telegram_user.last_name,
-                             language_code=telegram_user.language_code,
-                             is_bot=telegram_user.is_bot,
-                             is_active=True)
+            await self.database.add_user(telegram_id=telegram_user.id,
+                                         username=telegram_user.username,
+                                         firstname=telegram_user.first_name,
+                                         lastname=telegram_user.last_name,
+                                         language_code=telegram_user.language_code,
+                                         is_bot=telegram_user.is_bot,
+                                         is_active=True)
 
-        self.db.update_user(telegram_id=telegram_user.id, is_active=1)
+        await self.database.update_user(telegram_id=telegram_user.id, is_active=1)
 
         message = "You will now receive news! Use /help if you need some tips how to tell me what to do!"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
     async def add(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -197,35 +281,38 @@ class RobotRss(object):
             message = "Sorry! I could not add the entry! Please use the the command passing the following " \
                       "arguments:\n\n /add <url> <entryname> \n\n Here is a short example: \n\n /add " \
                       "http://www.feedforall.com/sample.xml ExampleEntry"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
 
         arg_url = FeedHandler.format_url_string(string=args[0])
         arg_entry = args[1]
 
-        # Check if argument matches url format
-        if not FeedHandler.is_parsable(url=arg_url):
+        # Check if argument matches url format, following redirects to the url the feed is really served from
+        feed_url = await self.feeds.resolve_feed_url(url=arg_url, cache=self.feed_cache)
+        if feed_url is None:
             message = f"Sorry! It seems like {arg_url} doesn't provide an RSS news feed.. Have you tried another URL " \
                       f"from that provider?"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
+        arg_url = feed_url
+        key = FeedHandler.canonicalize_url(arg_url)
 
         # Check if entry does not exist
-        entries = self.db.get_urls_for_user(telegram_id=telegram_user.id)
+        entries = await self.database.get_urls_for_user(telegram_id=telegram_user.id)
         for entry in entries:
             name = entry[1]
             url = entry[0]
-            if url.lower() == arg_url.lower() or name.lower() == name:
+            if FeedHandler.canonicalize_url(url) == key or name.lower() == arg_entry.lower():
                 message = f"Sorry, {telegram_user.first_name}! I already have {url} " \
                           f"in your subscriptions with name '{name}'." \
                           f"Please choose another name or delete the entry using '/remove {name}'"
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+                await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
                 return
 
-        self.db.add_user_bookmark(
-            telegram_id=telegram_user.id, url=arg_url.lower(), alias=arg_entry)
+        await self.database.add_user_bookmark(
+            telegram_id=telegram_user.id, url=arg_url, alias=arg_entry, key=key)
         message = f"I added {arg_entry} to your subscriptions"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
     async def get(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -239,7 +326,7 @@ class RobotRss(object):
         args = context.args
 
         if len(args) > 2 or len(args) == 0:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=help_message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=help_message)
             return
 
         if len(args) == 2:
@@ -249,28 +336,22 @@ class RobotRss(object):
             args_entry = args[0]
             args_count = 4
 
-        url = self.db.get_user_bookmark(
+        url = await self.database.get_user_bookmark(
             telegram_id=telegram_user.id, alias=args_entry)
 
         if url is None:
             message = f"I can not find an entry with label {args_entry} in your subscriptions. Please check your " \
                       f"subscriptions using /list and use the delete " \
                       "command again!"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
 
-        entries = FeedHandler.parse_feed(url[0], args_count)
+        entries = await self.feeds.parse_feed(url[0], args_count, cache=self.feed_cache)
         for entry in entries:
             message = "[" + url[1] + "] <a href='" + \
                       entry.link + "'>" + entry.title + "</a>"
-            try:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=message,
-                                               parse_mode=ParseMode.HTML)
-            except Forbidden:
-                self.db.update_user(telegram_id=telegram_user.id, is_active=0)
-            except TelegramError:
-                # handle all other telegram related errors
-                pass
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message,
+                                          parse_mode=ParseMode.HTML)
 
     async def remove(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -283,22 +364,22 @@ class RobotRss(object):
         if len(args) != 1:
             message = "To remove a subscriptions from your list please use /remove <entryname>. To see all your " \
                       "subscriptions along with their entry names use /list !"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
 
-        entry = self.db.get_user_bookmark(
+        entry = await self.database.get_user_bookmark(
             telegram_id=telegram_user.id, alias=args[0])
 
         if entry:
-            self.db.remove_user_bookmark(
+            await self.database.remove_user_bookmark(
                 telegram_id=telegram_user.id, url=entry[0])
             message = f"I removed {args[0]} from your subscriptions"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
         else:
             message = f"I can not find {args[0]} in your subscriptions! Please check your subscriptions using /list " \
                       f"and use the delete " \
                       "command again!"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
     async def list(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -307,18 +388,18 @@ class RobotRss(object):
 
         telegram_user = update.message.from_user
 
-        entries = self.db.get_urls_for_user(telegram_id=telegram_user.id)
+        entries = await self.database.get_urls_for_user(telegram_id=telegram_user.id)
 
         if entries is not None and len(entries) > 0:
             message = "Subscriptions"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             for entry in entries:
                 message = "[" + entry[1] + "]\n " + entry[0]
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
 
         message = "You have no subscriptions"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
     async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -326,11 +407,49 @@ class RobotRss(object):
         """
 
         telegram_user = update.message.from_user
-        self.db.update_user(telegram_id=telegram_user.id, is_active=0)
+        await self.database.update_user(telegram_id=telegram_user.id, is_active=0)
 
         message = "Oh.. Okay, I will not send you any more news updates! If you change your mind and you want to " \
                   "receive messages from me again use /start command again!"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
+
+    async def digest(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Switches the digest mode of the user on or off
+        """
+
+        telegram_user = update.message.from_user
+        args = context.args
+
+        if len(args) != 1 or args[0].lower() not in ("on", "off"):
+            message = "To receive all news of an update bundled into as few messages as possible use /digest on. " \
+                      "To receive one message per news use /digest off."
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
+            return
+
+        is_digest = args[0].lower() == "on"
+        await self.database.update_user(telegram_id=telegram_user.id, digest=is_digest)
+
+        if is_digest:
+            message = "From now on I will bundle your news into as few messages as possible!"
+        else:
+            message = "From now on I will send you one message per news!"
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
+
+    async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Profiles the next polling cycle, for the admins of the bot only
+        """
+
+        if update.effective_user.id not in self.admin_ids:
+            return
+
+        if self.processing is None:
+            message = "The feeds are polled by the workers, send them SIGUSR1 to profile their next cycle."
+        else:
+            self.processing.profiler.request()
+            message = "The next polling cycle will be profiled, the profile is saved next to the bot."
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
 
     async def start_private_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Greets the user and records that they started a chat with the bot if it's a private chat.
@@ -339,7 +458,7 @@ class RobotRss(object):
         """
 
         chat = update.effective_chat
-        self.db.add_chat(chat)
+        await self.database.add_chat(chat)
 
         if chat.type != Chat.PRIVATE or chat.id in context.bot_data.get("user_ids", set()):
             return
@@ -353,7 +472,7 @@ class RobotRss(object):
 
     async def show_chats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Shows which chats the bot is in"""
-        entries = self.db.get_all_chats()
+        entries = await self.database.get_all_chats()
 
         if entries is not None and len(entries) > 0:
             message = "Chats:\n"
@@ -362,11 +481,29 @@ class RobotRss(object):
                 if entry[1] is not None:
                     name = f" '{entry[1]}'"
                 message += f"{entry[2]}: {entry[0]}{name}\n"
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+            await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
             return
 
         message = "You have no chats"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+        await self.queue.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+def load_setting(credentials, name, default=None):
+    """
+    Returns a setting from the environment (upper case name) or the credentials file (lower case name)
+    """
+
+    if name.upper() in os.environ:
+        return os.environ.get(name.upper())
+    return credentials.get(name.lower(), default)
+
+
+def load_flag(credentials, name, default=False):
+    """
+    Returns a yes/no setting, accepting 1, true and yes as well as JSON booleans
+    """
+
+    return str(load_setting(credentials, name, default)).lower() in ("1", "true", "yes")
 
 
 if __name__ == '__main__':
@@ -378,9 +515,21 @@ if __name__ == '__main__':
         token = os.environ.get("BOT_TOKEN")
     else:
         token = credentials["telegram_token"]
-    if 'UPDATE_INTERVAL' in os.environ:
-        update_interval = int(os.environ.get("UPDATE_INTERVAL", 300))
-    else:
-        update_interval = credentials["update_interval"]
 
-    RobotRss(telegram_token=token, update_interval=update_interval)
+    RobotRss(telegram_token=token,
+             update_interval=int(load_setting(credentials, "update_interval", 300)),
+             fetch_concurrency=int(load_setting(credentials, "fetch_concurrency", 10)),
+             min_interval=int(load_setting(credentials, "min_interval", 60)),
+             max_interval=int(load_setting(credentials, "max_interval", 86400)),
+             senders=int(load_setting(credentials, "senders", 4)),
+             fetch_per_host=int(load_setting(credentials, "fetch_per_host", 4)),
+             fetch_timeout=float(load_setting(credentials, "fetch_timeout", 30)),
+             max_feed_size=int(load_setting(credentials, "max_feed_size", MAX_BODY_SIZE)),
+             max_failures=int(load_setting(credentials, "max_failures", 5)),
+             parse_workers=int(load_setting(credentials, "parse_workers", 0)),
+             external_workers=load_flag(credentials, "external_workers"),
+             metrics_port=int(load_setting(credentials, "metrics_port", 0)),
+             trace_file=load_setting(credentials, "trace_file"),
+             trace_top=int(load_setting(credentials, "trace_top", 10)),
+             admin_ids=[int(admin_id) for admin_id in str(load_setting(credentials, "admin_ids", "")).split(",")
+                        if admin_id.strip()])
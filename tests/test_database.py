@@ -100,12 +100,157 @@ class TestDatabaseHandler(unittest.TestCase):
         result = self.db.get_url(url="https://lorem-rss.herokuapp.com/feed")
         self.assertEqual(result.last_updated, timestamp)
 
+    def test_update_url_validators(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.db.update_url(url="https://lorem-rss.herokuapp.com/feed",
+                           etag='"abc"', modified="Mon, 01 Jan 2024 00:00:00 GMT")
+
+        result = self.db.get_all_urls()
+        self.assertEqual(result[0][2], '"abc"')
+        self.assertEqual(result[0][3], "Mon, 01 Jan 2024 00:00:00 GMT")
+
+    def test_iter_urls(self):
+        for i in range(5):
+            self.db.add_url(url="https://lorem-rss.herokuapp.com/feed%d" % i)
+
+        urls = []
+        for url in self.db.iter_urls(batch_size=2):
+            urls.append(url[0])
+            if len(urls) == 1:
+                # Feeds added while iterating are picked up by the following pages
+                self.db.add_url(url="https://lorem-rss.herokuapp.com/feed9")
+
+        self.assertEqual(len(urls), 6)
+        self.assertEqual(urls[-1], "https://lorem-rss.herokuapp.com/feed9")
+
+    def test_canonicalize_urls(self):
+        self.db.add_user(telegram_id=25525, username="TestDummy01",
+                         firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=True)
+        self.db.add_user(telegram_id=25526, username="TestDummy02",
+                         firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=True)
+        self.db.add_user_bookmark(telegram_id=25525, url="https://lorem-rss.herokuapp.com/feed", alias="feed")
+        self.db.add_user_bookmark(telegram_id=25526, url="https://lorem-rss.herokuapp.com/feed/", alias="feed")
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed/", entry_ids=[1, 2])
+
+        merged = self.db.canonicalize_urls(lambda url: url.rstrip("/"))
+
+        self.assertEqual(merged, 1)
+        self.assertEqual([row[0] for row in self.db.get_all_urls()], ["https://lorem-rss.herokuapp.com/feed"])
+        result = self.db.get_users_for_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.assertEqual(sorted(row[0] for row in result), [25525, 25526])
+        self.assertEqual(self.db.get_seen_entries(url="https://lorem-rss.herokuapp.com/feed"), {1, 2})
+        self.assertEqual(self.db.get_seen_entries(url="https://lorem-rss.herokuapp.com/feed/"), set())
+
+    def test_canonicalize_urls_keeps_urls(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed/")
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/other")
+        self.db.add_failure(url="https://lorem-rss.herokuapp.com/other", host="lorem-rss.herokuapp.com")
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/other/")
+
+        merged = self.db.canonicalize_urls(lambda url: url.rstrip("/"))
+
+        # Only feeds whose keys collide are merged, the one that works keeps its url as it was served
+        self.assertEqual(merged, 1)
+        self.assertEqual([row[0] for row in self.db.get_all_urls()],
+                         ["https://lorem-rss.herokuapp.com/feed/", "https://lorem-rss.herokuapp.com/other/"])
+        self.assertEqual(self.db.get_url_by_key("https://lorem-rss.herokuapp.com/feed"),
+                         "https://lorem-rss.herokuapp.com/feed/")
+
+    def test_add_user_bookmark_reuses_feed_by_key(self):
+        self.db.add_user_bookmark(telegram_id=25525, url="https://lorem-rss.herokuapp.com/feed/", alias="feed",
+                                  key="https://lorem-rss.herokuapp.com/feed")
+        url = self.db.add_user_bookmark(telegram_id=25526, url="https://lorem-rss.herokuapp.com/feed",
+                                        alias="feed", key="https://lorem-rss.herokuapp.com/feed")
+
+        self.assertEqual(url, "https://lorem-rss.herokuapp.com/feed/")
+        self.assertEqual([row[0] for row in self.db.get_all_urls()], ["https://lorem-rss.herokuapp.com/feed/"])
+
+    def test_failures(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed1")
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed2")
+
+        self.assertEqual(self.db.add_failure(url="https://lorem-rss.herokuapp.com/feed1",
+                                             host="lorem-rss.herokuapp.com"), (1, 1))
+        self.assertEqual(self.db.add_failure(url="https://lorem-rss.herokuapp.com/feed2",
+                                             host="lorem-rss.herokuapp.com"), (1, 2))
+        self.db.open_host(host="lorem-rss.herokuapp.com", retry_at=1700000000.0)
+        self.assertEqual(self.db.get_failing_hosts(), {"lorem-rss.herokuapp.com": 1700000000.0})
+        self.assertEqual(self.db.get_all_urls()[0][4], 1)
+
+        self.db.reset_failures(url="https://lorem-rss.herokuapp.com/feed1", host="lorem-rss.herokuapp.com")
+        self.assertEqual(self.db.get_failing_hosts(), {})
+        self.assertEqual([row[4] for row in self.db.get_all_urls()], [0, 1])
+
     def test_get_url(self):
         self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
         result = self.db.get_url(url="https://lorem-rss.herokuapp.com/feed")
 
         self.assertEqual(result.url, "https://lorem-rss.herokuapp.com/feed")
 
+    def test_seen_entries(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.assertEqual(self.db.get_seen_entries(url="https://lorem-rss.herokuapp.com/feed"), set())
+
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1, 2, 3])
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[3, 4])
+
+        result = self.db.get_seen_entries(url="https://lorem-rss.herokuapp.com/feed")
+        self.assertEqual(result, {1, 2, 3, 4})
+
+    def test_seen_entries_retention(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1, 2, 3], retention=3)
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[3, 4], retention=3)
+
+        result = self.db.get_seen_entries(url="https://lorem-rss.herokuapp.com/feed")
+        self.assertEqual(len(result), 3)
+        self.assertIn(3, result)
+        self.assertIn(4, result)
+
+    def test_seen_entries_with_outbox(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1],
+                                 news={1: [(25525, "news", False), (25526, "news", True)]})
+
+        result = self.db.get_outbox()
+        self.assertEqual([row[1:4] for row in result], [(25525, "news", False), (25526, "news", True)])
+
+    def test_seen_entries_queued_once(self):
+        self.db.add_url(url="https://lorem-rss.herokuapp.com/feed")
+        self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1])
+
+        # Two workers read the feed while entry 2 was new, only the first one to write queues it
+        news = {2: [(25525, "news", False)]}
+        self.assertEqual(self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1, 2],
+                                                  news=news), [2])
+        self.assertEqual(self.db.add_seen_entries(url="https://lorem-rss.herokuapp.com/feed", entry_ids=[1, 2],
+                                                  news=news), [])
+        self.assertEqual(len(self.db.get_outbox()), 1)
+
+    def test_outbox(self):
+        self.db.add_outbox([(25525, "first", False), (25525, "second", False), (25525, "third", False)])
+        first, second, third = self.db.get_outbox()
+
+        self.db.remove_outbox([first[0]])
+        self.db.retry_outbox([second[0]], now=1000, max_attempts=2, delay=60)
+        self.assertEqual(self.db.get_outbox(), [(second[0], 25525, "second", False, 1), third])
+        # A failed message waits for its retry, a held back one until it is released
+        self.assertEqual(self.db.get_outbox(now=1059), [third])
+        self.assertEqual(self.db.get_outbox(now=1060), [(second[0], 25525, "second", False, 1), third])
+        self.db.hold_outbox([third[0]])
+        self.assertEqual(self.db.get_outbox(now=10 ** 12), [(second[0], 25525, "second", False, 1)])
+        self.db.release_outbox()
+        self.assertEqual(self.db.get_outbox(now=1060), [(second[0], 25525, "second", False, 1), third])
+
+        self.db.retry_outbox([second[0]], now=1000, max_attempts=2)
+        self.assertEqual(self.db.get_outbox(), [third])
+
+    def test_digest_outbox(self):
+        self.db.add_outbox([(1, "a", True), (2, "b", True), (3, "c", False), (1, "d", True), (2, "e", True)])
+
+        result = self.db.get_digest_outbox([2, 1, 3])
+        self.assertEqual([row[1:3] for row in result], [(1, "a"), (1, "d"), (2, "b"), (2, "e")])
+
     def test_add_user_bookmark(self):
         self.db.add_user(telegram_id=25525, username="TestDummy",
                          firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=True)
@@ -185,6 +330,26 @@ class TestDatabaseHandler(unittest.TestCase):
         self.assertEqual(result[1][1], "TestDummy02")
         self.assertEqual(result[2][1], "TestDummy03")
 
+    def test_get_active_users_for_urls(self):
+        self.db.add_user(telegram_id=25526, username="TestDummy01",
+                         firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=True)
+        self.db.add_user(telegram_id=25527, username="TestDummy02",
+                         firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=False)
+
+        self.db.add_user_bookmark(
+            telegram_id=25526, url="http://cbrgm.de", alias="cbrgm")
+        self.db.add_user_bookmark(
+            telegram_id=25527, url="http://cbrgm.de", alias="niceblog")
+        self.db.add_user_bookmark(
+            telegram_id=25526, url="https://lorem-rss.herokuapp.com/feed", alias="lorem")
+
+        result = self.db.get_active_users_for_urls(
+            ["http://cbrgm.de", "https://lorem-rss.herokuapp.com/feed", "http://example.com"])
+
+        self.assertEqual(result["http://cbrgm.de"], [(25526, "cbrgm", False)])
+        self.assertEqual(result["https://lorem-rss.herokuapp.com/feed"], [(25526, "lorem", False)])
+        self.assertEqual(result["http://example.com"], [])
+
     def test_get_user_bookmark(self):
         self.db.add_user(telegram_id=25525, username="TestDummy",
                          firstname="John", lastname="Snow", language_code="DE", is_bot=False, is_active=True)
@@ -227,6 +392,7 @@ class TestDatabaseHandler(unittest.TestCase):
         self.assertEqual(web.url, "https://lorem-rss.herokuapp.com/feed")
 
     def tearDown(self):
+        self.db.close()
         base_path = os.path.abspath(os.path.dirname(__file__))
         filepath = os.path.join(base_path, '..', "resources/test.db")
         os.remove(filepath)
@@ -0,0 +1,39 @@
+import datetime
+import unittest
+
+import pytz
+
+from util.datehandler import DateHandler
+
+
+class TestDateHandler(unittest.TestCase):
+
+    def test_get_datetime_now(self):
+        now = DateHandler.get_datetime_now()
+
+        self.assertEqual(now.microsecond, 0)
+        self.assertEqual(now.tzinfo.zone, "Europe/Berlin")
+
+    def test_parse_datetime_rfc822(self):
+        result = DateHandler.parse_datetime("Mon, 01 Jan 2024 10:00:00 GMT")
+        self.assertEqual(result, datetime.datetime(2024, 1, 1, 10, tzinfo=pytz.utc))
+
+        result = DateHandler.parse_datetime("Sun, 7 Jan 2024 09:05:03 +0100")
+        self.assertEqual(result, datetime.datetime(2024, 1, 7, 8, 5, 3, tzinfo=pytz.utc))
+
+    def test_parse_datetime_iso8601(self):
+        result = DateHandler.parse_datetime("2024-01-01T10:00:00Z")
+        self.assertEqual(result, datetime.datetime(2024, 1, 1, 10, tzinfo=pytz.utc))
+
+        result = DateHandler.parse_datetime(str(DateHandler.get_datetime_now()))
+        self.assertIsNotNone(result.tzinfo)
+
+    def test_parse_datetime_naive(self):
+        # Dates without timezone are taken as UTC
+        result = DateHandler.parse_datetime("2024-01-01 10:00:00")
+        self.assertEqual(result, datetime.datetime(2024, 1, 1, 10, tzinfo=pytz.utc))
+        self.assertEqual(result.tzinfo.zone, "Europe/Berlin")
+
+    def test_parse_datetime_fallback(self):
+        result = DateHandler.parse_datetime("January 5, 2024")
+        self.assertEqual(result, datetime.datetime(2024, 1, 5, tzinfo=pytz.utc))
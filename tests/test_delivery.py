@@ -0,0 +1,260 @@
+import asyncio
+import contextlib
+import io
+import os
+import time
+import unittest
+from unittest import mock
+
+from telegram.error import Forbidden, RetryAfter
+
+from util.database import DatabaseHandler
+from util.delivery import (MessageQueue, OutboxWorker, TokenBucket, PRIORITY_HIGH, PRIORITY_LOW, DELIVERED,
+                           REJECTED, FAILED, pack_messages)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_delay(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket.updated
+
+        self.assertEqual(bucket.delay(now=now), 0)
+        bucket.consume(now=now)
+        bucket.consume(now=now)
+        self.assertAlmostEqual(bucket.delay(now=now), 0.5)
+        self.assertEqual(bucket.delay(now=now + 0.5), 0)
+        self.assertTrue(bucket.is_full(now=now + 10))
+
+
+class TestPackMessages(unittest.TestCase):
+
+    def test_pack_messages(self):
+        lines = ["x" * 1000 for _ in range(10)]
+        messages = pack_messages(lines)
+
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(all(len(message) <= 4096 for message in messages))
+        self.assertEqual("\n".join(messages).split("\n"), lines)
+
+    def test_pack_messages_oversized_line(self):
+        messages = pack_messages(["short", "x" * 5000, "short"])
+        self.assertEqual(messages, ["short", "x" * 5000, "short"])
+
+
+class TestMessageQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.bot = mock.AsyncMock()
+        self.forbidden = []
+        self.queue = MessageQueue(bot=self.bot, senders=1, on_forbidden=self.forbidden.append, global_rate=1000)
+        self.queue.PRIVATE_RATE = 50
+
+    async def asyncTearDown(self):
+        await self.queue.stop()
+
+    async def test_priority(self):
+        low = await self.queue.send_message(chat_id=1, text="news", priority=PRIORITY_LOW)
+        high = await self.queue.send_message(chat_id=2, text="reply", priority=PRIORITY_HIGH)
+        self.queue.start()
+
+        self.assertEqual(await high, DELIVERED)
+        self.assertEqual(await low, DELIVERED)
+        texts = [call.kwargs["text"] for call in self.bot.send_message.call_args_list]
+        self.assertEqual(texts, ["reply", "news"])
+
+    async def test_per_chat_limit(self):
+        self.queue.start()
+        started = time.monotonic()
+        futures = [await self.queue.send_message(chat_id=1, text=str(i)) for i in range(4)]
+        await asyncio.gather(*futures)
+
+        # The bucket of the chat holds one token and refills 50 per second
+        self.assertGreaterEqual(time.monotonic() - started, 3 / 50)
+        texts = [call.kwargs["text"] for call in self.bot.send_message.call_args_list]
+        self.assertEqual(texts, ["0", "1", "2", "3"])
+
+    async def test_per_chat_limit_under_load(self):
+        await self.queue.stop()
+        self.queue = MessageQueue(bot=self.bot, senders=4, global_rate=20)
+        self.queue.PRIVATE_RATE = 10
+        # All senders wait for the global limit, none may send for the chat while another one holds its token
+        self.queue.global_bucket.tokens = 0
+        sent = []
+        self.bot.send_message.side_effect = lambda **kwargs: sent.append(time.monotonic())
+        self.queue.start()
+
+        futures = [await self.queue.send_message(chat_id=1, text=str(i)) for i in range(4)]
+        await asyncio.gather(*futures)
+
+        gaps = [later - earlier for earlier, later in zip(sent, sent[1:])]
+        self.assertGreaterEqual(min(gaps), 0.09)
+
+    async def test_retry_after(self):
+        self.bot.send_message.side_effect = [RetryAfter(0), None]
+        self.queue.start()
+
+        self.assertEqual(await (await self.queue.send_message(chat_id=1, text="news")), DELIVERED)
+        self.assertEqual(self.bot.send_message.call_count, 2)
+
+    async def test_forbidden(self):
+        self.bot.send_message.side_effect = Forbidden("blocked")
+        self.queue.start()
+
+        self.assertEqual(await (await self.queue.send_message(chat_id=1, text="news")), REJECTED)
+        self.assertEqual(self.forbidden, [1])
+
+    async def test_unexpected_error(self):
+        self.bot.send_message.side_effect = [RuntimeError("broken"), None]
+        self.queue.start()
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            first = await self.queue.send_message(chat_id=1, text="first")
+            second = await self.queue.send_message(chat_id=2, text="second")
+
+            # The message fails, the only sender keeps delivering the others
+            self.assertEqual(await first, FAILED)
+            self.assertEqual(await second, DELIVERED)
+
+    async def test_forbidden_callback_error(self):
+        self.bot.send_message.side_effect = [Forbidden("blocked"), None]
+        self.queue.on_forbidden = mock.Mock(side_effect=RuntimeError("database is locked"))
+        self.queue.start()
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(await (await self.queue.send_message(chat_id=1, text="first")), REJECTED)
+            self.assertEqual(await (await self.queue.send_message(chat_id=2, text="second")), DELIVERED)
+        self.queue.on_forbidden.assert_called_once_with(1)
+
+
+class FakeQueue(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self.results.pop(0) if self.results else DELIVERED)
+        return future
+
+
+class TestOutboxWorker(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = DatabaseHandler("resources/test.db")
+
+    def tearDown(self):
+        self.db.close()
+        base_path = os.path.abspath(os.path.dirname(__file__))
+        os.remove(os.path.join(base_path, '..', "resources/test.db"))
+
+    async def drain(self, worker):
+        worker.interval = 0
+        task = asyncio.ensure_future(worker.run())
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+        worker.set_running(False)
+        worker.notify()
+        await task
+        await worker.flush()
+
+    async def test_drain(self):
+        self.db.add_outbox([(1, "first", False), (2, "second", False)])
+        queue = FakeQueue([DELIVERED, REJECTED])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue))
+
+        self.assertEqual(queue.sent, [(1, "first"), (2, "second")])
+        self.assertEqual(self.db.get_outbox(), [])
+
+    async def test_drain_digest(self):
+        self.db.add_outbox([(1, "a", True), (2, "b", False), (1, "c", True)])
+        queue = FakeQueue([])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue))
+
+        self.assertEqual(sorted(queue.sent), [(1, "a\nc"), (2, "b")])
+        self.assertEqual(self.db.get_outbox(), [])
+
+    async def test_drain_digest_across_batches(self):
+        # The poller writes the messages entry by entry across all subscribers
+        self.db.add_outbox([(chat_id, "entry %d" % entry, True) for entry in range(8) for chat_id in (1, 2, 3)])
+        queue = FakeQueue([])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue, batch_size=10))
+
+        self.assertEqual(sorted(queue.sent), [(chat_id, "\n".join("entry %d" % entry for entry in range(8)))
+                                              for chat_id in (1, 2, 3)])
+        self.assertEqual(self.db.get_outbox(), [])
+
+    async def test_drain_retries_failed_messages(self):
+        self.db.add_outbox([(1, "first", False), (2, "second", False)])
+        queue = FakeQueue([FAILED, FAILED])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue, retry_delay=0))
+
+        # Failed messages stay in the outbox until they were delivered
+        self.assertEqual(queue.sent, [(1, "first"), (2, "second"), (1, "first"), (2, "second")])
+        self.assertEqual(self.db.get_outbox(), [])
+
+    async def test_drain_delays_failed_messages(self):
+        self.db.add_outbox([(1, "first", False)])
+        queue = FakeQueue([FAILED])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue, retry_delay=60))
+
+        self.assertEqual(queue.sent, [(1, "first")])
+        self.assertEqual([row[4] for row in self.db.get_outbox()], [1])
+        self.assertEqual(self.db.get_outbox(now=time.time()), [])
+
+    async def test_drain_after_outbox_was_emptied(self):
+        worker = OutboxWorker(database=self.db, queue=FakeQueue([]), interval=0)
+        task = asyncio.ensure_future(worker.run())
+
+        try:
+            # Sqlite hands out the ids of an emptied table again
+            for text in ("first", "second"):
+                self.db.add_outbox([(1, text, False)])
+                worker.notify()
+                for _ in range(10):
+                    await asyncio.sleep(0.01)
+        finally:
+            worker.set_running(False)
+            worker.notify()
+            await task
+        await worker.flush()
+
+        self.assertEqual(worker.queue.sent, [(1, "first"), (1, "second")])
+        self.assertEqual(self.db.get_outbox(), [])
+
+    async def test_recovery(self):
+        # Messages left in the outbox by a crashed process are delivered after a restart
+        self.db.add_outbox([(1, "first", False)])
+        self.db.add_outbox([(1, "second", False)])
+        self.db.remove_outbox([self.db.get_outbox()[0][0]])
+        queue = FakeQueue([])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue))
+
+        self.assertEqual(queue.sent, [(1, "second")])
+
+    async def test_recovery_of_messages_in_flight(self):
+        # Messages in flight when the process died are sent right after a restart
+        self.db.add_outbox([(1, "first", False)])
+        self.db.hold_outbox([row[0] for row in self.db.get_outbox()])
+        queue = FakeQueue([])
+
+        await self.drain(OutboxWorker(database=self.db, queue=queue))
+
+        self.assertEqual(queue.sent, [(1, "first")])
+
+    async def test_messages_in_flight_dont_block_others(self):
+        self.db.add_outbox([(-1, "group %d" % i, False) for i in range(100)])
+        worker = OutboxWorker(database=self.db, queue=FakeQueue([]), batch_size=100)
+        self.assertEqual(len(await worker.fetch()), 100)
+
+        # However long the group takes, its messages in flight are not read again
+        self.db.add_outbox([(1, "private", False)])
+        self.assertEqual([row[2] for row in await worker.fetch()], ["private"])
@@ -0,0 +1,42 @@
+import unittest
+
+from feedparser import FeedParserDict
+
+from util.feedcache import FeedCache
+
+
+class TestFeedCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = FeedCache(ttl=60)
+        feed = FeedParserDict(entries=[])
+        cache.put("http://example.com/feed", feed, now=0)
+
+        self.assertIs(cache.get("http://example.com/feed", now=30), feed)
+        self.assertIsNone(cache.get("http://example.com/other", now=30))
+
+    def test_canonical_key(self):
+        cache = FeedCache(ttl=60)
+        feed = FeedParserDict(entries=[])
+        cache.put("HTTP://Example.com/feed/", feed)
+
+        self.assertIs(cache.get("http://example.com/feed?utm_source=x"), feed)
+        self.assertIn("http://example.com/feed", cache)
+
+    def test_expiry(self):
+        cache = FeedCache(ttl=60)
+        cache.put("http://example.com/feed", FeedParserDict(entries=[]), now=0)
+
+        self.assertIsNone(cache.get("http://example.com/feed", now=60))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = FeedCache(ttl=60, max_size=2)
+        cache.put("http://example.com/a", FeedParserDict(entries=[]), now=0)
+        cache.put("http://example.com/b", FeedParserDict(entries=[]), now=0)
+        cache.get("http://example.com/a", now=1)
+        cache.put("http://example.com/c", FeedParserDict(entries=[]), now=2)
+
+        self.assertIsNotNone(cache.get("http://example.com/a", now=3))
+        self.assertIsNone(cache.get("http://example.com/b", now=3))
+        self.assertIsNotNone(cache.get("http://example.com/c", now=3))
@@ -1,9 +1,44 @@
+import time
 import unittest
-from util.feedhandler import FeedHandler
+
+import httpx
+from feedparser import FeedParserDict
+
+from util.feedhandler import FeedEntry, FeedHandler
+from util.fetcher import Fetcher
+
+SAMPLE_RSS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Sample</title>
+<item><title>First</title><link>http://example.com/1</link><guid>1</guid>
+<pubDate>Mon, 01 Jan 2024 10:00:00 GMT</pubDate></item>
+<item><title>Second</title><link>http://example.com/2</link><guid>2</guid>
+<pubDate>Mon, 01 Jan 2024 09:00:00 GMT</pubDate></item>
+</channel></rss>"""
+
+LOREM_ITEMS = "".join("<item><title>Lorem %d</title><link>http://example.com/%d</link><guid>%d</guid></item>"
+                      % (i, i, i) for i in range(10))
+LOREM_RSS = ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Lorem</title>%s</channel></rss>'
+             % LOREM_ITEMS).encode("utf-8")
+
+
+def serve_offline(request):
+    # Stands in for the feeds the tests used to download from the internet
+    if request.url.host == "lorem-rss.herokuapp.com":
+        return httpx.Response(200, content=LOREM_RSS, headers={"Content-Type": "application/rss+xml"})
+    return httpx.Response(200, content=b"<html><body>No feed here</body></html>",
+                          headers={"Content-Type": "text/html"})
 
 
 class TestFeedHandler(unittest.TestCase):
 
+    def setUp(self):
+        self.fetcher = FeedHandler.fetcher
+        FeedHandler.fetcher = Fetcher(transport=httpx.MockTransport(serve_offline))
+
+    def tearDown(self):
+        FeedHandler.fetcher.close()
+        FeedHandler.fetcher = self.fetcher
+
     def test_parse_feed(self):
         url = "https://lorem-rss.herokuapp.com/feed"
         feed = FeedHandler.parse_feed(url)
@@ -23,6 +58,19 @@ class TestFeedHandler(unittest.TestCase):
         url = "www.google.de"
         self.assertFalse(FeedHandler.is_parsable(url))
 
+    def test_resolve_feed_url_keeps_served_url(self):
+        def serve_slash_only(request):
+            if request.url.path == "/feed/":
+                return httpx.Response(200, content=SAMPLE_RSS)
+            return httpx.Response(404)
+
+        FeedHandler.fetcher.close()
+        FeedHandler.fetcher = Fetcher(transport=httpx.MockTransport(serve_slash_only))
+
+        # The canonical form drops the trailing slash, the feed is only served with it
+        url = FeedHandler.format_url_string("https://Example.com/feed/")
+        self.assertEqual(FeedHandler.resolve_feed_url(url), "https://example.com/feed/")
+
     def test_format_url_string(self):
         url = "https://lorem-rss.herokuapp.com/feed"
         url = FeedHandler.format_url_string(url)
@@ -35,3 +83,74 @@ class TestFeedHandler(unittest.TestCase):
         url = "lorem-rss.herokuapp.com/feed"
         url = FeedHandler.format_url_string(url)
         self.assertEqual(url, "http://lorem-rss.herokuapp.com/feed")
+
+        url = "Example.com/Feeds/RSS.xml"
+        url = FeedHandler.format_url_string(url)
+        self.assertEqual(url, "http://example.com/Feeds/RSS.xml")
+
+        url = "example.com/feed/?utm_source=x"
+        url = FeedHandler.format_url_string(url)
+        self.assertEqual(url, "http://example.com/feed/?utm_source=x")
+
+    def test_canonicalize_url(self):
+        self.assertEqual(FeedHandler.canonicalize_url("HTTPS://Example.COM:443/feed/"), "https://example.com/feed")
+        self.assertEqual(FeedHandler.canonicalize_url("http://example.com:8080"), "http://example.com:8080/")
+        self.assertEqual(FeedHandler.canonicalize_url("http://example.com/feed?utm_source=x&id=5&fbclid=y#top"),
+                         "http://example.com/feed?id=5")
+        self.assertEqual(FeedHandler.canonicalize_url("http://example.com/feed?q=a%2Fb"),
+                         "http://example.com/feed?q=a%2Fb")
+
+
+class TestFeedHandlerAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fetch_feed_async(self):
+        def handler(request):
+            return httpx.Response(200, content=SAMPLE_RSS, headers={"ETag": '"abc"'})
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as client:
+            feed = await FeedHandler.fetch_feed_async(client, "http://example.com/feed")
+
+        self.assertEqual(len(feed.entries), 2)
+        self.assertEqual(feed.entries[0].title, "First")
+        self.assertEqual(feed.etag, '"abc"')
+
+    async def test_fetch_feed_async_not_modified(self):
+        def handler(request):
+            self.assertEqual(request.headers["If-None-Match"], '"abc"')
+            return httpx.Response(304)
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as client:
+            feed = await FeedHandler.fetch_feed_async(client, "http://example.com/feed", etag='"abc"')
+
+        self.assertIsNone(feed)
+
+    async def test_fetch_feed_async_builds_entries(self):
+        def handler(request):
+            return httpx.Response(200, content=SAMPLE_RSS)
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as client:
+            feed = await FeedHandler.fetch_feed_async(client, "http://example.com/feed")
+
+        entry = feed.entries[0]
+        self.assertIsInstance(entry, FeedEntry)
+        self.assertEqual(entry.guid, "1")
+        self.assertEqual(entry.link, "http://example.com/1")
+        self.assertEqual(entry.timestamp, 1704103200)
+
+
+class TestFeedEntry(unittest.TestCase):
+
+    def test_from_entry(self):
+        entry = FeedEntry.from_entry(FeedParserDict(link="http://example.com/1", title="First",
+                                                    updated_parsed=time.gmtime(1704103200)))
+        self.assertEqual(entry.guid, "http://example.com/1")
+        self.assertEqual(entry.timestamp, 1704103200)
+
+        entry = FeedEntry.from_entry(FeedParserDict(title="Untimed"))
+        self.assertEqual(entry.guid, "Untimed")
+        self.assertIsNone(entry.timestamp)
+
+    def test_entry_id(self):
+        self.assertEqual(FeedEntry("1", "a", "a").entry_id, FeedEntry("1", "b", "b").entry_id)
+        self.assertNotEqual(FeedEntry("1", "a", "a").entry_id, FeedEntry("2", "a", "a").entry_id)
+        self.assertFalse(hasattr(FeedEntry("1", "a", "a"), "__dict__"))
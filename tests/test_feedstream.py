@@ -0,0 +1,65 @@
+import unittest
+
+import feedparser
+
+from util.feedstream import EntryLimiter
+
+RSS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"><channel><title>Sample</title>
+<ttl>60</ttl>
+<item><title>First</title><guid>1</guid><content:encoded><![CDATA[<item>not an entry</item>]]></content:encoded></item>
+<item><title>Second</title><guid>2</guid></item>
+<item><title>Third</title><guid>3</guid></item>
+</channel></rss>"""
+
+ATOM = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Sample</title>
+<entry><title>First</title><id>urn:1</id></entry>
+<entry><title>Second</title><id>urn:2</id></entry>
+<entry><title>Third</title><id>urn:3</id></entry>
+</feed>"""
+
+
+def limit(content, entries, chunk_size=16):
+    limiter = EntryLimiter(entries)
+    for i in range(0, len(content), chunk_size):
+        if limiter.feed(content[i:i + chunk_size]):
+            break
+    return limiter.truncate(content)
+
+
+class TestEntryLimiter(unittest.TestCase):
+
+    def test_rss(self):
+        feed = feedparser.parse(limit(RSS, 2))
+
+        self.assertFalse(feed.bozo)
+        self.assertEqual([entry.id for entry in feed.entries], ["1", "2"])
+        self.assertEqual(feed.feed.ttl, "60")
+
+    def test_atom(self):
+        feed = feedparser.parse(limit(ATOM, 1, chunk_size=1))
+
+        self.assertFalse(feed.bozo)
+        self.assertEqual([entry.id for entry in feed.entries], ["urn:1"])
+
+    def test_fewer_entries(self):
+        self.assertEqual(limit(RSS, 5), RSS)
+
+    def test_same_entries_as_whole_feed(self):
+        whole = feedparser.parse(RSS)
+        limited = feedparser.parse(limit(RSS, 2))
+
+        self.assertEqual(limited.entries, whole.entries[:2])
+
+    def test_broken_feed_is_kept(self):
+        content = b"<rss><channel><item><title>&nbsp;</title></item><item></item></channel></rss>"
+        limiter = EntryLimiter(1)
+
+        self.assertFalse(limiter.feed(content))
+        self.assertTrue(limiter.failed)
+        self.assertEqual(limiter.truncate(content), content)
+
+    def test_utf16_is_kept(self):
+        content = RSS.decode("utf-8").replace("UTF-8", "UTF-16").encode("utf-16")
+        self.assertEqual(limit(content, 1), content)
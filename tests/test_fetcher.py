@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+
+import httpx
+
+from util.fetcher import Fetcher, ResponseTooLarge
+
+
+class TestFetcher(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fetch(self):
+        def handler(request):
+            if request.url.path == "/old":
+                return httpx.Response(301, headers={"Location": "http://example.com/feed"})
+            return httpx.Response(200, content=b"<rss/>", headers={"ETag": '"abc"'})
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as fetcher:
+            result = await fetcher.fetch("http://example.com/old")
+            client = fetcher.client
+            await fetcher.fetch("http://example.com/feed")
+            # Connections are reused between fetches
+            self.assertIs(fetcher.client, client)
+
+        self.assertEqual(result.url, "http://example.com/feed")
+        self.assertEqual(result.content, b"<rss/>")
+        self.assertEqual(result.headers["etag"], '"abc"')
+
+    async def test_fetch_not_modified(self):
+        def handler(request):
+            self.assertEqual(request.headers["If-Modified-Since"], "Mon, 01 Jan 2024 00:00:00 GMT")
+            return httpx.Response(304)
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as fetcher:
+            result = await fetcher.fetch("http://example.com/feed", modified="Mon, 01 Jan 2024 00:00:00 GMT")
+
+        self.assertIsNone(result)
+
+    async def test_fetch_errors(self):
+        def handler(request):
+            if request.url.path == "/large":
+                return httpx.Response(200, content=b"x" * 2048)
+            return httpx.Response(404)
+
+        async with Fetcher(max_body_size=1024, transport=httpx.MockTransport(handler)) as fetcher:
+            with self.assertRaises(ResponseTooLarge):
+                await fetcher.fetch("http://example.com/large")
+            with self.assertRaises(httpx.HTTPStatusError):
+                await fetcher.fetch("http://example.com/missing")
+
+    async def test_per_host_limit(self):
+        running = {}
+        peak = {}
+
+        async def handler(request):
+            host = request.url.host
+            running[host] = running.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), running[host])
+            await asyncio.sleep(0.01)
+            running[host] -= 1
+            return httpx.Response(200, content=b"<rss/>")
+
+        async with Fetcher(per_host=2, transport=httpx.MockTransport(handler)) as fetcher:
+            await asyncio.gather(*[fetcher.fetch("http://%s.com/%d" % (host, i))
+                                   for host in ("a", "b") for i in range(10)])
+
+        self.assertEqual(peak, {"a.com": 2, "b.com": 2})
+
+    def test_fetch_blocking(self):
+        def handler(request):
+            return httpx.Response(200, content=b"<rss/>")
+
+        fetcher = Fetcher(transport=httpx.MockTransport(handler))
+        result = fetcher.fetch_blocking("http://example.com/feed")
+        fetcher.close()
+
+        self.assertEqual(result.content, b"<rss/>")
+
+
+class TestFetcherEntryLimit(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stops_after_max_entries(self):
+        chunks = []
+
+        async def body():
+            yield b'<?xml version="1.0"?><rss version="2.0"><channel><title>Huge</title>'
+            for i in range(100000):
+                chunks.append(i)
+                yield b"<item><title>Entry %d</title><guid>%d</guid></item>" % (i, i)
+            yield b"</channel></rss>"
+
+        def handler(request):
+            return httpx.Response(200, content=body())
+
+        async with Fetcher(max_body_size=1024 * 1024, transport=httpx.MockTransport(handler)) as fetcher:
+            result = await fetcher.fetch("http://example.com/feed", max_entries=3)
+
+        # Read on up to DRAIN_SIZE at most, the 4 MB rest of the body is never downloaded
+        self.assertLess(len(chunks), 10000)
+        self.assertTrue(result.content.endswith(b"<guid>2</guid></item></channel></rss>"))
+
+    async def test_keeps_short_feeds(self):
+        content = b'<rss version="2.0"><channel><item><guid>1</guid></item></channel></rss>'
+
+        def handler(request):
+            return httpx.Response(200, content=content)
+
+        async with Fetcher(transport=httpx.MockTransport(handler)) as fetcher:
+            result = await fetcher.fetch("http://example.com/feed", max_entries=3)
+
+        self.assertEqual(result.content, content)
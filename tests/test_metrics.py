@@ -0,0 +1,84 @@
+import unittest
+import urllib.request
+
+from util import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "A counter.", ["result"], registry=self.registry)
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        counter.inc(result="error")
+
+        self.assertEqual(counter.get(result="ok"), 3)
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_total A counter.\n'
+                         '# TYPE test_total counter\n'
+                         'test_total{result="error"} 1\n'
+                         'test_total{result="ok"} 3\n')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "A histogram.", buckets=(0.1, 1), registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_seconds A histogram.\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{le="0.1"} 1\n'
+                         'test_seconds_bucket{le="1"} 2\n'
+                         'test_seconds_bucket{le="+Inf"} 3\n'
+                         'test_seconds_sum 5.55\n'
+                         'test_seconds_count 3\n')
+
+    def test_gauge_function(self):
+        items = [1, 2]
+        gauge = metrics.Gauge("test_depth", "A gauge.", registry=self.registry)
+        gauge.set_function(items.__len__)
+        items.append(3)
+
+        self.assertIn("test_depth 3\n", self.registry.render())
+
+    def test_timed_methods(self):
+        histogram = metrics.Histogram("test_db_seconds", "Calls.", ["method"], registry=self.registry)
+
+        @metrics.timed_methods(histogram)
+        class Handler(object):
+
+            def get(self):
+                return 1
+
+            def iterate(self):
+                yield from range(3)
+
+            def _private(self):
+                return 2
+
+        handler = Handler()
+        self.assertEqual(handler.get(), 1)
+        self.assertEqual(list(handler.iterate()), [0, 1, 2])
+        self.assertEqual(handler._private(), 2)
+
+        self.assertEqual(histogram.get_count(method="get"), 1)
+        self.assertEqual(histogram.get_count(method="iterate"), 1)
+        self.assertEqual(histogram.get_count(method="_private"), 0)
+        self.assertEqual(histogram.get_total_count(), 2)
+
+    def test_server(self):
+        metrics.Counter("test_total", "A counter.", registry=self.registry).inc()
+        server = metrics.start_server(0, registry=self.registry)
+
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1]) as response:
+                body = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertIn("test_total 1\n", body)
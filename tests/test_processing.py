@@ -0,0 +1,426 @@
+import asyncio
+import contextlib
+import io
+import time
+import unittest
+from unittest import mock
+
+from feedparser import FeedParserDict
+
+from util.feedcache import FeedCache
+from util.feedhandler import FeedEntry
+from util.fetcher import FetchResult
+from util.processing import BatchProcess
+from util.subscriptions import SubscriptionIndex
+from util.tracing import Tracer
+
+SAMPLE_RSS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Sample</title>
+<item><title>First</title><link>http://example.com/1</link><guid>1</guid></item>
+</channel></rss>"""
+
+URL = ("http://example.com/feed", "2024-01-01 00:00:00+01:00", None, None, 0)
+
+
+class FakeDatabase(object):
+
+    def __init__(self, subscriptions, digest=False):
+        self.subscriptions = subscriptions
+        self.digest = digest
+        self.seen = {}
+        self.outbox = []
+        self.failures = {}
+        self.hosts = {}
+
+    def get_active_users_for_urls(self, urls):
+        return {url: [(telegram_id, "alias", self.digest) for telegram_id in self.subscriptions.get(url, [])]
+                for url in urls}
+
+    def update_url(self, url, **kwargs):
+        pass
+
+    def get_seen_entries(self, url):
+        return set(self.seen.get(url, []))
+
+    def add_seen_entries(self, url, entry_ids, news=None):
+        seen = self.get_seen_entries(url)
+        self.seen[url] = list(entry_ids)
+        queued = [entry_id for entry_id in news or {} if entry_id not in seen]
+        self.add_outbox([message for entry_id in queued for message in news[entry_id]])
+        return queued
+
+    def add_outbox(self, messages):
+        self.outbox.extend(messages)
+
+    def add_failure(self, url, host):
+        self.failures[url] = self.failures.get(url, 0) + 1
+        self.hosts[host] = self.hosts.get(host, 0) + 1
+        return self.failures[url], self.hosts[host]
+
+    def reset_failures(self, url, host):
+        self.failures.pop(url, None)
+        self.hosts.pop(host, None)
+
+    def open_host(self, host, retry_at):
+        pass
+
+    def get_failing_hosts(self):
+        return {}
+
+
+class FakeFetcher(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    async def fetch(self, url, etag=None, modified=None, trace=None, max_entries=None):
+        return FetchResult(url, {}, self.content)
+
+
+def fetch_feed_returning(feed):
+    return mock.patch("util.processing.FeedHandler.fetch_feed_async", new_callable=mock.AsyncMock,
+                      return_value=feed)
+
+
+class TestBatchProcess(unittest.IsolatedAsyncioTestCase):
+
+    async def test_update_feed_parses_once(self):
+        db = FakeDatabase({"http://example.com/feed": range(100)})
+        process = BatchProcess(database=db, update_interval=300)
+
+        with fetch_feed_returning(FeedParserDict(entries=[])) as fetch:
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual(fetch.call_count, 1)
+
+    async def test_update_feed_skips_inactive_feed(self):
+        db = FakeDatabase({"http://example.com/feed": []})
+        process = BatchProcess(database=db, update_interval=300)
+
+        with fetch_feed_returning(FeedParserDict(entries=[])) as fetch:
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual(fetch.call_count, 0)
+
+    async def test_update_feed_sends_validators(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        db.update_url = mock.Mock()
+        process = BatchProcess(database=db, update_interval=300)
+        feed = FeedParserDict(entries=[], etag='"abc"', modified="Mon, 01 Jan 2024 00:00:00 GMT")
+
+        with fetch_feed_returning(feed) as fetch:
+            await process.parse_parallel(queue=[URL[:2] + ('"xyz"', None, 0)])
+
+        fetch.assert_called_once_with(None, "http://example.com/feed", etag='"xyz"', modified=None, executor=None,
+                                      trace=None)
+        self.assertEqual(db.update_url.call_args.kwargs["etag"], '"abc"')
+        self.assertEqual(db.update_url.call_args.kwargs["modified"], "Mon, 01 Jan 2024 00:00:00 GMT")
+
+    async def test_update_feed_not_modified(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        db.update_url = mock.Mock()
+        process = BatchProcess(database=db, update_interval=300)
+
+        with fetch_feed_returning(None):
+            await process.parse_parallel(queue=[URL[:2] + ('"xyz"', None, 0)])
+
+        db.update_url.assert_not_called()
+        self.assertEqual(db.outbox, [])
+
+    async def test_update_feed_sends_unseen_entries(self):
+        db = FakeDatabase({"http://example.com/feed": [1, 2]})
+        outbox = mock.Mock()
+        process = BatchProcess(database=db, update_interval=300, outbox=outbox)
+
+        def entry(guid):
+            return FeedEntry(guid, "http://example.com/" + guid, guid)
+
+        # The first fetch only records the entries that are already there
+        with fetch_feed_returning(FeedParserDict(entries=[entry("b"), entry("a")])):
+            await process.parse_parallel(queue=[URL])
+        self.assertEqual(db.outbox, [])
+
+        with fetch_feed_returning(FeedParserDict(entries=[entry("d"), entry("c"), entry("b"), entry("a")])):
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual(len(db.outbox), 4)
+        self.assertIn((1, "[alias] <a href='http://example.com/d'>d</a>", False), db.outbox)
+        self.assertIn((2, "[alias] <a href='http://example.com/c'>c</a>", False), db.outbox)
+        outbox.notify.assert_called()
+
+    async def test_update_feed_records_all_entries(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        process = BatchProcess(database=db, update_interval=300)
+        entries = [FeedEntry(str(i), "http://example.com/%d" % i, str(i)) for i in range(6)]
+
+        with fetch_feed_returning(FeedParserDict(entries=entries)):
+            await process.parse_parallel(queue=[URL])
+        # The newest entry is deleted, an older one moves up among the posts sent
+        with fetch_feed_returning(FeedParserDict(entries=entries[1:])):
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual(db.seen["http://example.com/feed"], [entry.entry_id for entry in entries[1:]])
+        self.assertEqual(db.outbox, [])
+
+    async def test_update_feed_digest(self):
+        db = FakeDatabase({"http://example.com/feed": [1]}, digest=True)
+        db.seen = {"http://example.com/feed": [0]}
+        process = BatchProcess(database=db, update_interval=300)
+        entries = [FeedEntry(str(i), "http://example.com/%d" % i, str(i)) for i in range(3)]
+
+        with fetch_feed_returning(FeedParserDict(entries=entries)):
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual([message[2] for message in db.outbox], [True, True, True])
+
+    async def test_update_feed_uses_cache(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        cache = FeedCache()
+        cache.put("http://example.com/feed", FeedParserDict(entries=[FeedEntry("a", "http://example.com/a", "a")]))
+        process = BatchProcess(database=db, update_interval=300, cache=cache)
+
+        with fetch_feed_returning(None) as fetch:
+            await process.parse_parallel(queue=[URL])
+
+        self.assertEqual(fetch.call_count, 0)
+        self.assertEqual(len(db.seen[URL[0]]), 1)
+
+    async def test_update_feed_error(self):
+        db = FakeDatabase({"http://example.com/feed": [1, 2]})
+        process = BatchProcess(database=db, update_interval=300, max_failures=3)
+
+        with mock.patch("util.processing.FeedHandler.fetch_feed_async", side_effect=ValueError("broken")):
+            for _ in range(5):
+                await process.parse_parallel(queue=[URL])
+
+        # Subscribers are told once, when the feed failed max_failures times in a row
+        self.assertEqual([message[0] for message in db.outbox], [1, 2])
+        self.assertEqual(db.failures[URL[0]], 5)
+
+        with fetch_feed_returning(None):
+            await process.parse_parallel(queue=[URL[:4] + (5,)])
+        self.assertEqual(db.failures, {})
+
+    async def test_update_feed_error_backs_off(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        process = BatchProcess(database=db, update_interval=300, max_interval=86400)
+        process.scheduler.jitter = 0
+
+        with mock.patch("util.processing.FeedHandler.fetch_feed_async", side_effect=ValueError("broken")):
+            for _ in range(3):
+                await process.parse_parallel(queue=[URL])
+
+        self.assertGreater(process.scheduler.next_due(), 300 * 2 ** 3 - 10)
+
+    async def test_failing_host_is_shut_off(self):
+        db = FakeDatabase({"http://example.com/%d" % i: [1] for i in range(30)})
+        db.open_host = mock.Mock()
+        process = BatchProcess(database=db, update_interval=300)
+        urls = [("http://example.com/%d" % i, None, None, None, 0) for i in range(30)]
+
+        with mock.patch("util.processing.FeedHandler.fetch_feed_async", side_effect=ValueError("broken")) as fetch:
+            await process.parse_parallel(queue=urls)
+            self.assertEqual(fetch.call_count, 30)
+            db.open_host.assert_called()
+
+            # The feeds of the host don't take a fetch slot until it is tried again
+            await process.parse_parallel(queue=urls)
+            self.assertEqual(fetch.call_count, 30)
+        self.assertEqual(db.outbox, [])
+
+    async def test_parse_in_processes(self):
+        db = FakeDatabase({"http://example.com/feed": [1]})
+        db.seen = {"http://example.com/feed": [0]}
+        process = BatchProcess(database=db, update_interval=300, parse_workers=1)
+        process.client = FakeFetcher(SAMPLE_RSS)
+        process.start_parser()
+
+        try:
+            await process.parse_parallel(queue=[URL])
+        finally:
+            process.parser.shutdown()
+
+        self.assertEqual(db.outbox, [(1, "[alias] <a href='http://example.com/1'>First</a>", False)])
+
+    async def test_parse_parallel_limits_concurrency(self):
+        process = BatchProcess(database=FakeDatabase({}), update_interval=300, concurrency=3)
+        running = []
+        peak = []
+
+        async def update_feed(url, users, trace=None):
+            running.append(url)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(url)
+
+        process.update_feed = update_feed
+        await process.parse_parallel(queue=(("http://example.com/%d" % i,) for i in range(20)))
+
+        self.assertEqual(max(peak), 3)
+        self.assertEqual(len(process.scheduler), 20)
+
+    async def test_parse_parallel_interleaves_hosts(self):
+        process = BatchProcess(database=FakeDatabase({}), update_interval=300, concurrency=1)
+        order = []
+
+        async def update_feed(url, users, trace=None):
+            order.append(url[0])
+
+        process.update_feed = update_feed
+        urls = [("http://%s.example.com/%d" % (host, i),) for host in ("a", "b", "c") for i in range(3)]
+        await process.parse_parallel(queue=urls)
+
+        # Feeds of one host come out of the database side by side, the workers get them spread over the hosts
+        self.assertEqual([url.split(".")[0][7:] for url in order], ["a", "b", "c"] * 3)
+        self.assertEqual(sorted(order), sorted(url[0] for url in urls))
+
+    async def test_parse_parallel_traces_feeds(self):
+        db = FakeDatabase({"http://example.com/feed": [1, 2], "http://example.com/broken": [1]})
+        process = BatchProcess(database=db, update_interval=300, tracer=Tracer())
+
+        class PartlyBrokenFetcher(FakeFetcher):
+            async def fetch(self, url, etag=None, modified=None, trace=None, max_entries=None):
+                if url.endswith("broken"):
+                    raise ValueError("broken")
+                return await super().fetch(url, etag, modified, trace, max_entries)
+
+        process.client = PartlyBrokenFetcher(SAMPLE_RSS)
+        urls = [(url, None, None, None, 0) for url in ("http://example.com/feed", "http://example.com/broken")]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            await process.parse_parallel(queue=urls)
+
+        traces = {trace.url: trace for trace in process.tracer.traces}
+        self.assertEqual(traces["http://example.com/feed"].result, "ok")
+        self.assertIn("parse", traces["http://example.com/feed"].timings)
+        self.assertIn("db", traces["http://example.com/feed"].timings)
+        self.assertEqual(traces["http://example.com/broken"].result, "error")
+
+    async def test_subscribers_from_index(self):
+        db = FakeDatabase({})
+        db.get_active_users_for_urls = mock.Mock()
+        db.get_seen_entries = mock.Mock(return_value={1})
+        index = SubscriptionIndex()
+        index.add("http://example.com/feed", 7, "news")
+        index.update_user(7, is_active=True)
+        process = BatchProcess(database=db, update_interval=300, subscriptions=index)
+
+        with fetch_feed_returning(FeedParserDict(entries=[FeedEntry("2", "http://example.com/2", "Second")])):
+            await process.parse_parallel(queue=[URL])
+
+        db.get_active_users_for_urls.assert_not_called()
+        self.assertEqual([message[0] for message in db.outbox], [7])
+
+    async def test_sync_schedule(self):
+        db = FakeDatabase({})
+        db.iter_urls = mock.Mock(return_value=[("http://example.com/a",), ("http://example.com/b",)])
+        process = BatchProcess(database=db, update_interval=300)
+
+        await process.sync_schedule()
+        self.assertIn("http://example.com/a", process.scheduler)
+        self.assertIn("http://example.com/b", process.scheduler)
+
+        db.iter_urls.return_value = [("http://example.com/b",)]
+        await process.sync_schedule()
+        self.assertNotIn("http://example.com/a", process.scheduler)
+
+    async def test_sync_schedule_shard(self):
+        db = FakeDatabase({})
+        urls = [("http://example.com/%d" % i,) for i in range(100)]
+        db.iter_urls = mock.Mock(return_value=urls)
+        lease = mock.Mock()
+        processes = [BatchProcess(database=db, update_interval=300, lease=lease) for _ in range(3)]
+
+        for index, process in enumerate(processes):
+            lease.renew.return_value = (index, 3)
+            await process.renew_lease()
+            await process.sync_schedule()
+
+        # Every feed is polled by exactly one worker
+        self.assertEqual(sorted(url for process in processes for url in process.scheduler.urls()),
+                         sorted(url[0] for url in urls))
+        self.assertTrue(all(len(process.scheduler) > 10 for process in processes))
+
+        lease.renew.return_value = (0, 1)
+        await processes[0].renew_lease()
+        await processes[0].sync_schedule()
+        self.assertEqual(len(processes[0].scheduler), 100)
+
+    async def test_sync_schedule_polls_cached_feeds_first(self):
+        db = FakeDatabase({})
+        db.iter_urls = mock.Mock(return_value=[("http://example.com/a",)])
+        cache = FeedCache()
+        cache.put("http://example.com/a", FeedParserDict(entries=[]))
+        process = BatchProcess(database=db, update_interval=3600, cache=cache)
+
+        await process.sync_schedule()
+        self.assertEqual(process.scheduler.pop_due(), ["http://example.com/a"])
+
+    async def test_poll_does_not_wait_for_slow_feeds(self):
+        db = FakeDatabase({})
+        db.iter_urls = mock.Mock(return_value=[("http://example.com/slow",), ("http://example.com/fast",)])
+        db.get_feeds = lambda urls: [(url, None, None, None, 0) for url in urls]
+        process = BatchProcess(database=db, update_interval=300, concurrency=2)
+        process.scheduler.schedule("http://example.com/slow", 0)
+        process.scheduler.schedule("http://example.com/fast", 0.05)
+        updated = {}
+
+        async def update_feed(url, users, trace=None):
+            if url[0].endswith("slow"):
+                await asyncio.sleep(1)
+            updated[url[0]] = time.monotonic()
+
+        process.update_feed = update_feed
+        started = time.monotonic()
+        task = asyncio.ensure_future(process._poll())
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        # The feed falling due while the slow one is fetched is updated right away
+        self.assertLess(updated["http://example.com/fast"] - started, 0.3)
+        self.assertNotIn("http://example.com/slow", updated)
+
+    async def test_heartbeat_renews_lease(self):
+        lease = mock.Mock(interval=0.01)
+        lease.renew.return_value = (1, 2)
+        process = BatchProcess(database=FakeDatabase({}), update_interval=300, lease=lease)
+
+        # The lease is renewed on its own period, not between the updates of the feeds
+        task = asyncio.ensure_future(process._heartbeat())
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+        self.assertGreaterEqual(lease.renew.call_count, 3)
+        self.assertEqual(process.shard, (1, 2))
+
+    async def test_sync_schedule_skips_feeds_being_updated(self):
+        db = FakeDatabase({})
+        db.iter_urls = mock.Mock(return_value=[("http://example.com/a",), ("http://example.com/b",)])
+        cache = FeedCache()
+        cache.put("http://example.com/a", FeedParserDict(entries=[]))
+        process = BatchProcess(database=db, update_interval=300, cache=cache)
+        started = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def update_feed(url, users, trace=None):
+            started.set()
+            await finish.wait()
+
+        process.update_feed = update_feed
+        with contextlib.redirect_stdout(io.StringIO()):
+            task = asyncio.ensure_future(process.parse_parallel(queue=[("http://example.com/a",),
+                                                                       ("http://example.com/b",)]))
+            await started.wait()
+
+            # A feed handed to a worker is not scheduled again, one removed meanwhile is not rescheduled
+            await process.sync_schedule()
+            self.assertEqual(process.scheduler.pop_due(), [])
+            db.iter_urls.return_value = [("http://example.com/a",)]
+            await process.sync_schedule()
+
+            finish.set()
+            await task
+
+        self.assertEqual(process.scheduler.urls(), {"http://example.com/a"})
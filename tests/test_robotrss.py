@@ -0,0 +1,95 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from util.asynchandler import AsyncHandler
+from util.feedhandler import FeedEntry
+
+from robotrss import RobotRss
+
+
+class FakeQueue(object):
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((time.monotonic(), chat_id, text))
+
+    async def stop(self):
+        pass
+
+
+class SlowFeedHandler(object):
+
+    @staticmethod
+    def parse_feed(url, entries=0, cache=None):
+        # Blocks like a download of a slow feed
+        time.sleep(0.5)
+        return [FeedEntry("1", "http://example.com/1", "First")]
+
+
+class FakeDatabase(object):
+
+    def get_user_bookmark(self, telegram_id, alias):
+        return ("http://example.com/feed", alias, None)
+
+    def get_urls_for_user(self, telegram_id):
+        return [("http://example.com/feed", "feed", None)]
+
+
+def command(chat_id, *args):
+    update = SimpleNamespace(message=SimpleNamespace(from_user=SimpleNamespace(id=chat_id, first_name="John")),
+                             effective_chat=SimpleNamespace(id=chat_id))
+    return update, SimpleNamespace(args=list(args))
+
+
+class TestRobotRss(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # Only the parts of the bot used by the command handlers
+        self.bot = RobotRss.__new__(RobotRss)
+        self.bot.queue = FakeQueue()
+        self.bot.database = AsyncHandler(FakeDatabase(), name="database")
+        self.bot.feeds = AsyncHandler(SlowFeedHandler, name="feeds")
+        self.bot.feed_cache = None
+
+    def tearDown(self):
+        self.bot.database.shutdown()
+        self.bot.feeds.shutdown()
+
+    async def test_slow_get_does_not_delay_list(self):
+        started = time.monotonic()
+        get = asyncio.ensure_future(self.bot.get(*command(1, "feed")))
+        await asyncio.sleep(0.05)
+        await self.bot.list(*command(2))
+        listed = time.monotonic()
+        await get
+
+        # /list answered while /get was still downloading
+        self.assertLess(listed - started, 0.3)
+        replies = {chat_id: sent for sent, chat_id, text in self.bot.queue.sent}
+        self.assertLess(replies[2], replies[1])
+
+    async def test_post_stop_waits_for_tasks(self):
+        cleaned_up = []
+
+        async def run():
+            try:
+                await asyncio.sleep(60)
+            finally:
+                await asyncio.sleep(0.01)
+                cleaned_up.append(True)
+
+        self.bot.processing = None
+        self.bot.outbox = mock.Mock()
+        self.bot.processing_task = asyncio.ensure_future(run())
+        self.bot.outbox_task = None
+        await asyncio.sleep(0)
+
+        with mock.patch("robotrss.FeedHandler.fetcher"):
+            await self.bot.post_stop(application=None)
+
+        self.assertEqual(cleaned_up, [True])
@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from feedparser import FeedParserDict
+
+from util.feedhandler import FeedEntry
+from util.scheduler import FeedScheduler
+
+
+def feed_with_timestamps(timestamps, **channel):
+    entries = [FeedEntry(str(timestamp), "", "", timestamp) for timestamp in timestamps]
+    return FeedParserDict(entries=entries, feed=FeedParserDict(channel))
+
+
+class TestFeedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = FeedScheduler(default_interval=300, min_interval=60, max_interval=86400, jitter=0)
+
+    def test_pop_due_in_order(self):
+        self.scheduler.schedule("http://example.com/b", 20, now=0)
+        self.scheduler.schedule("http://example.com/a", 10, now=0)
+        self.scheduler.schedule("http://example.com/c", 30, now=0)
+
+        self.assertEqual(self.scheduler.pop_due(now=5), [])
+        self.assertEqual(self.scheduler.pop_due(now=25), ["http://example.com/a", "http://example.com/b"])
+        self.assertEqual(self.scheduler.next_due(now=25), 5)
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_reschedule_replaces_earlier_schedule(self):
+        self.scheduler.schedule("http://example.com/a", 10, now=0)
+        self.scheduler.schedule("http://example.com/a", 50, now=0)
+
+        self.assertEqual(self.scheduler.pop_due(now=20), [])
+        self.assertEqual(self.scheduler.pop_due(now=60), ["http://example.com/a"])
+
+    def test_remove(self):
+        self.scheduler.schedule("http://example.com/a", 10, now=0)
+        self.scheduler.remove("http://example.com/a")
+
+        self.assertEqual(self.scheduler.pop_due(now=20), [])
+        self.assertIsNone(self.scheduler.next_due(now=20))
+
+    def test_estimate_interval_from_publish_rate(self):
+        now = 1700000000
+        feed = feed_with_timestamps([now - 600, now - 1200, now - 1800, now - 2400])
+
+        # Four posts in the last 40 minutes, polled twice per expected post
+        self.assertEqual(self.scheduler.estimate_interval(feed, now=now), 300)
+
+    def test_estimate_interval_respects_hints(self):
+        now = 1700000000
+        feed = feed_with_timestamps([now - 60, now - 120], ttl="60")
+        self.assertEqual(self.scheduler.estimate_interval(feed, now=now), 3600)
+
+        feed = feed_with_timestamps([], sy_updateperiod="daily", sy_updatefrequency="4")
+        self.assertEqual(self.scheduler.estimate_interval(feed, now=now), 21600)
+
+        feed = feed_with_timestamps([])
+        self.assertIsNone(self.scheduler.estimate_interval(feed, now=now))
+
+    def test_reschedule_is_bounded(self):
+        now = time.time()
+        busy = feed_with_timestamps([now - 1, now - 2, now - 3])
+        dormant = feed_with_timestamps([now - 365 * 86400])
+
+        for _ in range(20):
+            self.scheduler.reschedule("http://example.com/busy", feed=busy, started=0)
+            self.scheduler.reschedule("http://example.com/dormant", feed=dormant, started=0)
+
+        self.assertEqual(self.scheduler.intervals["http://example.com/busy"], 60)
+        self.assertEqual(self.scheduler.intervals["http://example.com/dormant"], 86400)
+
+    def test_reschedule_backs_off_failures(self):
+        self.scheduler.reschedule("http://example.com/a", failures=2, started=0)
+        self.assertEqual(self.scheduler.next_due(now=0), 1200)
+
+        self.scheduler.reschedule("http://example.com/a", failures=20, started=0)
+        self.assertEqual(self.scheduler.next_due(now=0), 86400)
+        self.assertEqual(self.scheduler.intervals["http://example.com/a"], 300)
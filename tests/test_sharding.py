@@ -0,0 +1,41 @@
+import os
+import unittest
+
+from util.database import DatabaseHandler
+from util.sharding import ShardLease, shard_of
+
+
+class TestShardLease(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseHandler("resources/test.db")
+
+    def test_shards_rebalance(self):
+        first = ShardLease(self.db, "worker-a", timeout=60)
+        second = ShardLease(self.db, "worker-b", timeout=60)
+
+        self.assertEqual(first.renew(now=0), (0, 1))
+        self.assertEqual(second.renew(now=10), (1, 2))
+        self.assertEqual(first.renew(now=20), (0, 2))
+
+        # worker-b stopped renewing its lease, worker-a takes over all feeds
+        self.assertEqual(first.renew(now=100), (0, 1))
+
+        second.renew(now=110)
+        second.release()
+        self.assertEqual(first.renew(now=120), (0, 1))
+
+    def test_shard_of(self):
+        urls = ["http://example.com/%d" % i for i in range(1000)]
+        shards = [shard_of(url, 4) for url in urls]
+
+        self.assertEqual(shards, [shard_of(url, 4) for url in urls])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        # Fixed by the crc32 of the url, other processes and restarts agree on it
+        self.assertEqual(shard_of("http://example.com/feed", 4), 1)
+
+    def tearDown(self):
+        self.db.close()
+        base_path = os.path.abspath(os.path.dirname(__file__))
+        filepath = os.path.join(base_path, '..', "resources/test.db")
+        os.remove(filepath)
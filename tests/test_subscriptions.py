@@ -0,0 +1,151 @@
+import os
+import unittest
+
+from util.database import DatabaseHandler
+from util.subscriptions import SubscriptionIndex
+
+
+class TestSubscriptionIndex(unittest.TestCase):
+
+    def test_add_and_remove(self):
+        index = SubscriptionIndex()
+        for chat_id in (1, 2):
+            index.update_user(chat_id, is_active=True)
+        index.add("http://example.com/feed", 1, "news")
+        index.add("http://example.com/feed", 2, "news")
+        index.add("http://example.com/feed", 1, "other")
+        index.add("http://example.com/other", 1, "other")
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed", "http://example.com/none"]),
+                         {"http://example.com/feed": [(1, "news", False), (2, "news", False)],
+                          "http://example.com/none": []})
+
+        index.remove("http://example.com/feed", 1)
+        index.remove("http://example.com/feed", 3)
+        index.remove("http://example.com/other", 1)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed"]),
+                         {"http://example.com/feed": [(2, "news", False)]})
+
+    def test_flags(self):
+        index = SubscriptionIndex()
+        for chat_id in (1, 2):
+            index.update_user(chat_id, is_active=True)
+        index.add("http://example.com/feed", 1, "news")
+        index.add("http://example.com/feed", 2, "news")
+
+        index.update_user(1, is_active=False)
+        index.update_user(2, digest=True)
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed"]),
+                         {"http://example.com/feed": [(2, "news", True)]})
+
+        index.update_user(1, is_active=True)
+        index.update_user(2, digest=False)
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed"]),
+                         {"http://example.com/feed": [(1, "news", False), (2, "news", False)]})
+
+    def test_rename(self):
+        index = SubscriptionIndex()
+        index.update_user(1, is_active=True)
+        index.add("http://example.com/feed", 1, "news")
+        index.rename("http://example.com/feed", 1, "renamed")
+
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed"]),
+                         {"http://example.com/feed": [(1, "renamed", False)]})
+
+    def test_single_subscriber(self):
+        index = SubscriptionIndex()
+        group = -1001234567890
+        for chat_id in (group, 2):
+            index.update_user(chat_id, is_active=True)
+
+        # The pair of a feed with one subscriber is packed, group chats have negative ids
+        index.add("http://example.com/feed", group, "news")
+        index.rename("http://example.com/feed", group, "renamed")
+        index.add("http://example.com/feed", 2, "news")
+        index.remove("http://example.com/feed", 2)
+        index.rename("http://example.com/feed", 2, "ignored")
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get_active_users_for_urls(["http://example.com/feed"]),
+                         {"http://example.com/feed": [(group, "renamed", False)]})
+
+        index.remove("http://example.com/feed", 2)
+        index.remove("http://example.com/feed", group)
+        self.assertEqual(len(index), 0)
+
+
+class TestSubscriptionIndexDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DatabaseHandler("resources/test.db")
+        for telegram_id in (1, 2, 3):
+            self.db.add_user(telegram_id=telegram_id, username="TestDummy", firstname="John", lastname="Snow",
+                             language_code="DE", is_bot=False, is_active=True)
+        self.db.add_user_bookmark(telegram_id=1, url="http://example.com/feed", alias="news")
+        self.db.add_user_bookmark(telegram_id=2, url="http://example.com/feed", alias="feed")
+        self.db.update_user(telegram_id=2, digest=True)
+
+    def tearDown(self):
+        self.db.close()
+        base_path = os.path.abspath(os.path.dirname(__file__))
+        os.remove(os.path.join(base_path, '..', "resources/test.db"))
+        # Left behind when sqlite can't checkpoint on close
+        for suffix in ("-wal", "-shm"):
+            path = os.path.join(base_path, '..', "resources/test.db" + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def assertMatchesDatabase(self, index, urls):
+        self.assertEqual({url: sorted(users) for url, users in index.get_active_users_for_urls(urls).items()},
+                         {url: sorted(users) for url, users in self.db.get_active_users_for_urls(urls).items()})
+
+    def test_load(self):
+        index = SubscriptionIndex.load(self.db)
+
+        self.assertEqual(len(index), 2)
+        self.assertMatchesDatabase(index, ["http://example.com/feed"])
+
+    def test_follows_database(self):
+        urls = ["http://example.com/feed", "http://example.com/other"]
+        self.db.subscriptions = index = SubscriptionIndex.load(self.db)
+
+        self.db.add_user_bookmark(telegram_id=3, url="http://example.com/other", alias="other")
+        self.db.add_user_bookmark(telegram_id=1, url="http://example.com/feed", alias="ignored")
+        self.assertMatchesDatabase(index, urls)
+
+        self.db.update_user(telegram_id=1, is_active=0)
+        self.db.update_user(telegram_id=2, digest=False, firstname="Jon")
+        self.assertMatchesDatabase(index, urls)
+
+        self.db.update_user_bookmark(telegram_id=2, url="http://example.com/feed", alias="renamed")
+        self.db.remove_user_bookmark(telegram_id=3, url="http://example.com/other")
+        self.db.remove_user(telegram_id=2)
+        self.assertMatchesDatabase(index, urls)
+
+        self.db.update_user(telegram_id=1, is_active=1)
+        self.assertMatchesDatabase(index, urls)
+        self.assertMatchesDatabase(SubscriptionIndex.load(self.db), urls)
+
+    def test_subscription_without_user(self):
+        urls = ["http://example.com/other"]
+        self.db.subscriptions = index = SubscriptionIndex.load(self.db)
+
+        # /add before /start leaves a subscription without a user row, the database doesn't serve it
+        self.db.add_user_bookmark(telegram_id=4, url="http://example.com/other", alias="other")
+        self.db.update_user(telegram_id=4, is_active=1)
+        self.assertEqual(index.get_active_users_for_urls(urls), {"http://example.com/other": []})
+        self.assertMatchesDatabase(index, urls)
+
+        self.db.add_user(telegram_id=4, username="TestDummy", firstname="John", lastname="Snow",
+                         language_code="DE", is_bot=False, is_active=True)
+        self.assertEqual(index.get_active_users_for_urls(urls), {"http://example.com/other": [(4, "other", False)]})
+        self.assertMatchesDatabase(index, urls)
+
+    def test_remove_url(self):
+        urls = ["http://example.com/feed"]
+        self.db.subscriptions = index = SubscriptionIndex.load(self.db)
+
+        self.db.remove_url(url="http://example.com/feed")
+        self.assertEqual(len(index), 0)
+        self.assertMatchesDatabase(index, urls)
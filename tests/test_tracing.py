@@ -0,0 +1,87 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import httpx
+
+from util.feedhandler import FeedHandler
+from util.fetcher import Fetcher
+from util.tracing import FeedTrace, Profiler, Tracer
+
+SAMPLE_RSS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Sample</title>
+<item><title>First</title><link>http://example.com/1</link><guid>1</guid></item>
+</channel></rss>"""
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_span(self):
+        trace = FeedTrace("http://example.com/feed")
+        with trace.span("parse"):
+            pass
+        trace.add("parse", 1.0)
+        trace.finish()
+
+        self.assertGreaterEqual(trace.timings["parse"], 1.0)
+        self.assertGreater(trace.total, 0)
+
+    def test_http_events(self):
+        trace = FeedTrace("http://example.com/feed")
+        for name in ("connection.connect_tcp.started", "connection.connect_tcp.complete",
+                     "http11.send_request_headers.started", "http11.send_request_headers.complete",
+                     "http11.receive_response_headers.started", "http11.receive_response_headers.complete"):
+            asyncio.run(trace.on_http_event(name, {}))
+
+        self.assertIn("connect", trace.timings)
+        self.assertIn("ttfb", trace.timings)
+
+    def test_finish_cycle(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "trace.jsonl")
+        tracer = Tracer(path=path, top=1)
+
+        tracer.start_cycle()
+        fast = tracer.trace("http://example.com/fast")
+        slow = tracer.trace("http://example.com/slow")
+        fast.total, slow.total = 0.1, 2.0
+        slow.add("ttfb", 1.5)
+        summary = tracer.finish_cycle()
+
+        self.assertIn("http://example.com/slow", summary)
+        self.assertNotIn("http://example.com/fast", summary)
+        with open(path) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record["url"] for record in records], ["http://example.com/fast", "http://example.com/slow"])
+        self.assertEqual(records[1]["ttfb"], 1.5)
+        self.assertEqual(records[1]["cycle"], 1)
+
+    def test_profiler(self):
+        profiler = Profiler(directory=tempfile.mkdtemp())
+        profiler.start()
+        self.assertIsNone(profiler.stop())
+
+        profiler.request()
+        profiler.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            path = profiler.stop()
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(profiler.requested)
+
+
+class TestTracedFetch(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fetch_records_download(self):
+        trace = FeedTrace("http://example.com/feed")
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=SAMPLE_RSS))
+
+        async with Fetcher(transport=transport) as client:
+            feed = await FeedHandler.fetch_feed_async(client, "http://example.com/feed", trace=trace)
+
+        self.assertEqual(len(feed.entries), 1)
+        self.assertIn("download", trace.timings)
+        self.assertIn("parse", trace.timings)
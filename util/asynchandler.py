@@ -0,0 +1,34 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncHandler(object):
+
+    def __init__(self, handler, max_workers=4, name="handler"):
+        """Async facade over a handler with blocking methods. Every method call returns a coroutine that runs
+        the method in a thread pool of its own, so the event loop keeps serving other updates meanwhile and a
+        handler doing slow network I/O can't starve one doing quick database queries
+
+        Args:
+            handler (object): The handler whose methods are called, e.g. a DatabaseHandler or FeedHandler.
+            max_workers (int): The number of calls running at the same time.
+            name (str): The name prefix of the threads of the pool.
+        """
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def __getattr__(self, name):
+        method = getattr(self.handler, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+        return call
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -1,8 +1,8 @@
-import sqlite3
 from datetime import datetime
 
 from telegram import Chat
 
+from util import metrics
 from util.datehandler import DateHandler
 
 from peewee import (
@@ -10,13 +10,29 @@ from peewee import (
     SqliteDatabase,
     CharField,
     AutoField,
+    BigIntegerField,
     BooleanField,
     DateTimeField,
+    FloatField,
+    IntegerField,
+    TextField,
     ForeignKeyField, CompositeKey, IntegrityError
 )
+from playhouse.migrate import SqliteMigrator, migrate
 
 db = SqliteDatabase(None)
 
+# next_attempt of outbox messages in flight, they are never due until released
+HELD = float("inf")
+
+# Applied to every connection: WAL lets the poller and command handlers read while another thread writes
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16000,  # 16 MB
+    'temp_store': 'memory',
+}
+
 
 class BaseModel(Model):
     class Meta:
@@ -31,19 +47,35 @@ class User(BaseModel):
     language: str = CharField()
     is_bot: bool = BooleanField()
     is_active: bool = BooleanField()
+    digest: bool = BooleanField(default=False)
 
     class Meta:
         table_name = 'user'
 
 
 class Feed(BaseModel):
+    # The url the feed is fetched from, as it was served after redirects
     url: str = CharField(primary_key=True)
+    # Canonical form of the url, feeds whose urls share it are the same feed
+    key: str = CharField(null=True, index=True)
     last_updated: datetime = DateTimeField()
+    etag: str = CharField(null=True)
+    modified: str = CharField(null=True)
+    failures: int = IntegerField(default=0)
 
     class Meta:
         table_name = 'web'
 
 
+class Host(BaseModel):
+    host: str = CharField(primary_key=True)
+    failures: int = IntegerField(default=0)
+    retry_at: float = FloatField(null=True)
+
+    class Meta:
+        table_name = 'host'
+
+
 class WebUser(BaseModel):
     url = ForeignKeyField(Feed, column_name='url', backref='web_user', on_delete='CASCADE')
     telegram_id = ForeignKeyField(User, column_name='telegram_id', backref='web_user', on_delete='CASCADE')
@@ -54,6 +86,38 @@ class WebUser(BaseModel):
         primary_key = CompositeKey('url', 'telegram_id')
 
 
+class SeenEntry(BaseModel):
+    url = ForeignKeyField(Feed, column_name='url', backref='seen_entry', on_delete='CASCADE')
+    entry_id: int = BigIntegerField()
+    seen_at: datetime = DateTimeField()
+
+    class Meta:
+        table_name = 'seen_entry'
+        primary_key = CompositeKey('url', 'entry_id')
+
+
+class Outbox(BaseModel):
+    id: int = AutoField()
+    chat_id: int = BigIntegerField(index=True)
+    text: str = TextField()
+    digest: bool = BooleanField(default=False)
+    attempts: int = IntegerField(default=0)
+    created: datetime = DateTimeField()
+    # Seconds since the epoch before which the message is not sent after a failure, HELD while it is in flight
+    next_attempt: float = FloatField(default=0)
+
+    class Meta:
+        table_name = 'outbox'
+
+
+class Worker(BaseModel):
+    worker_id: str = CharField(primary_key=True)
+    heartbeat: float = FloatField()
+
+    class Meta:
+        table_name = 'worker'
+
+
 class Channel(BaseModel):
     chat_id: int = AutoField(primary_key=True)
     title: str = CharField()
@@ -73,14 +137,39 @@ class WebChat(BaseModel):
         primary_key = CompositeKey('url', 'chat_id')
 
 
+@metrics.timed_methods(metrics.DB_SECONDS)
 class DatabaseHandler(object):
 
     def __init__(self, database_path):
 
         self.database_path = database_path
         self.db = db
-        self.db.init(database_path)
-        self.db.create_tables([User, Feed, WebUser, Channel, WebChat])
+        # peewee keeps one long-lived connection per thread, sqlite3 caches the prepared statements of each
+        self.db.init(database_path, pragmas=PRAGMAS, timeout=10, cached_statements=256)
+        self.db.create_tables([User, Feed, Host, WebUser, SeenEntry, Outbox, Worker, Channel, WebChat])
+        self._migrate()
+        # SubscriptionIndex kept up to date with the subscriptions and users written through this handler
+        self.subscriptions = None
+
+    def close(self):
+        """Closes the connection of the calling thread"""
+        if not self.db.is_closed():
+            self.db.close()
+
+    def _migrate(self):
+        """Adds columns introduced after a table was first created to existing databases"""
+        migrator = SqliteMigrator(self.db)
+        operations = []
+
+        for model in [User, Feed, Host, WebUser, SeenEntry, Outbox, Worker, Channel, WebChat]:
+            table = model._meta.table_name
+            columns = [column.name for column in self.db.get_columns(table)]
+            for field in model._meta.sorted_fields:
+                if field.column_name not in columns:
+                    operations.append(migrator.add_column(table, field.column_name, field))
+
+        if operations:
+            migrate(*operations)
 
     def add_user(self, telegram_id, username, firstname, lastname, language_code, is_bot, is_active):
         """Adds a user to sqlite database
@@ -103,7 +192,8 @@ class DatabaseHandler(object):
             is_bot=is_bot,
             is_active=is_active
         )
-        self.db.close()
+        if self.subscriptions is not None:
+            self.subscriptions.update_user(telegram_id, is_active=bool(is_active), digest=False)
 
     def remove_user(self, telegram_id):
         """Removes a user from the sqlite database
@@ -113,7 +203,9 @@ class DatabaseHandler(object):
         """
         q = User.delete().where(User.telegram_id == telegram_id)
         q.execute()
-        self.db.close()
+        if self.subscriptions is not None:
+            # Subscriptions of users that don't exist are never served, like inactive ones
+            self.subscriptions.update_user(telegram_id, is_active=False)
 
     def update_user(self, telegram_id, **kwargs):
         """Updates a user to sqlite database
@@ -123,8 +215,10 @@ class DatabaseHandler(object):
             (kwargs): The attributes to be updated of a user.
         """
         _q = User.update(kwargs).where(User.telegram_id == telegram_id)
-        _q.execute()
-        self.db.close()
+        # A chat without a user row stays unknown to the index, the database doesn't serve it either
+        if _q.execute() and self.subscriptions is not None:
+            self.subscriptions.update_user(telegram_id, is_active=_flag(kwargs.get("is_active")),
+                                           digest=_flag(kwargs.get("digest")))
 
     def get_user(self, telegram_id) -> User:
         """Returns a user by its id
@@ -140,127 +234,441 @@ class DatabaseHandler(object):
         except User.DoesNotExist:
             pass
 
-    def add_url(self, url):
+    def add_url(self, url, key=None):
         try:
             _feed = Feed.create(
                 url=url,
+                key=key,
                 last_updated=DateHandler.get_datetime_now()
             )
         except IntegrityError:
             pass
-        self.db.close()
 
     def remove_url(self, url):
         _q = Feed.select().where(Feed.url == url).get()
         _q.delete_instance(recursive=True)
-        self.db.close()
+        if self.subscriptions is not None:
+            self.subscriptions.remove_url(url)
 
     def update_url(self, url, **kwargs):
         _q = Feed.update(kwargs).where(Feed.url == url)
         _q.execute()
-        db.close()
+
+    def canonicalize_urls(self, canonicalize):
+        """Stores the canonical form of every feed url as its key and merges feeds whose keys collide, so nobody
+        gets news twice. The urls are kept as they are, they are what the feeds are fetched from. Of the feeds
+        merged, the one that failed least keeps its url, subscriptions and seen entries move to it
+
+        Args:
+            canonicalize (callable): Returns the canonical form of an url.
+
+        Returns:
+            int: The number of feeds that were merged into another one.
+        """
+        merged = 0
+        feeds = {}
+        rows = self.db.execute_sql("SELECT url, key FROM web ORDER BY failures, url").fetchall()
+
+        for url, key in rows:
+            canonical = canonicalize(url)
+            target = feeds.get(canonical)
+            if target is None:
+                feeds[canonical] = url
+                if key != canonical:
+                    self.db.execute_sql("UPDATE web SET key = ? WHERE url = ?", (canonical, url))
+                continue
+
+            with self.db.atomic():
+                self.db.execute_sql("INSERT OR IGNORE INTO web_user (url, telegram_id, alias) "
+                                    "SELECT ?, telegram_id, alias FROM web_user WHERE url = ?", (target, url))
+                self.db.execute_sql("INSERT OR IGNORE INTO web_chat (url, chat_id, alias) "
+                                    "SELECT ?, chat_id, alias FROM web_chat WHERE url = ?", (target, url))
+                self.db.execute_sql("INSERT OR IGNORE INTO seen_entry (url, entry_id, seen_at) "
+                                    "SELECT ?, entry_id, seen_at FROM seen_entry WHERE url = ?", (target, url))
+                for table in ("web_user", "web_chat", "seen_entry", "web"):
+                    self.db.execute_sql("DELETE FROM " + table + " WHERE url = ?", (url,))
+            merged += 1
+        return merged
+
+    def get_url_by_key(self, key):
+        """Returns the url of the feed with the given canonical key, None if there is none
+
+        Args:
+            key (str): The canonical form of the url.
+        """
+        row = self.db.execute_sql("SELECT url FROM web WHERE key = ? LIMIT 1", (key,)).fetchone()
+        return row[0] if row else None
 
     def get_url(self, url) -> Feed:
         try:
-            return Feed.select().where(url == url).get()
+            return Feed.select().where(Feed.url == url).get()
         except Feed.DoesNotExist:
             pass
 
     def get_all_urls(self):
-        try:
-            return Feed.select().get()
-        except Feed.DoesNotExist:
-            pass
+        """Returns all feeds as a list of (url, last_updated, etag, modified, failures) tuples"""
+        return list(Feed.select(Feed.url, Feed.last_updated, Feed.etag, Feed.modified, Feed.failures).tuples())
 
-    def add_user_bookmark(self, telegram_id, url, alias):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def iter_urls(self, batch_size=1000):
+        """Yields all feeds as (url, last_updated, etag, modified, failures) tuples, reading the table page by page
 
-        self.add_url(url)  # add if not exists
-        cursor.execute("INSERT OR IGNORE INTO web_user VALUES (?,?,?)",
-                       (url, telegram_id, alias))
+        Args:
+            batch_size (int): The number of feeds read per query.
+        """
+        last_url = ""
 
-        conn.commit()
-        conn.close()
+        while True:
+            # Keyset pagination on the primary key, so feeds added behind the current page are still seen
+            cursor = self.db.execute_sql(
+                "SELECT url, last_updated, etag, modified, failures FROM web WHERE url > ? ORDER BY url LIMIT ?",
+                (last_url, batch_size))
+            rows = cursor.fetchall()
 
-    def remove_user_bookmark(self, telegram_id, url):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_url = rows[-1][0]
 
-        cursor.execute(
-            "DELETE FROM web_user WHERE telegram_id=(?) AND url = (?)", (telegram_id, url))
-        cursor.execute(
-            "DELETE FROM web WHERE web.url NOT IN (SELECT web_user.url from web_user)")
+    def iter_feeds(self, urls):
+        """Yields the given feeds as (url, last_updated, etag, modified, failures) tuples
 
-        conn.commit()
-        conn.close()
+        Args:
+            urls (list): The urls of the feeds.
+        """
+        urls = list(urls)
 
-    def update_user_bookmark(self, telegram_id, url, alias):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        # Stay below the maximum number of host parameters of sqlite
+        for i in range(0, len(urls), 500):
+            yield from Feed.select(Feed.url, Feed.last_updated, Feed.etag, Feed.modified, Feed.failures) \
+                .where(Feed.url.in_(urls[i:i + 500])).tuples()
 
-        cursor.execute("UPDATE web_user SET alias=(?) WHERE telegram_id=(?) AND url=(?)",
-                       (alias, telegram_id, url))
+    def get_feeds(self, urls):
+        """Returns the given feeds as a list of (url, last_updated, etag, modified, failures) tuples
 
-        conn.commit()
-        conn.close()
+        Args:
+            urls (list): The urls of the feeds.
+        """
+        return list(self.iter_feeds(urls))
 
-    def get_user_bookmark(self, telegram_id, alias):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def add_failure(self, url, host):
+        """Counts a failed fetch of a feed and of its host
 
-        cursor.execute(
-            "SELECT web.url, web_user.alias, web.last_updated FROM web, web_user WHERE web_user.url = web.url AND "
-            "web_user.telegram_id =" +
-            str(telegram_id) + " AND web_user.alias ='" + str(alias) + "';")
+        Args:
+            url (str): The url of the feed.
+            host (str): The host the feed is served from.
 
-        result = cursor.fetchone()
+        Returns:
+            tuple: The number of consecutive failures of the feed and of the host.
+        """
+        with self.db.atomic():
+            self.db.execute_sql("UPDATE web SET failures = failures + 1 WHERE url = ?", (url,))
+            self.db.execute_sql("INSERT INTO host (host, failures) VALUES (?, 1) "
+                                "ON CONFLICT (host) DO UPDATE SET failures = failures + 1", (host,))
+            feed_failures = self.db.execute_sql("SELECT failures FROM web WHERE url = ?", (url,)).fetchone()
+            host_failures = self.db.execute_sql("SELECT failures FROM host WHERE host = ?", (host,)).fetchone()
+        return (feed_failures[0] if feed_failures else 0), host_failures[0]
 
-        conn.commit()
-        conn.close()
+    def reset_failures(self, url, host):
+        """Forgets the failures of a feed and its host after a successful fetch
 
-        return result
+        Args:
+            url (str): The url of the feed.
+            host (str): The host the feed is served from.
+        """
+        with self.db.atomic():
+            self.db.execute_sql("UPDATE web SET failures = 0 WHERE url = ? AND failures != 0", (url,))
+            self.db.execute_sql("DELETE FROM host WHERE host = ?", (host,))
 
-    def get_urls_for_user(self, telegram_id):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def open_host(self, host, retry_at):
+        """Stops fetching the feeds of a host until retry_at
+
+        Args:
+            host (str): The host the feeds are served from.
+            retry_at (float): The time to try the host again as seconds since the epoch.
+        """
+        self.db.execute_sql("UPDATE host SET retry_at = ? WHERE host = ?", (retry_at, host))
+
+    def get_failing_hosts(self):
+        """Returns the hosts that failed since their last successful fetch
+
+        Returns:
+            dict: Maps every failing host to the time it is tried again, None if it wasn't shut off.
+        """
+        cursor = self.db.execute_sql("SELECT host, retry_at FROM host")
+        return dict(cursor.fetchall())
+
+    def get_seen_entries(self, url):
+        """Returns the ids of all entries of a feed that were already seen
+
+        Args:
+            url (str): The url of the feed.
+
+        Returns:
+            set: The ids of the seen entries.
+        """
+        cursor = self.db.execute_sql("SELECT entry_id FROM seen_entry WHERE url = ?", (url,))
+        return set(row[0] for row in cursor.fetchall())
+
+    def add_seen_entries(self, url, entry_ids, retention=200, news=None):
+        """Marks entries of a feed as seen, keeping only the most recently seen ones, and queues the messages
+        about the new entries in the outbox. Both happen in one write transaction, which also checks which
+        entries are still new, so two workers polling the same feed at the same time don't both queue them
+
+        Args:
+            url (str): The url of the feed.
+            entry_ids (list): The ids of the entries currently in the feed.
+            retention (int): The maximum number of ids kept per feed.
+            news (dict): Maps the ids of entries that were new when the feed was read to the (chat_id, text,
+                digest) tuples of their messages.
+
+        Returns:
+            list: The ids of the entries whose messages were queued.
+        """
+        seen_at = DateHandler.get_datetime_now()
+        queued = []
+
+        # Take the write lock before reading, a deferred transaction would let another writer in between
+        with self.db.atomic("IMMEDIATE"):
+            if news:
+                seen = self.get_seen_entries(url)
+                queued = [entry_id for entry_id in news if entry_id not in seen]
+                self.add_outbox([message for entry_id in queued for message in news[entry_id]])
+            # Refresh entries that are still in the feed, so they outlive the ones that dropped out of it
+            if entry_ids:
+                SeenEntry.insert_many([(url, entry_id, seen_at) for entry_id in entry_ids],
+                                      fields=[SeenEntry.url, SeenEntry.entry_id, SeenEntry.seen_at]) \
+                    .on_conflict_replace().execute()
+            self.db.execute_sql(
+                "DELETE FROM seen_entry WHERE url = ? AND rowid NOT IN "
+                "(SELECT rowid FROM seen_entry WHERE url = ? ORDER BY seen_at DESC, rowid DESC LIMIT ?)",
+                (url, url, retention))
+        return queued
+
+    def add_outbox(self, messages):
+        """Queues messages for delivery
+
+        Args:
+            messages (list): The (chat_id, text, digest) tuples of the messages to send.
+        """
+        created = DateHandler.get_datetime_now()
+
+        if messages:
+            Outbox.insert_many([(chat_id, text, digest, created) for chat_id, text, digest in messages],
+                               fields=[Outbox.chat_id, Outbox.text, Outbox.digest, Outbox.created]).execute()
 
-        cursor.execute(
+    def get_outbox(self, limit=100, now=None):
+        """Returns the oldest messages waiting for delivery
+
+        Args:
+            limit (int): The maximum number of messages returned.
+            now (float): Only messages due at this time, in seconds since the epoch, are returned. None returns
+                all messages.
+
+        Returns:
+            list: The (id, chat_id, text, digest, attempts) tuples of the messages.
+        """
+        cursor = self.db.execute_sql(
+            "SELECT id, chat_id, text, digest, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+            (float("inf") if now is None else now, limit))
+        return [(row[0], row[1], row[2], bool(row[3]), row[4]) for row in cursor.fetchall()]
+
+    def get_digest_outbox(self, chat_ids, now=None):
+        """Returns all digest messages waiting for delivery to the given chats, so they are bundled together
+
+        Args:
+            chat_ids (list): The chat_ids of the chats.
+            now (float): Only messages due at this time, in seconds since the epoch, are returned. None returns
+                all messages.
+
+        Returns:
+            list: The (id, chat_id, text, digest, attempts) tuples of the messages, ordered by chat.
+        """
+        chat_ids = list(chat_ids)
+        rows = []
+
+        # Stay below the maximum number of host parameters of sqlite
+        for i in range(0, len(chat_ids), 500):
+            batch = chat_ids[i:i + 500]
+            cursor = self.db.execute_sql(
+                "SELECT id, chat_id, text, digest, attempts FROM outbox WHERE digest AND next_attempt <= ? AND "
+                "chat_id IN (" + ", ".join("?" * len(batch)) + ") ORDER BY chat_id, id",
+                [float("inf") if now is None else now] + batch)
+            rows.extend((row[0], row[1], row[2], bool(row[3]), row[4]) for row in cursor.fetchall())
+        return rows
+
+    def hold_outbox(self, ids):
+        """Holds messages back while they are in flight, until they are removed, retried or released
+
+        Args:
+            ids (list): The ids of the messages.
+        """
+        ids = list(ids)
+
+        with self.db.atomic():
+            for i in range(0, len(ids), 500):
+                Outbox.update(next_attempt=HELD).where(Outbox.id.in_(ids[i:i + 500])).execute()
+
+    def release_outbox(self):
+        """Makes all messages held back as in flight due again, e.g. after the process delivering them died"""
+        Outbox.update(next_attempt=0).where(Outbox.next_attempt == HELD).execute()
+
+    def remove_outbox(self, ids):
+        """Removes delivered messages from the outbox
+
+        Args:
+            ids (list): The ids of the messages.
+        """
+        ids = list(ids)
+
+        with self.db.atomic():
+            for i in range(0, len(ids), 500):
+                Outbox.delete().where(Outbox.id.in_(ids[i:i + 500])).execute()
+
+    def retry_outbox(self, ids, now, max_attempts=10, delay=60, max_delay=3600):
+        """Counts a failed delivery attempt of messages, dropping those that failed too often. The others are
+        tried again after a delay doubling with every attempt
+
+        Args:
+            ids (list): The ids of the messages.
+            now (float): The current time as seconds since the epoch.
+            max_attempts (int): The number of attempts after which a message is dropped.
+            delay (float): The seconds before the first retry.
+            max_delay (float): The maximum number of seconds between two attempts.
+        """
+        ids = list(ids)
+
+        with self.db.atomic():
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                self.db.execute_sql(
+                    "UPDATE outbox SET next_attempt = ? + MIN(? * (1 << MIN(attempts, 32)), ?), "
+                    "attempts = attempts + 1 WHERE id IN (" + ", ".join("?" * len(batch)) + ")",
+                    [now, delay, max_delay] + batch)
+            Outbox.delete().where(Outbox.attempts >= max_attempts).execute()
+
+    def renew_worker(self, worker_id, now, timeout):
+        """Renews the lease of a polling worker and drops the leases of workers that stopped renewing theirs
+
+        Args:
+            worker_id (str): The id of the worker.
+            now (float): The current time as seconds since the epoch.
+            timeout (float): The seconds after which a lease that was not renewed expires.
+
+        Returns:
+            list: The sorted ids of all live workers.
+        """
+        with self.db.atomic():
+            self.db.execute_sql("INSERT OR REPLACE INTO worker (worker_id, heartbeat) VALUES (?, ?)", (worker_id, now))
+            self.db.execute_sql("DELETE FROM worker WHERE heartbeat < ?", (now - timeout,))
+            cursor = self.db.execute_sql("SELECT worker_id FROM worker ORDER BY worker_id")
+            return [row[0] for row in cursor.fetchall()]
+
+    def remove_worker(self, worker_id):
+        """Gives up the lease of a polling worker, so the others take over its feeds at their next renewal
+
+        Args:
+            worker_id (str): The id of the worker.
+        """
+        self.db.execute_sql("DELETE FROM worker WHERE worker_id = ?", (worker_id,))
+
+    def add_user_bookmark(self, telegram_id, url, alias, key=None):
+        """Subscribes a user to a feed. A feed already stored under the same canonical key is reused, so every
+        feed is fetched once no matter how its url is spelled
+
+        Args:
+            telegram_id (int): The telegram_id of a user.
+            url (str): The url of the feed.
+            alias (str): The name the user gave the feed.
+            key (str): The canonical form of the url, None doesn't look for the same feed under other urls.
+
+        Returns:
+            str: The url the subscription was stored with.
+        """
+        with self.db.atomic():
+            url = (self.get_url_by_key(key) if key is not None else None) or url
+            self.add_url(url, key=key)  # add if not exists
+            self.db.execute_sql("INSERT OR IGNORE INTO web_user VALUES (?,?,?)",
+                                (url, telegram_id, alias))
+        if self.subscriptions is not None:
+            self.subscriptions.add(url=url, chat_id=telegram_id, alias=alias)
+        return url
+
+    def remove_user_bookmark(self, telegram_id, url):
+        with self.db.atomic():
+            self.db.execute_sql(
+                "DELETE FROM web_user WHERE telegram_id=(?) AND url = (?)", (telegram_id, url))
+            self.db.execute_sql(
+                "DELETE FROM web WHERE web.url NOT IN (SELECT web_user.url from web_user)")
+        if self.subscriptions is not None:
+            self.subscriptions.remove(url=url, chat_id=telegram_id)
+
+    def update_user_bookmark(self, telegram_id, url, alias):
+        self.db.execute_sql("UPDATE web_user SET alias=(?) WHERE telegram_id=(?) AND url=(?)",
+                            (alias, telegram_id, url))
+        if self.subscriptions is not None:
+            self.subscriptions.rename(url=url, chat_id=telegram_id, alias=alias)
+
+    def get_user_bookmark(self, telegram_id, alias):
+        cursor = self.db.execute_sql(
             "SELECT web.url, web_user.alias, web.last_updated FROM web, web_user WHERE web_user.url = web.url AND "
-            "web_user.telegram_id =" +
-            str(telegram_id) + ";")
+            "web_user.telegram_id = ? AND web_user.alias = ?", (telegram_id, alias))
 
-        result = cursor.fetchall()
+        return cursor.fetchone()
 
-        conn.commit()
-        conn.close()
+    def get_urls_for_user(self, telegram_id):
+        cursor = self.db.execute_sql(
+            "SELECT web.url, web_user.alias, web.last_updated FROM web, web_user WHERE web_user.url = web.url AND "
+            "web_user.telegram_id = ?", (telegram_id,))
 
-        return result
+        return cursor.fetchall()
 
     def get_users_for_url(self, url):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        cursor = self.db.execute_sql(
+            "SELECT user.telegram_id, user.username, user.firstname, user.lastname, user.language, user.is_bot, "
+            "user.is_active, web_user.alias FROM user, web_user WHERE web_user.telegram_id = user.telegram_id AND "
+            "web_user.url = ?", (url,))
 
-        cursor.execute(
-            "SELECT user.*, web_user.alias FROM user, web_user WHERE web_user.telegram_id = user.telegram_id AND "
-            "web_user.url ='" + str(
-                url) + "';")
-        result = cursor.fetchall()
+        return cursor.fetchall()
 
-        conn.commit()
-        conn.close()
+    def get_active_users_for_urls(self, urls):
+        """Returns the active subscribers of a batch of feeds
 
+        Args:
+            urls (list): The urls of the feeds.
+
+        Returns:
+            dict: The return value. Maps every url to a list of (telegram_id, alias, digest) tuples.
+        """
+        result = {url: [] for url in urls}
+        urls = list(result)
+
+        # Stay below the maximum number of host parameters of sqlite
+        for i in range(0, len(urls), 500):
+            batch = urls[i:i + 500]
+            cursor = self.db.execute_sql(
+                "SELECT web_user.url, web_user.telegram_id, web_user.alias, user.digest FROM web_user "
+                "JOIN user ON user.telegram_id = web_user.telegram_id "
+                "WHERE user.is_active AND web_user.url IN (" + ", ".join("?" * len(batch)) + ")", batch)
+            for url, telegram_id, alias, digest in cursor:
+                result[url].append((telegram_id, alias, bool(digest)))
         return result
 
-    def add_chat(self, chat_info: Chat):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def iter_subscriptions(self):
+        """Yields all subscriptions of existing users as (url, telegram_id, alias) tuples"""
+        cursor = self.db.execute_sql(
+            "SELECT web_user.url, web_user.telegram_id, web_user.alias FROM web_user "
+            "JOIN user ON user.telegram_id = web_user.telegram_id")
+        yield from cursor
 
-        cursor.execute("INSERT OR IGNORE INTO chat VALUES (?,?,?)",
-                       (chat_info.telegram_id, chat_info.title, chat_info.type))
+    def iter_user_flags(self):
+        """Yields all users as (telegram_id, is_active, digest) tuples"""
+        cursor = self.db.execute_sql("SELECT telegram_id, is_active, digest FROM user")
+        for telegram_id, is_active, digest in cursor:
+            yield telegram_id, bool(is_active), bool(digest)
 
-        conn.commit()
-        conn.close()
+    def add_chat(self, chat_info: Chat):
+        self.db.execute_sql("INSERT OR IGNORE INTO chat VALUES (?,?,?)",
+                            (chat_info.telegram_id, chat_info.title, chat_info.type))
 
     def remove_chat(self, chat_id):
         """Remove a chat from the sqlite database
@@ -269,14 +677,7 @@ class DatabaseHandler(object):
             chat_id (int): The chat_id of a private chat, channel or group.
         """
 
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM chat WHERE chat_id=" +
-                       str(chat_id))
-
-        conn.commit()
-        conn.close()
+        self.db.execute_sql("DELETE FROM chat WHERE chat_id = ?", (chat_id,))
 
     def update_chat(self, chat_id, **kwargs):
         """Updates a user to sqlite database
@@ -286,19 +687,8 @@ class DatabaseHandler(object):
             (kwargs): The attributes to be updated of a user.
         """
 
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-
-        sql_command = "UPDATE chat SET "
-        for key in kwargs:
-            sql_command = sql_command + \
-                          str(key) + "='" + str(kwargs[key]) + "', "
-        sql_command = sql_command[:-2] + " WHERE chat_id=" + str(chat_id)
-
-        cursor.execute(sql_command)
-
-        conn.commit()
-        conn.close()
+        sql_command = "UPDATE chat SET " + ", ".join(str(key) + " = ?" for key in kwargs) + " WHERE chat_id = ?"
+        self.db.execute_sql(sql_command, tuple(kwargs.values()) + (chat_id,))
 
     def get_chat(self, chat_id):
         """Returns a user by its id
@@ -309,28 +699,14 @@ class DatabaseHandler(object):
         Returns:
             list: The return value. A list containing all attributes of a user.
         """
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT * FROM chat WHERE chat_id = " + str(chat_id))
-        result = cursor.fetchone()
-
-        conn.commit()
-        conn.close()
-
-        return result
+        cursor = self.db.execute_sql("SELECT * FROM chat WHERE chat_id = ?", (chat_id,))
+        return cursor.fetchone()
 
     def get_all_chats(self):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-
-        sql_command = "SELECT * FROM chat;"
+        cursor = self.db.execute_sql("SELECT * FROM chat;")
+        return cursor.fetchall()
 
-        cursor.execute(sql_command)
-        result = cursor.fetchall()
 
-        conn.commit()
-        conn.close()
-
-        return result
+def _flag(value):
+    """Returns a flag written to the user table as bool, None if it was not written"""
+    return None if value is None else bool(value)
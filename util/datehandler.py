@@ -1,29 +1,63 @@
 import datetime
+import functools
+from email.utils import parsedate_to_datetime
 
 import pytz
 from dateutil import parser
 
+TIMEZONE = pytz.timezone("Europe/Berlin")
+
 
 class DateHandler:
 
     @staticmethod
     def get_datetime_now():
-        # Strip seconds from datetime
-        date_string = str(
-            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-        naive_date = datetime.datetime.utcnow().strptime(date_string, "%Y-%m-%d %H:%M:%S")
-
-        # Make datetime aware of timezone
-        aware_date = pytz.utc.localize(naive_date)
-        result = aware_date.astimezone(pytz.timezone("Europe/Berlin"))
-        return result
+        # Strip microseconds from datetime and make it aware of timezone
+        now = datetime.datetime.now(pytz.utc).replace(microsecond=0)
+        return now.astimezone(TIMEZONE)
 
     @staticmethod
     def parse_datetime(timestamp: datetime):
-        result = parser.parse(timestamp)
+        if isinstance(timestamp, datetime.datetime):
+            return _localize(timestamp)
+        return _parse_datetime_cached(timestamp)
 
-        if result.tzinfo is None:
-            aware_date = pytz.utc.localize(result)
-            result = aware_date.astimezone(pytz.timezone("Europe/Berlin"))
 
-        return result
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime_cached(timestamp):
+    result = _parse_fast(timestamp)
+    if result is None:
+        result = parser.parse(timestamp)
+    return _localize(result)
+
+
+def _parse_fast(timestamp):
+    """
+    Parses the ISO 8601 and RFC 822 dates used by almost all feeds, returns None for anything else
+    """
+
+    value = timestamp.strip()
+    if not value:
+        return None
+
+    if value[0].isdigit():
+        # ISO 8601, e.g. 2024-01-01T10:00:00Z or str() of a datetime
+        if value[-1] in "zZ":
+            value = value[:-1] + "+00:00"
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+
+    # RFC 822, e.g. Mon, 01 Jan 2024 10:00:00 GMT
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _localize(result):
+    if result.tzinfo is None:
+        aware_date = pytz.utc.localize(result)
+        result = aware_date.astimezone(TIMEZONE)
+    return result
@@ -0,0 +1,355 @@
+import asyncio
+import itertools
+import time
+import traceback
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from util import metrics
+from util.asynchandler import AsyncHandler
+
+# Replies to commands overtake the fan-out of feed updates
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# Maximum length of the text of a telegram message
+MAX_MESSAGE_LENGTH = 4096
+
+# Results of a delivery: sent, refused by telegram for good, or failed for now and worth another try
+DELIVERED = "delivered"
+REJECTED = "rejected"
+FAILED = "failed"
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=1):
+        """Token bucket refilled with rate tokens per second, holding at most capacity tokens
+
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (float): The maximum number of tokens, i.e. the allowed burst.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """Returns the seconds until a token is available, 0 if one is available now"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class MessageQueue(object):
+
+    # Limits of the Telegram Bot API: ~30 messages per second overall, 1 per second per chat and
+    # 20 per minute per group
+    GLOBAL_RATE = 30
+    PRIVATE_RATE = 1
+    GROUP_RATE = 20 / 60
+
+    # Attempts for a message that failed because of network errors
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, bot, senders=4, on_forbidden=None, global_rate=GLOBAL_RATE):
+        """Central delivery queue for outgoing messages honoring the flood limits of Telegram
+
+        Args:
+            bot (telegram.Bot): The bot the messages are sent with.
+            senders (int): The number of messages sent concurrently.
+            on_forbidden (callable): Called with the chat_id of chats that blocked the bot.
+            global_rate (float): The number of messages sent per second at most.
+        """
+        self.bot = bot
+        self.senders = int(senders)
+        self.on_forbidden = on_forbidden
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = []
+        self._sequence = itertools.count()
+        metrics.QUEUE_DEPTH.set_function(self.__len__)
+
+    def start(self):
+        """Starts the sender tasks in the running event loop"""
+        self.tasks = [asyncio.ensure_future(self._sender()) for _ in range(self.senders)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_HIGH, **kwargs):
+        """Enqueues a message and returns without waiting for its delivery
+
+        Returns:
+            asyncio.Future: Resolves to DELIVERED, REJECTED or FAILED.
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = {"chat_id": chat_id, "text": text, "kwargs": kwargs, "future": future, "attempts": 0}
+        self._put(priority, next(self._sequence), item)
+        return future
+
+    def _put(self, priority, sequence, item):
+        self.queue.put_nowait((priority, sequence, item))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Forget idle chats, a full bucket behaves like a new one
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full()}
+            # Private chats have positive ids, groups and channels negative ones
+            bucket = TokenBucket(self.PRIVATE_RATE if chat_id > 0 else self.GROUP_RATE)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _sender(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            priority, sequence, item = await self.queue.get()
+
+            # Put messages for chats that are over their limit back, without blocking other chats
+            if self._requeue_if_limited(loop, priority, sequence, item):
+                continue
+
+            # Everything waits for the global limit and for a flood wait imposed by telegram
+            while True:
+                delay = max(self.global_bucket.delay(), self.paused_until - time.monotonic())
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            # Another sender may have sent to the chat while this one waited, check again without yielding
+            if self._requeue_if_limited(loop, priority, sequence, item):
+                continue
+            self.global_bucket.consume()
+            self._chat_bucket(item["chat_id"]).consume()
+            await self._deliver(priority, sequence, item)
+
+    def _requeue_if_limited(self, loop, priority, sequence, item):
+        """Puts the message back for when its chat is within its limit again, returns False if it is now"""
+        delay = self._chat_bucket(item["chat_id"]).delay()
+        if delay <= 0:
+            return False
+        loop.call_later(delay, self._put, priority, sequence, item)
+        return True
+
+    async def _deliver(self, priority, sequence, item):
+        future = item["future"]
+
+        try:
+            await self._attempt(priority, sequence, item)
+        except Exception:
+            # Anything unexpected fails the message for now, the sender lives on to serve the others
+            traceback.print_exc()
+            if not future.done():
+                _resolve(future, FAILED)
+
+    async def _attempt(self, priority, sequence, item):
+        future = item["future"]
+
+        try:
+            try:
+                await self.bot.send_message(chat_id=item["chat_id"], text=item["text"], **item["kwargs"])
+            except TelegramError as e:
+                metrics.TELEGRAM_ERRORS.inc(type=e.__class__.__name__)
+                raise
+            _resolve(future, DELIVERED)
+        except RetryAfter as e:
+            # Flood limit hit, pause all senders and try again afterwards
+            self.paused_until = max(self.paused_until, time.monotonic() + float(e.retry_after))
+            self._put(priority, sequence, item)
+        except Forbidden:
+            _resolve(future, REJECTED)
+            if self.on_forbidden is not None:
+                # The callback writes to the database, keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.on_forbidden, item["chat_id"])
+        except BadRequest:
+            # The message itself is broken, sending it again won't help
+            traceback.print_exc()
+            _resolve(future, REJECTED)
+        except NetworkError:
+            item["attempts"] += 1
+            if item["attempts"] < self.MAX_ATTEMPTS:
+                asyncio.get_running_loop().call_later(2 ** item["attempts"], self._put, priority, sequence, item)
+            else:
+                traceback.print_exc()
+                _resolve(future, FAILED)
+        except TelegramError:
+            traceback.print_exc()
+            _resolve(future, FAILED)
+
+
+class OutboxWorker(object):
+
+    def __init__(self, database, queue, batch_size=100, max_in_flight=1000, interval=60, retry_delay=60):
+        """Drains the outbox table into the message queue. Messages are removed from the outbox only after
+        telegram confirmed or refused them, so every message is delivered at least once, even across restarts
+
+        Args:
+            database (DatabaseHandler): The database holding the outbox.
+            queue (MessageQueue): The queue the messages are sent with.
+            batch_size (int): The number of messages read from the outbox at once.
+            max_in_flight (int): The number of messages handed to the queue but not delivered yet.
+            interval (float): The seconds between two reads of the outbox without notify() being called.
+            retry_delay (float): The seconds before a failed message is tried again, doubling with every attempt.
+        """
+        # The outbox is read and written in a thread pool, not in the event loop the bot answers commands in
+        self.db = AsyncHandler(database, max_workers=1, name="outbox")
+        self.queue = queue
+        self.batch_size = int(batch_size)
+        self.max_in_flight = int(max_in_flight)
+        self.interval = float(interval)
+        self.retry_delay = float(retry_delay)
+        self.in_flight = set()
+        self.results = []
+        self.running = True
+        self._wakeup = asyncio.Event()
+        metrics.OUTBOX_IN_FLIGHT.set_function(self.in_flight.__len__)
+
+    def notify(self):
+        """Wakes the worker up, e.g. after the poller queued new messages"""
+        self._wakeup.set()
+
+    async def run(self):
+        # The bot is the only process delivering messages, those held by a previous run were never confirmed
+        await self.db.release_outbox()
+
+        while self.running:
+            await self.flush()
+
+            rows = []
+            if len(self.in_flight) < self.max_in_flight:
+                rows = await self.fetch()
+
+            if rows:
+                await self.enqueue(rows)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval if not self.in_flight else 1)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def fetch(self):
+        """Returns the next batch of due messages and holds them back in the outbox until they were delivered.
+        The batch is completed with all due digest messages of its chats, the poller writes them entry by entry
+        across all subscribers, so a batch rarely holds more than one message of a chat by itself
+        """
+        now = time.time()
+        rows = await self.db.get_outbox(limit=self.batch_size, now=now)
+
+        chats = set(row[1] for row in rows if row[3])
+        if chats:
+            rows = [row for row in rows if not row[3]] + await self.db.get_digest_outbox(chats, now=now)
+
+        if rows:
+            await self.db.hold_outbox([row[0] for row in rows])
+        return rows
+
+    async def enqueue(self, rows):
+        """Hands outbox rows to the message queue, packing the rows of chats in digest mode together"""
+        digests = {}
+
+        for row_id, chat_id, text, digest, attempts in rows:
+            if digest:
+                digests.setdefault(chat_id, []).append((row_id, text))
+            else:
+                await self._send([row_id], chat_id, text)
+
+        for chat_id, items in digests.items():
+            # Pack the lines in order and hand out the row ids along with the message holding them
+            for message in pack_messages([text for row_id, text in items]):
+                count, length = 0, -1
+                while length < len(message):
+                    length += len(items[count][1]) + 1
+                    count += 1
+                await self._send([row_id for row_id, text in items[:count]], chat_id, message)
+                items = items[count:]
+
+    async def _send(self, row_ids, chat_id, text):
+        self.in_flight.update(row_ids)
+        future = await self.queue.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                                               priority=PRIORITY_LOW)
+        future.add_done_callback(lambda done: self._done(row_ids, done.result()))
+
+    def _done(self, row_ids, result):
+        self.results.append((row_ids, result))
+        self._wakeup.set()
+
+    async def flush(self):
+        """Writes the results of finished deliveries to the outbox"""
+        results, self.results = self.results, []
+        done = []
+        failed = []
+
+        for row_ids, result in results:
+            self.in_flight.difference_update(row_ids)
+            if result == FAILED:
+                failed.extend(row_ids)
+            else:
+                done.extend(row_ids)
+
+        if done:
+            await self.db.remove_outbox(done)
+        if failed:
+            await self.db.retry_outbox(failed, now=time.time(), delay=self.retry_delay)
+
+    def set_running(self, running):
+        self.running = running
+
+
+def pack_messages(lines, limit=MAX_MESSAGE_LENGTH):
+    """Packs lines into as few messages as possible, each at most limit characters long
+
+    Args:
+        lines (list): The lines to send.
+        limit (int): The maximum length of a message.
+
+    Returns:
+        list: The texts of the messages.
+    """
+    messages = []
+    current = ""
+
+    for line in lines:
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current = current + "\n" + line if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+def _resolve(future, result):
+    metrics.MESSAGES.inc(result=result)
+    if not future.done():
+        future.set_result(result)
@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+from util.feedhandler import FeedHandler
+
+
+class FeedCache(object):
+
+    def __init__(self, ttl=120, max_size=256):
+        """Short lived cache of parsed feeds keyed by their canonical url, so validating a feed in /add, a manual
+        /get and the next poll of the feed share one download
+
+        Args:
+            ttl (float): The seconds a parsed feed is reused.
+            max_size (int): The number of feeds kept, the least recently used ones are dropped first.
+        """
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self._feeds = OrderedDict()
+        # Handlers may use the cache from executor threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._feeds)
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def get(self, url, now=None):
+        """Returns the parsed feed of the url, or None if it is not cached or expired"""
+        now = time.monotonic() if now is None else now
+        key = FeedHandler.canonicalize_url(url)
+
+        with self._lock:
+            item = self._feeds.get(key)
+            if item is None:
+                return None
+            if now - item[0] >= self.ttl:
+                del self._feeds[key]
+                return None
+            self._feeds.move_to_end(key)
+            return item[1]
+
+    def put(self, url, feed, now=None):
+        now = time.monotonic() if now is None else now
+        key = FeedHandler.canonicalize_url(url)
+
+        with self._lock:
+            self._feeds[key] = (now, feed)
+            self._feeds.move_to_end(key)
+            while len(self._feeds) > self.max_size:
+                self._feeds.popitem(last=False)
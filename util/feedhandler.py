@@ -1,63 +1,253 @@
+import asyncio
+import calendar
+import hashlib
 import re
+import time
+from urllib.parse import urlsplit, urlunsplit
 
 import feedparser
+import httpx
+
+from util import metrics, tracing
+from util.fetcher import Fetcher, ResponseTooLarge
+
+URL_VALIDATOR = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Query parameters that only track where a click came from and never change the feed
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "igshid"}
+
+# Channel elements kept after parsing, the scheduler reads its hints from them
+CHANNEL_KEYS = ("title", "ttl", "sy_updateperiod", "sy_updatefrequency")
+
+# Entries downloaded and parsed per feed. Only the newest few are sent, the others tell the scheduler how often
+# the feed is updated. Huge feeds, e.g. podcasts listing every episode ever, are cut off after them
+MAX_ENTRIES = 20
+
+
+class FeedEntry(object):
+    """Normalized entry of a feed, built once per entry right after parsing"""
+
+    __slots__ = ("entry_id", "guid", "link", "title", "timestamp")
+
+    def __init__(self, guid, link, title, timestamp=None):
+        """
+        Args:
+            guid (str): The guid of the entry, falling back to its link or title.
+            link (str): The link of the entry.
+            title (str): The title of the entry.
+            timestamp (float): The time the entry was published or updated as seconds since the epoch, or None.
+        """
+        self.guid = guid
+        self.link = link
+        self.title = title
+        self.timestamp = timestamp
+        # Compact 64 bit id of the entry, stored to remember which entries were seen
+        digest = hashlib.blake2b(guid.encode("utf-8"), digest_size=8).digest()
+        self.entry_id = int.from_bytes(digest, "big", signed=True)
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Builds the entry from a FeedParserDict entry, using the dates feedparser already parsed"""
+        return cls(*_entry_record(entry))
+
+    def __repr__(self):
+        return "FeedEntry(%r, %r, %r, %r)" % (self.guid, self.link, self.title, self.timestamp)
 
 
 class FeedHandler(object):
 
+    # Shared by the poller and the command handlers, replace it to configure timeouts and limits
+    fetcher = Fetcher()
+
     @staticmethod
-    def parse_feed(url, entries=0):
+    def parse_feed(url, entries=0, cache=None):
         """
-        Parses the given url, returns a list containing all available entries
+        Parses the given url, returns a list containing the FeedEntry objects of the newest entries.
+        A feed parsed recently is taken from the cache, if one is given
         """
 
+        feed = cache.get(url) if cache is not None else None
+        if feed is None:
+            feed = _download(url)
+            if cache is not None and feed.entries:
+                cache.put(url, feed)
+
         if 1 <= entries <= 10:
-            feed = feedparser.parse(url)
             return feed.entries[:entries]
         else:
-            feed = feedparser.parse(url)
             return feed.entries[:4]
 
+    @staticmethod
+    def create_client():
+        """
+        Returns the fetcher used by the poller, its connections are closed when the poller leaves it
+        """
+
+        return FeedHandler.fetcher
+
+    @staticmethod
+    async def fetch_feed_async(fetcher, url, etag=None, modified=None, executor=None, trace=None):
+        """
+        Fetches the newest MAX_ENTRIES entries of the given url without blocking the event loop and parses them
+        in an executor, e.g. a ProcessPoolExecutor to parse on all cores. Returns None if the server answered
+        304 Not Modified, else the parsed feed with its entries as FeedEntry objects. The phases are recorded in
+        trace, if one is given
+        """
+
+        result = await fetcher.fetch(url, etag=etag, modified=modified, trace=trace, max_entries=MAX_ENTRIES)
+        if result is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        with tracing.span(trace, "parse"):
+            records = await loop.run_in_executor(executor, parse_records, result.content, dict(result.headers))
+        metrics.PARSE_SECONDS.observe(time.perf_counter() - started)
+        metrics.FEED_ENTRIES.observe(len(records[0]))
+        return _build_feed(result, records)
+
     @staticmethod
     def is_parsable(url):
         """
         Checks wether the given url provides a news feed. Return True if news are available, else False
         """
 
-        if not _url_validator().match(url):
-            return False
+        return FeedHandler.resolve_feed_url(url) is not None
 
-        feed = feedparser.parse(url)
+    @staticmethod
+    def resolve_feed_url(url, cache=None):
+        """
+        Parses the given url, following redirects. Returns the url the feed was finally served from, or None if
+        the url doesn't provide any news. The parsed feed is put in the cache, if one is given, so the first poll
+        of a new subscription doesn't download it again
+        """
+
+        if not URL_VALIDATOR.match(url):
+            return None
 
-        # Check if result is empty
+        feed = cache.get(url) if cache is not None else None
+        if feed is None:
+            feed = _download(url)
+
+        # Check if result is empty, entries without a date are fine as new entries are recognized by their guid
         if not feed.entries:
-            return False
-        # Check if entries provide updated attribute
-        for post in feed.entries:
-            if not hasattr(post, "updated"):
-                return False
-        return True
+            return None
+
+        # Fetch from where the feed was served, its canonical form may not be served at all
+        feed_url = feed.get("href") or url
+        if cache is not None:
+            cache.put(feed_url, feed)
+        return feed_url
 
     @staticmethod
     def format_url_string(string):
         """
         Formats a given url as string, so it matches http(s)://address.domain.
-        This should be called before parsing the url, to make sure it is parsable
+        This should be called before parsing the url, to make sure it is parsable. Only the scheme and the host
+        are lowercased, the rest may matter to the server
         """
 
-        string = string.lower()
+        string = string.strip()
 
-        if not _url_validator().match(string):
+        if "://" not in string:
             string = "http://" + string
 
-        return string
+        parts = urlsplit(string)
+        netloc = parts.netloc if "@" in parts.netloc else parts.netloc.lower()
+        return urlunsplit((parts.scheme.lower(), netloc, parts.path, parts.query, parts.fragment))
+
+    @staticmethod
+    def canonicalize_url(url):
+        """
+        Returns the canonical form of an url, the key different spellings of the same feed are recognized by:
+        lowercase scheme and host, no default port, no trailing slash, no tracking parameters and no fragment.
+        The path and the remaining query are kept as they are, as both may be case sensitive. It is never
+        fetched, the server may not serve the feed under it
+        """
+
+        try:
+            parts = urlsplit(url.strip())
+            port = parts.port
+        except ValueError:
+            return url
+
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").rstrip(".")
+        netloc = "[" + host + "]" if ":" in host else host
+        if port is not None and port != DEFAULT_PORTS.get(scheme):
+            netloc += ":" + str(port)
+        if parts.username is not None:
+            userinfo = parts.netloc.rpartition("@")[0]
+            netloc = userinfo + "@" + netloc
+
+        path = parts.path.rstrip("/") or "/"
+        # Filter the raw parameters, decoding and encoding them again could change what the server sees
+        query = "&".join(param for param in parts.query.split("&") if param and not _is_tracking_param(param))
+
+        return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def _is_tracking_param(param):
+    key = param.partition("=")[0].lower()
+    return key.startswith("utm_") or key in TRACKING_PARAMS
+
+
+def _download(url):
+    """Downloads and parses a feed with the shared fetcher. Like feedparser, errors are reported in bozo_exception
+    of an empty feed"""
+    try:
+        result = FeedHandler.fetcher.fetch_blocking(url, max_entries=MAX_ENTRIES)
+    except (httpx.HTTPError, httpx.InvalidURL, ResponseTooLarge) as e:
+        return feedparser.FeedParserDict(entries=[], bozo=1, bozo_exception=e)
+
+    return _parse_result(result)
+
+
+def _parse_result(result):
+    """Parses a FetchResult in the calling thread"""
+    return _build_feed(result, parse_records(result.content, dict(result.headers)))
+
+
+def _build_feed(result, records):
+    """Builds the parsed feed with FeedEntry objects from the records returned by parse_records"""
+    entries, channel, bozo = records
+    return feedparser.FeedParserDict(
+        entries=[FeedEntry(*record) for record in entries],
+        feed=feedparser.FeedParserDict(channel),
+        bozo=bozo,
+        href=result.url,
+        etag=result.headers.get("etag"),
+        modified=result.headers.get("last-modified"))
+
+
+def parse_records(content, headers=None):
+    """Parses the body of a feed. Runs in worker processes, so only plain, compact data is returned
+
+    Args:
+        content (bytes): The body of the feed.
+        headers (dict): The headers of the response, telling the encoding.
+
+    Returns:
+        tuple: The (guid, link, title, timestamp) tuples of the entries, a dict with the CHANNEL_KEYS found in
+        the channel and the bozo flag of feedparser.
+    """
+    feed = feedparser.parse(content, response_headers=headers or {})
+    entries = [_entry_record(entry) for entry in feed.entries]
+    channel = {key: feed.feed[key] for key in CHANNEL_KEYS if key in feed.feed}
+    return entries, channel, int(feed.get("bozo", 0))
 
 
-def _url_validator():
-    return re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+def _entry_record(entry):
+    link = entry.get("link") or ""
+    title = entry.get("title") or ""
+    parsed = entry.get("published_parsed") or entry.get("updated_parsed")
+    timestamp = calendar.timegm(parsed) if parsed is not None else None
+    return entry.get("id") or link or title, link, title, timestamp
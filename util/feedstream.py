@@ -0,0 +1,75 @@
+import xml.parsers.expat
+
+# Local names of the elements holding the entries of RSS, RDF and Atom feeds
+ENTRY_TAGS = ("item", "entry")
+
+
+class EntryLimiter(object):
+
+    def __init__(self, limit):
+        """Finds the end of the limit-th entry of a feed while its body is downloaded, so the download can stop
+        there and feedparser only parses the newest entries. Feeds list their newest entries first. A body
+        that is not well-formed XML is left whole, feedparser copes with broken feeds
+
+        Args:
+            limit (int): The number of entries kept.
+        """
+        self.limit = int(limit)
+        self.count = 0
+        self.failed = False
+        self.end = None
+        self.open = None
+        self._stack = []
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+
+    @property
+    def done(self):
+        """True once the limit-th entry has ended"""
+        return self.end is not None
+
+    def feed(self, chunk):
+        """Parses the next chunk of the body
+
+        Returns:
+            bool: True once the limit-th entry has ended.
+        """
+        if self.failed or self.end is not None:
+            return self.end is not None
+
+        # The closing tags appended by truncate() are ASCII, which UTF-16 and UTF-32 bodies are not
+        if not self._stack and (chunk[:2] in (b"\xff\xfe", b"\xfe\xff") or b"\x00" in chunk[:4]):
+            self.failed = True
+            return False
+
+        try:
+            self._parser.Parse(chunk, False)
+        except xml.parsers.expat.ExpatError:
+            self.failed = True
+        return self.end is not None
+
+    def truncate(self, content):
+        """Returns the body up to the end of the limit-th entry, closing the elements still open so it stays
+        well-formed. The body is returned unchanged if it has fewer entries"""
+        if self.end is None:
+            return content
+
+        end = content.find(b">", self.end)
+        if end < 0:
+            return content
+        closing = "".join("</%s>" % name for name in reversed(self.open))
+        return content[:end + 1] + closing.encode("utf-8")
+
+    def _start(self, name, attributes):
+        self._stack.append(name)
+
+    def _end(self, name):
+        self._stack.pop()
+        # Entries are children of the root (Atom, RDF) or of the channel (RSS)
+        if self.end is None and len(self._stack) <= 2 and name.rpartition(":")[2] in ENTRY_TAGS:
+            self.count += 1
+            if self.count >= self.limit:
+                # The index of the end tag of the entry, everything after it is cut off
+                self.end = self._parser.CurrentByteIndex
+                self.open = list(self._stack)
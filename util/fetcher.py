@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+
+import feedparser
+import httpx
+
+from util import metrics, tracing
+from util.feedstream import EntryLimiter
+
+try:
+    import h2  # noqa: F401 HTTP/2 is only negotiated if the optional h2 package is installed
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# Largest feed body downloaded, anything bigger is not a feed we want to parse
+MAX_BODY_SIZE = 5 * 1024 * 1024
+
+# Bodies up to this size are read to the end after enough entries were found, so the connection can be reused.
+# Bigger ones are cut off, reconnecting is cheaper than downloading the rest
+DRAIN_SIZE = 256 * 1024
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class FetchResult(object):
+    """Body of a successful download along with the url it was finally served from"""
+
+    __slots__ = ("url", "headers", "content")
+
+    def __init__(self, url, headers, content):
+        self.url = url
+        self.headers = headers
+        self.content = content
+
+
+class Fetcher(object):
+
+    def __init__(self, timeout=30.0, per_host=4, max_connections=100, max_body_size=MAX_BODY_SIZE, transport=None):
+        """Fetch layer below the FeedHandler. Keeps connections alive between fetches and caps the concurrent
+        requests per host, so hosts serving many of our feeds see a few reused connections instead of a
+        handshake per feed
+
+        Args:
+            timeout (float): The seconds to wait for connecting and for each read of a response.
+            per_host (int): The number of requests sent to the same host at the same time.
+            max_connections (int): The number of connections kept open over all hosts.
+            max_body_size (int): The maximum size of a response body in bytes.
+            transport (httpx.BaseTransport): Replaces the network, for tests.
+        """
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 10.0))
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=60.0)
+        self.per_host = int(per_host)
+        self.max_body_size = int(max_body_size)
+        self.transport = transport
+        self._client = None
+        self._sync_client = None
+        self._semaphores = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def _options(self):
+        return {
+            "timeout": self.timeout,
+            "limits": self.limits,
+            "follow_redirects": True,
+            "headers": {"User-Agent": feedparser.USER_AGENT},
+            "transport": self.transport,
+        }
+
+    @property
+    def client(self):
+        """The shared client of the event loop, created on first use"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(http2=HTTP2, **self._options())
+        return self._client
+
+    @property
+    def sync_client(self):
+        """The shared client of blocking calls, e.g. the command handlers running in a thread pool"""
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(http2=HTTP2, **self._options())
+            return self._sync_client
+
+    async def fetch(self, url, etag=None, modified=None, trace=None, max_entries=None):
+        """Downloads the url without blocking the event loop, sending the validators of the previous fetch
+
+        Args:
+            trace (FeedTrace): Records the time spent connecting, waiting for and downloading the response.
+            max_entries (int): Stops the download after this many entries, None downloads the whole feed.
+
+        Returns:
+            FetchResult: The downloaded body, or None if the server answered 304 Not Modified.
+        """
+        started = time.perf_counter()
+        try:
+            result = await self._fetch(url, etag, modified, trace, max_entries)
+        except Exception:
+            metrics.FETCHES.inc(result="error")
+            raise
+        finally:
+            metrics.FETCH_SECONDS.observe(time.perf_counter() - started)
+        return _count(result)
+
+    async def _fetch(self, url, etag, modified, trace, max_entries):
+        host = urlsplit(url).hostname or ""
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.per_host)
+
+        extensions = {"trace": trace.on_http_event} if trace is not None else None
+        async with semaphore:
+            async with self.client.stream("GET", url, headers=_conditional_headers(etag, modified),
+                                          extensions=extensions) as response:
+                if response.status_code == 304:
+                    return None
+                response.raise_for_status()
+                self._check_length(url, response)
+
+                body = _Body(url, self.max_body_size, max_entries)
+                with tracing.span(trace, "download"):
+                    async for chunk in response.aiter_bytes():
+                        if not body.add(chunk):
+                            break
+
+        return FetchResult(str(response.url), response.headers, body.content())
+
+    def fetch_blocking(self, url, etag=None, modified=None, max_entries=None):
+        """Same as fetch, for callers outside of the event loop"""
+        started = time.perf_counter()
+        try:
+            result = self._fetch_blocking(url, etag, modified, max_entries)
+        except Exception:
+            metrics.FETCHES.inc(result="error")
+            raise
+        finally:
+            metrics.FETCH_SECONDS.observe(time.perf_counter() - started)
+        return _count(result)
+
+    def _fetch_blocking(self, url, etag, modified, max_entries):
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            host_lock = self._host_locks.get(host)
+            if host_lock is None:
+                host_lock = self._host_locks[host] = threading.BoundedSemaphore(self.per_host)
+
+        with host_lock:
+            with self.sync_client.stream("GET", url, headers=_conditional_headers(etag, modified)) as response:
+                if response.status_code == 304:
+                    return None
+                response.raise_for_status()
+                self._check_length(url, response)
+
+                body = _Body(url, self.max_body_size, max_entries)
+                for chunk in response.iter_bytes():
+                    if not body.add(chunk):
+                        break
+
+        return FetchResult(str(response.url), response.headers, body.content())
+
+    def _check_length(self, url, response):
+        # Refuse bodies announced as too large before reading them
+        try:
+            if int(response.headers.get("content-length", 0)) > self.max_body_size:
+                raise ResponseTooLarge(url)
+        except ValueError:
+            pass
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._semaphores = {}
+
+    def close(self):
+        with self._lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+
+class _Body(object):
+    """Collects the chunks of a response body, enforcing the size cap and stopping after max_entries entries"""
+
+    def __init__(self, url, max_body_size, max_entries=None):
+        self.url = url
+        self.max_body_size = max_body_size
+        self.limiter = EntryLimiter(max_entries) if max_entries else None
+        self.chunks = []
+        self.size = 0
+
+    def add(self, chunk):
+        """Adds the next chunk, returns False once the rest of the body is not needed anymore"""
+        self.size += len(chunk)
+        if self.limiter is not None and self.limiter.done:
+            # Read on without keeping the chunks, only to reuse the connection of a small body
+            return self.size <= DRAIN_SIZE
+
+        if self.size > self.max_body_size:
+            raise ResponseTooLarge(self.url)
+        self.chunks.append(chunk)
+        if self.limiter is not None:
+            self.limiter.feed(chunk)
+        return True
+
+    def content(self):
+        content = b"".join(self.chunks)
+        if self.limiter is not None:
+            content = self.limiter.truncate(content)
+        return content
+
+
+def _count(result):
+    if result is None:
+        metrics.FETCHES.inc(result="not_modified")
+    else:
+        metrics.FETCHES.inc(result="ok")
+        metrics.FETCH_BYTES.observe(len(result.content))
+    return result
+
+
+def _conditional_headers(etag, modified):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    return headers
@@ -0,0 +1,305 @@
+import functools
+import inspect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the buckets of latency histograms in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class Registry(object):
+
+    def __init__(self):
+        """Holds the metrics exposed together in the text format of Prometheus"""
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in the text exposition format"""
+        with self._lock:
+            metrics = list(self.metrics)
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        """
+        Args:
+            name (str): The name of the metric.
+            documentation (str): The help text of the metric.
+            labels (tuple): The names of the labels the values are split by.
+            registry (Registry): The registry the metric is exposed with, None to not expose it.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP %s %s\n" % (self.name, self.documentation), "# TYPE %s %s\n" % (self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return "".join(lines)
+
+    def _render_value(self, key, value):
+        return ["%s%s %s\n" % (self.name, self._format_labels(key), _format_number(value))]
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        super().__init__(name, documentation, labels=labels, registry=registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        """Reads the value from function every time the metric is exposed, e.g. the length of a queue"""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def get(self, **labels):
+        key = self._key(labels)
+        function = self._functions.get(key)
+        return function() if function is not None else self._values.get(key, 0)
+
+    def render(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super().render()
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labels=labels, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Count per bucket, sum and count of all observations
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Returns a context manager observing the seconds its block took"""
+        return _Timer(self, labels)
+
+    def get_count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state is not None else 0
+
+    def get_total_count(self):
+        """Returns the number of observations over all label values"""
+        with self._lock:
+            return sum(state[2] for state in self._values.values())
+
+    def _render_value(self, key, state):
+        lines = []
+        cumulative = 0
+        with self._lock:
+            counts, total, count = list(state[0]), state[1], state[2]
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            lines.append("%s_bucket%s %d\n" % (self.name, self._format_labels(key, [("le", _format_number(bound))]),
+                                               cumulative))
+        lines.append("%s_bucket%s %d\n" % (self.name, self._format_labels(key, [("le", "+Inf")]), count))
+        lines.append("%s_sum%s %s\n" % (self.name, self._format_labels(key), _format_number(total)))
+        lines.append("%s_count%s %d\n" % (self.name, self._format_labels(key), count))
+        return lines
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def timed_methods(histogram):
+    """Class decorator observing the duration of every public method in histogram, labelled by the method name.
+    For generators the time spent producing the items is observed"""
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, _timed(method, histogram))
+        return cls
+
+    return decorate
+
+
+def _timed(method, histogram):
+    name = method.__name__
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator(*args, **kwargs):
+            items = method(*args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    yield item
+            finally:
+                items.close()
+                histogram.observe(elapsed, method=name)
+
+        return generator
+
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, method=name)
+
+    return timed
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the output
+        pass
+
+
+def start_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serves the metrics on http://host:port/metrics from a daemon thread
+
+    Args:
+        port (int): The port to listen on, 0 picks a free one.
+        host (str): The address to listen on, only local connections by default.
+        registry (Registry): The metrics to serve.
+
+    Returns:
+        ThreadingHTTPServer: The running server, shutdown() stops it.
+    """
+    handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+# Metrics of the pipeline, from fetching a feed to delivering its news
+FETCH_SECONDS = Histogram("robotrss_fetch_seconds", "Duration of feed downloads.")
+FETCH_BYTES = Histogram("robotrss_fetch_bytes", "Size of downloaded feed bodies.", buckets=SIZE_BUCKETS)
+FETCHES = Counter("robotrss_fetches_total", "Feed downloads by result: ok, not_modified or error.", ["result"])
+PARSE_SECONDS = Histogram("robotrss_parse_seconds", "Duration of parsing a feed body.")
+FEED_ENTRIES = Histogram("robotrss_feed_entries", "Entries per parsed feed.", buckets=COUNT_BUCKETS)
+NEW_ENTRIES = Counter("robotrss_new_entries_total", "Entries that were not seen before.")
+FEED_FAILURES = Counter("robotrss_feed_failures_total", "Failed updates of a feed.")
+CYCLE_SECONDS = Histogram("robotrss_cycle_seconds", "Duration of a polling cycle over all due feeds.")
+CYCLE_FEEDS = Counter("robotrss_cycle_feeds_total", "Feeds updated by polling cycles.")
+OUTBOX_MESSAGES = Counter("robotrss_outbox_messages_total", "Messages written to the outbox.")
+MESSAGES = Counter("robotrss_messages_total", "Messages handed to telegram by result.", ["result"])
+TELEGRAM_ERRORS = Counter("robotrss_telegram_errors_total", "Errors returned by telegram by type.", ["type"])
+QUEUE_DEPTH = Gauge("robotrss_queue_depth", "Messages waiting in the delivery queue.")
+OUTBOX_IN_FLIGHT = Gauge("robotrss_outbox_in_flight", "Outbox messages handed to the queue but not delivered.")
+DB_SECONDS = Histogram("robotrss_db_seconds", "Duration of DatabaseHandler calls by method.", ["method"])
@@ -1,89 +1,483 @@
 # /bin/bash/python/
 
+import asyncio
 import datetime
-import threading
+import itertools
+import multiprocessing
+import time
 import traceback
-from multiprocessing.dummy import Pool as ThreadPool
-from threading import Thread as RunningThread
-from time import sleep
-
-from telegram.constants import ParseMode
-from telegram.error import (TelegramError, Forbidden)
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
 
+from util import metrics, tracing
+from util.asynchandler import AsyncHandler
 from util.datehandler import DateHandler
 from util.feedhandler import FeedHandler
+from util.scheduler import FeedScheduler
+from util.sharding import shard_of
+
+
+class BatchProcess(object):
 
+    # Seconds between two scans of the subscription table for added or removed feeds
+    SYNC_INTERVAL = 60
 
-class BatchProcess(threading.Thread):
+    # Number of feeds whose subscribers are looked up with one query
+    BATCH_SIZE = 500
 
-    def __init__(self, database, update_interval, bot):
-        RunningThread.__init__(self)
+    # Consecutive failures of all feeds of a host after which the host is shut off for a while
+    HOST_FAILURES = 20
+
+    def __init__(self, database, update_interval, outbox=None, cache=None, concurrency=10, min_interval=60,
+                 max_interval=86400, max_failures=5, parse_workers=0, lease=None, tracer=None, subscriptions=None):
+        """
+        Args:
+            max_failures (int): The consecutive failures of a feed after which its subscribers are told once
+                that it doesn't work anymore.
+            parse_workers (int): The number of processes feeds are parsed in, 0 parses them in a thread pool.
+            lease (ShardLease): The lease of a worker polling only its shard of the feeds, None polls all feeds.
+            tracer (Tracer): Records the phases of every feed update and reports the slowest feeds of a cycle.
+            subscriptions (SubscriptionIndex): Finds the subscribers in memory, None reads them from the database.
+        """
         self.db = database
+        # The poller runs in the event loop of the bot, its queries run in a thread pool so they don't stall
+        # the commands
+        self.database = AsyncHandler(database, max_workers=2, name="poller-database")
         self.update_interval = float(update_interval)
-        self.bot = bot
+        self.outbox = outbox
+        self.cache = cache
+        self.concurrency = int(concurrency)
+        self.scheduler = FeedScheduler(default_interval=self.update_interval,
+                                       min_interval=min_interval, max_interval=max_interval)
+        self.max_failures = int(max_failures)
+        self.parse_workers = int(parse_workers)
+        self.lease = lease
+        self.tracer = tracer
+        self.subscriptions = subscriptions
+        self.profiler = tracing.Profiler()
+        self.shard = None
+        self.parser = None
+        self.failures = {}
+        self.failing_hosts = {}
+        self.client = None
         self.running = True
+        self.last_sync = None
+        # Feeds being queued or updated, the cycle ends once the poller runs idle
+        self.busy = 0
+        # Urls handed to the workers and not rescheduled yet, and those of them removed from the database meanwhile
+        self.updating = set()
+        self.dropped = set()
+        self.cycle_started = None
+        self.cycle_feeds = 0
+
+    async def run(self):
+        """
+        Polls every feed when it is due until set_running(False) is called
+        """
+
+        if self.parse_workers > 0:
+            self.start_parser()
+
+        heartbeat = None
+        try:
+            if self.lease is not None:
+                await self.renew_lease()
+                heartbeat = asyncio.ensure_future(self._heartbeat())
+            async with FeedHandler.create_client() as client:
+                self.client = client
+                await self._poll()
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if self.parser is not None:
+                # Parses still queued were cancelled along with the tasks awaiting them. cancel_futures would
+                # need python 3.9, runtime.txt pins 3.8
+                self.parser.shutdown(wait=False)
+                self.parser = None
+            if self.lease is not None:
+                self.lease.release()
+
+    def start_parser(self):
+        """
+        Starts the processes feeds are parsed in. Fetching stays in the event loop, parsing is CPU bound and
+        gets all cores. The processes are spawned rather than forked, as forking a process running threads is
+        unsafe
+        """
+
+        self.parser = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                          mp_context=multiprocessing.get_context("spawn"))
+
+    async def _poll(self):
+        """
+        Hands every feed to a long-lived pool of workers as soon as it is due, so feeds falling due while others
+        are fetched don't wait for the slowest fetch of a batch
+        """
 
-    def run(self):
+        pending = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._worker(pending)) for _ in range(self.concurrency)]
+        try:
+            while self.running:
+                now = time.monotonic()
+                if self.last_sync is None or now - self.last_sync >= self.SYNC_INTERVAL:
+                    await self.sync_schedule()
+                    self.last_sync = now
+                    if self.cycle_started is not None:
+                        # A poller that never runs idle still reports its cycle and hands out the news once per sync
+                        self._finish_cycle()
+                        self._start_cycle()
+
+                due = self.scheduler.pop_due(now)
+                if due:
+                    await self._queue_feeds(await self.database.get_feeds(due), pending)
+
+                # Sleep until the next feed is due, waking up for the next sync at the latest
+                delay = self.scheduler.next_due()
+                if delay is None or delay > self.SYNC_INTERVAL:
+                    delay = self.SYNC_INTERVAL
+                await asyncio.sleep(delay)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._finish_cycle()
+
+    async def renew_lease(self):
         """
-        Starts the BatchThreadPool
+        Renews the lease of a sharded worker and takes the shard it got. The default thread pool is used, so
+        queries of the poller waiting for the database can't delay the renewal
         """
 
-        while self.running:
-            # Init workload queue, add queue to ThreadPool
-            url_queue = self.db.get_all_urls()
-            self.parse_parallel(queue=url_queue, threads=4)
+        self.shard = await asyncio.get_running_loop().run_in_executor(None, self.lease.renew)
 
-            # Sleep for interval
-            sleep(self.update_interval)
+    async def _heartbeat(self):
+        """
+        Renews the lease on a fixed period, no matter how long the feeds take to update. The feeds of the new
+        shard are picked up at the next sync
+        """
 
-    def parse_parallel(self, queue, threads):
-        time_started = datetime.datetime.now()
+        while True:
+            await asyncio.sleep(self.lease.interval)
+            try:
+                await self.renew_lease()
+            except Exception:
+                traceback.print_exc()
+
+    async def sync_schedule(self):
+        """
+        Schedules feeds that were added and drops feeds that were removed since the last sync. Added feeds
+        that were just parsed by /add are polled right away, reusing that download. A sharded worker only keeps
+        the feeds of the shard it got at its last renewal
+        """
+
+        loop = asyncio.get_running_loop()
+        self.failing_hosts = await self.database.get_failing_hosts()
+        urls = await loop.run_in_executor(self.database.executor, self._scan_urls, self.shard)
+
+        for url in urls:
+            # Feeds being updated are rescheduled by their worker
+            if url not in self.scheduler and url not in self.updating:
+                if self.cache is not None and url in self.cache:
+                    self.scheduler.schedule(url, 0)
+                else:
+                    self.scheduler.add(url)
+        for url in self.scheduler.urls() - urls:
+            self.scheduler.remove(url)
+        self.dropped = self.updating - urls
+
+    def _scan_urls(self, shard):
+        """
+        Returns the urls of all feeds of the shard, runs in the thread pool of the database
+        """
+
+        urls = set()
+        for url in self.db.iter_urls():
+            if shard is None or shard_of(url[0], shard[1]) == shard[0]:
+                urls.add(url[0])
+        return urls
+
+    async def parse_parallel(self, queue):
+        """
+        Updates all feeds of the queue with a fixed number of workers as one cycle. The queue may be any
+        iterable, it is consumed lazily so memory stays flat no matter how many feeds it yields
+        """
+
+        pending = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._worker(pending)) for _ in range(self.concurrency)]
+        try:
+            await self._queue_feeds(queue, pending)
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            self._finish_cycle()
+
+    async def _queue_feeds(self, queue, pending):
+        """
+        Looks up the subscribers of the feeds of the queue batch by batch and hands the feeds to the workers,
+        starting a cycle if none is running
+        """
+
+        if self.cycle_started is None:
+            self._start_cycle()
+        self.busy += 1
+        try:
+            for batch in _batched(queue, self.BATCH_SIZE):
+                # Feeds of one host come out of the database side by side, spread them so the workers don't all
+                # wait for the per host limit of the fetcher while other hosts are idle
+                batch = _interleave_by_host([url for url in batch if not self._host_is_open(url[0])])
+                if self.subscriptions is not None:
+                    subscribers = self.subscriptions.get_active_users_for_urls([url[0] for url in batch])
+                else:
+                    subscribers = await self.database.get_active_users_for_urls([url[0] for url in batch])
+                for url in batch:
+                    self.updating.add(url[0])
+                    await pending.put((url, subscribers.get(url[0], [])))
+                    self.cycle_feeds += 1
+        finally:
+            self.busy -= 1
+            self._finish_if_idle(pending)
+
+    async def _worker(self, pending):
+        """
+        Updates the feeds handed out by _queue_feeds until it gets None
+        """
+
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+
+            url, users = item
+            self.busy += 1
+            started = time.monotonic()
+            trace = self.tracer.trace(url[0]) if self.tracer is not None else None
+            feed = None
+            try:
+                feed = await self.update_feed(url, users=users, trace=trace)
+            except Exception:
+                traceback.print_exc()
+                if trace is not None:
+                    trace.result = "error"
+            finally:
+                if trace is not None:
+                    trace.finish()
+                failures = self.failures.pop(url[0], 0)
+                self.updating.discard(url[0])
+                if url[0] in self.dropped:
+                    self.dropped.discard(url[0])
+                else:
+                    self.scheduler.reschedule(url[0], feed=feed, started=started, failures=failures)
+                self.busy -= 1
+                self._finish_if_idle(pending)
 
-        pool = ThreadPool(threads)
-        pool.map(self.update_feed, queue)
-        pool.close()
-        pool.join()
+    def _start_cycle(self):
+        self.cycle_started = datetime.datetime.now()
+        self.cycle_feeds = 0
+        if self.tracer is not None:
+            self.tracer.start_cycle()
+        self.profiler.start()
+
+    def _finish_if_idle(self, pending):
+        if self.busy == 0 and pending.empty():
+            self._finish_cycle()
+
+    def _finish_cycle(self):
+        """
+        Reports the running cycle and wakes the outbox up for the news it queued, if a cycle is running
+        """
+
+        if self.cycle_started is None:
+            return
+
+        time_started, self.cycle_started = self.cycle_started, None
+        self.profiler.stop()
+        if self.outbox is not None:
+            self.outbox.notify()
 
         time_ended = datetime.datetime.now()
         duration = time_ended - time_started
-        print("Finished updating! Parsed " + str(len(queue)) +
+        metrics.CYCLE_SECONDS.observe(duration.total_seconds())
+        metrics.CYCLE_FEEDS.inc(self.cycle_feeds)
+        print("Finished updating! Parsed " + str(self.cycle_feeds) +
               " rss feeds in " + str(duration) + " !")
+        if self.tracer is not None:
+            print(self.tracer.finish_cycle())
 
-    def update_feed(self, url):
-        telegram_users = self.db.get_users_for_url(url=url[0])
-
-        for user in telegram_users:
-            if user[6]:  # is_active
-                try:
-                    for post in FeedHandler.parse_feed(url[0]):
-                        self.send_newest_messages(
-                            url=url, post=post, user=user)
-                except:
-                    traceback.print_exc()
-                    message = "Something went wrong when I tried to parse the URL: \n\n " + \
-                              url[0] + "\n\nCould you please check that for me? Remove the url from your subscriptions " \
-                                       "using the /remove command, it seems like it does not work anymore!"
-                    self.bot.send_message(
-                        chat_id=user[0], text=message, parse_mode=ParseMode.HTML)
-
-        self.db.update_url(url=url[0], last_updated=str(
-            DateHandler.get_datetime_now()))
-
-    def send_newest_messages(self, url, post, user):
-        post_update_date = DateHandler.parse_datetime(timestamp=post.updated)
-        url_update_date = DateHandler.parse_datetime(timestamp=url[1])
-
-        if post_update_date > url_update_date:
-            message = "[" + user[7] + "] <a href='" + post.link + \
-                      "'>" + post.title + "</a>"
+    async def update_feed(self, url, users, trace=None):
+        """
+        Fetches and parses the feed once, then fans the entries out to every active subscriber. Returns the
+        parsed feed, or None if it was not fetched, not modified or failed
+
+        Args:
+            url (tuple): The (url, last_updated, etag, modified, failures) row of the feed.
+            users (list): The (telegram_id, alias, digest) tuples of the active subscribers.
+            trace (FeedTrace): Records the phases of the update, None if the feed is not traced.
+        """
+
+        validators = {}
+        feed = None
+
+        if users:
+            parser = self.parser
             try:
-                self.bot.send_message(
-                    chat_id=user[0], text=message, parse_mode=ParseMode.HTML)
-            except Forbidden:
-                self.db.update_user(telegram_id=user[0], is_active=0)
-            except TelegramError:
-                # handle all other telegram related errors
-                pass
+                # The poller only reads the cache, reusing its own results would hide new entries until they expire
+                feed = self.cache.get(url[0]) if self.cache is not None else None
+                if feed is None:
+                    feed = await FeedHandler.fetch_feed_async(self.client, url[0], etag=url[2], modified=url[3],
+                                                              executor=parser, trace=trace)
+                elif trace is not None:
+                    trace.result = "cached"
+            except BrokenProcessPool:
+                # A parser process died, e.g. on a feed exhausting its memory, replace the pool once
+                traceback.print_exc()
+                if self.parser is parser:
+                    parser.shutdown(wait=False)
+                    self.start_parser()
+                await self.failed(url=url, users=users, trace=trace)
+                return None
+            except Exception:
+                traceback.print_exc()
+                await self.failed(url=url, users=users, trace=trace)
+                return None
+
+            with tracing.span(trace, "db"):
+                await self.succeeded(url=url)
+            if feed is None:
+                # 304 Not Modified, nothing to parse or send
+                if trace is not None:
+                    trace.result = "not_modified"
+                return None
+
+            posts = feed.entries[:4]
+            validators = {"etag": feed.get("etag"), "modified": feed.get("modified")}
+            if posts:
+                await self.send_new_posts(url=url, posts=posts, users=users, trace=trace, entries=feed.entries)
+        elif trace is not None:
+            trace.result = "unsubscribed"
+
+        with tracing.span(trace, "db"):
+            await self.database.update_url(url=url[0], last_updated=str(
+                DateHandler.get_datetime_now()), **validators)
+        return feed
+
+    async def failed(self, url, users, trace=None):
+        """
+        Counts a failed fetch of the feed and its host. Subscribers are told once, when the feed failed
+        max_failures times in a row, a host whose feeds keep failing is shut off for a while
+        """
+
+        metrics.FEED_FAILURES.inc()
+        if trace is not None:
+            trace.result = "error"
+        host = _host(url[0])
+        with tracing.span(trace, "db"):
+            failures, host_failures = await self.database.add_failure(url=url[0], host=host)
+        self.failures[url[0]] = failures
+        self.failing_hosts.setdefault(host, None)
+
+        if failures == self.max_failures:
+            message = "Something went wrong when I tried to parse the URL: \n\n " + \
+                      url[0] + "\n\nCould you please check that for me? Remove the url from your subscriptions " \
+                               "using the /remove command, it seems like it does not work anymore!"
+            await self.database.add_outbox([(user[0], message, False) for user in users])
+
+        if host_failures >= self.HOST_FAILURES:
+            # Every further round of failures doubles the time the host is left alone
+            cooldown = min(self.scheduler.min_interval * 2 ** min(host_failures // self.HOST_FAILURES, 32),
+                           self.scheduler.max_interval)
+            retry_at = time.time() + cooldown
+            await self.database.open_host(host=host, retry_at=retry_at)
+            self.failing_hosts[host] = retry_at
+
+    async def succeeded(self, url):
+        """
+        Forgets the failures of the feed and its host
+        """
+
+        host = _host(url[0])
+        if url[4] or host in self.failing_hosts:
+            await self.database.reset_failures(url=url[0], host=host)
+            self.failing_hosts.pop(host, None)
+
+    def _host_is_open(self, url):
+        """
+        Returns True if the host of the url is shut off, rescheduling the url for when it is tried again
+        """
+
+        retry_at = self.failing_hosts.get(_host(url))
+        if retry_at is None:
+            return False
+
+        delay = retry_at - time.time()
+        if delay <= 0:
+            return False
+        self.scheduler.schedule(url, delay)
+        return True
+
+    async def send_new_posts(self, url, posts, users, trace=None, entries=None):
+        """
+        Queues every post of the feed that was not seen before for all users in the outbox and marks all
+        entries of the feed as seen, so an older entry moving up among the posts, e.g. after a newer one was
+        deleted, is not sent. The database queues only the posts that are still new inside its write
+        transaction, so a feed polled by two workers while its shard changes hands is not sent twice
+
+        Args:
+            entries (list): All parsed entries of the feed, None if they are the posts.
+        """
+
+        entry_ids = [entry.entry_id for entry in (posts if entries is None else entries)]
+        with tracing.span(trace, "db"):
+            seen = await self.database.get_seen_entries(url=url[0])
+        news = {}
+
+        # The first fetch of a feed only records what is already there
+        if seen:
+            with tracing.span(trace, "fanout"):
+                for post in posts:
+                    if post.entry_id not in seen:
+                        news[post.entry_id] = [(user[0], self.format_message(post=post, alias=user[1]), user[2])
+                                               for user in users]
+
+        with tracing.span(trace, "db"):
+            queued = await self.database.add_seen_entries(url=url[0], entry_ids=entry_ids, news=news)
+        metrics.NEW_ENTRIES.inc(len(queued))
+        metrics.OUTBOX_MESSAGES.inc(sum(len(news[entry_id]) for entry_id in queued))
+
+    @staticmethod
+    def format_message(post, alias):
+        """
+        Returns the html message announcing a FeedEntry to a subscriber
+        """
+
+        return "[" + alias + "] <a href='" + post.link + \
+               "'>" + post.title + "</a>"
 
     def set_running(self, running):
         self.running = running
+
+
+def _host(url):
+    return urlsplit(url).hostname or ""
+
+
+def _interleave_by_host(urls):
+    """Reorders the url rows so consecutive ones are served by different hosts, as far as possible"""
+    hosts = {}
+    for url in urls:
+        hosts.setdefault(_host(url[0]), []).append(url)
+    return [url for urls in itertools.zip_longest(*hosts.values()) for url in urls if url is not None]
+
+
+def _batched(iterable, size):
+    """Yields lists of up to size items of the iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,148 @@
+import heapq
+import random
+import time
+
+UPDATE_PERIODS = {
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 604800,
+    "monthly": 2592000,
+    "yearly": 31536000,
+}
+
+
+class FeedScheduler(object):
+
+    def __init__(self, default_interval, min_interval=60, max_interval=86400, jitter=0.1):
+        """Priority queue of feeds keyed by the time they are due next
+
+        Args:
+            default_interval (float): The interval in seconds for feeds without any publishing history.
+            min_interval (float): The shortest interval in seconds a feed is polled with.
+            max_interval (float): The longest interval in seconds a feed is polled with.
+            jitter (float): The fraction of an interval fetches are randomly spread by.
+        """
+        self.default_interval = float(default_interval)
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.jitter = float(jitter)
+        self.intervals = {}
+        self._due = {}
+        self._queue = []
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, url):
+        return url in self._due
+
+    def urls(self):
+        """Returns all urls the scheduler knows about"""
+        return set(self._due) | set(self.intervals)
+
+    def schedule(self, url, delay, now=None):
+        """Schedules the url to be due after delay seconds, replacing an earlier schedule"""
+        now = time.monotonic() if now is None else now
+        due = now + max(delay, 0.0)
+        self._due[url] = due
+        heapq.heappush(self._queue, (due, url))
+
+    def add(self, url, now=None):
+        """Schedules a newly known url at a random point of the default interval to avoid a burst of fetches"""
+        self.schedule(url, random.uniform(0, min(self.default_interval, self.max_interval)), now=now)
+
+    def remove(self, url):
+        self._due.pop(url, None)
+        self.intervals.pop(url, None)
+
+    def pop_due(self, now=None):
+        """Removes and returns all urls that are due"""
+        now = time.monotonic() if now is None else now
+        result = []
+
+        while self._queue and self._queue[0][0] <= now:
+            due, url = heapq.heappop(self._queue)
+            # Skip entries that were rescheduled or removed in the meantime
+            if self._due.get(url) == due:
+                del self._due[url]
+                result.append(url)
+        return result
+
+    def next_due(self, now=None):
+        """Returns the seconds until the next url is due, or None if nothing is scheduled"""
+        now = time.monotonic() if now is None else now
+
+        while self._queue and self._due.get(self._queue[0][1]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return None
+        return max(self._queue[0][0] - now, 0.0)
+
+    def reschedule(self, url, feed=None, started=None, failures=0):
+        """Schedules the url again, adapting its interval to the feed if one was fetched
+
+        Args:
+            url (str): The url of the feed.
+            feed (FeedParserDict): The parsed feed holding FeedEntry objects, None if it was not modified or could
+                not be fetched.
+            started (float): The monotonic time the fetch started at, so slow fetches don't delay the schedule.
+            failures (int): The number of consecutive failed fetches, each one doubles the delay.
+        """
+        previous = self.intervals.get(url, self.default_interval)
+        interval = previous
+
+        if feed is not None:
+            estimate = self.estimate_interval(feed)
+            if estimate is not None:
+                # Smooth the estimate so a single burst doesn't swing the interval
+                interval = (previous + estimate) / 2
+
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[url] = interval
+
+        delay = interval
+        if failures > 0:
+            # Back off exponentially, a dead feed is still tried every max_interval
+            delay = min(interval * 2 ** min(failures, 32), max(interval, self.max_interval))
+
+        delay = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.schedule(url, delay, now=started)
+
+    def estimate_interval(self, feed, now=None):
+        """Returns the interval in seconds suggested by the publish rate and the ttl / sy:updatePeriod hints"""
+        now = time.time() if now is None else now
+
+        observed = None
+        timestamps = [entry.timestamp for entry in feed.entries if entry.timestamp is not None]
+        if timestamps:
+            # Mean time between posts over the window up to now, polled twice per expected post
+            window = max(now - min(timestamps), 0.0)
+            observed = window / len(timestamps) / 2
+
+        hint = _publisher_hint(feed.get("feed", {}))
+
+        if observed is None:
+            return hint
+        if hint is None:
+            return observed
+        return max(observed, hint)
+
+
+def _publisher_hint(channel):
+    """Returns the minimum interval in seconds the publisher asks for, or None"""
+    hints = []
+
+    try:
+        hints.append(float(channel["ttl"]) * 60)
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    period = UPDATE_PERIODS.get(str(channel.get("sy_updateperiod", "")).strip().lower())
+    if period is not None:
+        try:
+            frequency = max(int(channel.get("sy_updatefrequency", 1)), 1)
+        except (TypeError, ValueError):
+            frequency = 1
+        hints.append(period / frequency)
+
+    return max(hints) if hints else None
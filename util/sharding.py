@@ -0,0 +1,35 @@
+import time
+import zlib
+
+
+class ShardLease(object):
+
+    def __init__(self, database, worker_id, timeout=180):
+        """Lease of a polling worker. Every live worker renews its row in the worker table, the sorted list of
+        live workers decides which shard of the feeds each one polls. Workers joining or leaving rebalance the
+        shards at the next renewal
+
+        Args:
+            database (DatabaseHandler): The database shared by all workers.
+            worker_id (str): The unique id of this worker.
+            timeout (float): The seconds after which the feeds of a worker that stopped renewing are taken over.
+        """
+        self.db = database
+        self.worker_id = worker_id
+        self.timeout = float(timeout)
+        # Renewed three times per timeout, a renewal or two may be late without losing the lease
+        self.interval = self.timeout / 3
+
+    def renew(self, now=None):
+        """Renews the lease, returns the (index, count) of the shard this worker polls"""
+        now = time.time() if now is None else now
+        workers = self.db.renew_worker(worker_id=self.worker_id, now=now, timeout=self.timeout)
+        return workers.index(self.worker_id), len(workers)
+
+    def release(self):
+        self.db.remove_worker(worker_id=self.worker_id)
+
+
+def shard_of(url, count):
+    """Returns the shard of a feed, stable across processes and restarts unlike hash()"""
+    return zlib.crc32(url.encode("utf-8")) % count
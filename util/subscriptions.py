@@ -0,0 +1,166 @@
+import threading
+from array import array
+
+# Bits of a packed subscription taken by the alias id, the chat id is kept in the bits above
+ALIAS_BITS = 32
+ALIAS_MASK = (1 << ALIAS_BITS) - 1
+
+
+class SubscriptionIndex(object):
+
+    def __init__(self):
+        """In-memory graph of the subscriptions, so the poller finds the subscribers of a feed without reading
+        the database. Every feed maps to one array of chat id, alias id pairs, aliases are interned as many users
+        pick the same names. Most feeds have a single subscriber, their pair is packed into one int until a
+        second one arrives. Active and digest flags are kept per chat. Like the database, which joins the
+        subscriptions with the user table, the index only serves chats it knows to be active users. Updated by
+        the DatabaseHandler it is attached to
+        """
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._alias_names = []
+        self._alias_ids = {}
+        self._active = set()
+        self._digest = set()
+
+    @classmethod
+    def load(cls, database):
+        """Builds the index from the database
+
+        Args:
+            database (DatabaseHandler): The database holding the subscriptions.
+        """
+        index = cls()
+        for telegram_id, is_active, digest in database.iter_user_flags():
+            index._set_flags(telegram_id, is_active, digest)
+        # The primary key of the table rules out duplicates, no need to look for them
+        for url, telegram_id, alias in database.iter_subscriptions():
+            index._append(url, telegram_id, alias)
+        return index
+
+    def __len__(self):
+        """Returns the number of subscriptions"""
+        return sum(1 if isinstance(pairs, int) else len(pairs) // 2 for pairs in self._subscribers.values())
+
+    def add(self, url, chat_id, alias):
+        """Adds a subscription, like the database an existing one keeps its alias"""
+        with self._lock:
+            self._add(url, chat_id, alias)
+
+    def rename(self, url, chat_id, alias):
+        """Changes the alias of a subscription"""
+        with self._lock:
+            position = self._find(url, chat_id)
+            if position is None:
+                return
+            pairs = self._subscribers[url]
+            if isinstance(pairs, int):
+                self._subscribers[url] = _pack(chat_id, self._intern(alias))
+            else:
+                pairs[position + 1] = self._intern(alias)
+
+    def remove(self, url, chat_id):
+        """Removes a subscription"""
+        with self._lock:
+            position = self._find(url, chat_id)
+            if position is None:
+                return
+            pairs = self._subscribers[url]
+            if isinstance(pairs, int):
+                del self._subscribers[url]
+                return
+            del pairs[position:position + 2]
+            if len(pairs) == 2:
+                self._subscribers[url] = _pack(pairs[0], pairs[1])
+
+    def remove_url(self, url):
+        """Removes all subscriptions of a feed"""
+        with self._lock:
+            self._subscribers.pop(url, None)
+
+    def update_user(self, chat_id, is_active=None, digest=None):
+        """Updates the flags of a chat, None keeps a flag as it is"""
+        with self._lock:
+            self._set_flags(chat_id, is_active, digest)
+
+    def get_active_users_for_urls(self, urls):
+        """Returns the active subscribers of a batch of feeds, same as DatabaseHandler.get_active_users_for_urls
+
+        Args:
+            urls (list): The urls of the feeds.
+
+        Returns:
+            dict: The return value. Maps every url to a list of (telegram_id, alias, digest) tuples.
+        """
+        result = {}
+        with self._lock:
+            for url in urls:
+                users = []
+                pairs = self._subscribers.get(url)
+                if pairs is not None:
+                    for chat_id, alias_id in _iter_pairs(pairs):
+                        if chat_id in self._active:
+                            users.append((chat_id, self._alias_names[alias_id], chat_id in self._digest))
+                result[url] = users
+        return result
+
+    def _add(self, url, chat_id, alias):
+        if self._find(url, chat_id) is None:
+            self._append(url, chat_id, alias)
+
+    def _append(self, url, chat_id, alias):
+        pairs = self._subscribers.get(url)
+        if pairs is None:
+            self._subscribers[url] = _pack(chat_id, self._intern(alias))
+            return
+        if isinstance(pairs, int):
+            pairs = self._subscribers[url] = array("q", _unpack(pairs))
+        pairs.append(chat_id)
+        pairs.append(self._intern(alias))
+
+    def _find(self, url, chat_id):
+        """Returns the position of the chat id in the array of the feed, None if the chat is not subscribed"""
+        pairs = self._subscribers.get(url)
+        if pairs is None:
+            return None
+        if isinstance(pairs, int):
+            return 0 if pairs >> ALIAS_BITS == chat_id else None
+        try:
+            return pairs[::2].index(chat_id) * 2
+        except ValueError:
+            return None
+
+    def _intern(self, alias):
+        alias_id = self._alias_ids.get(alias)
+        if alias_id is None:
+            alias_id = self._alias_ids[alias] = len(self._alias_names)
+            self._alias_names.append(alias)
+        return alias_id
+
+    def _set_flags(self, chat_id, is_active, digest):
+        if is_active is not None:
+            if is_active:
+                self._active.add(chat_id)
+            else:
+                self._active.discard(chat_id)
+        if digest is not None:
+            if digest:
+                self._digest.add(chat_id)
+            else:
+                self._digest.discard(chat_id)
+
+
+def _pack(chat_id, alias_id):
+    return chat_id << ALIAS_BITS | alias_id
+
+
+def _unpack(packed):
+    return packed >> ALIAS_BITS, packed & ALIAS_MASK
+
+
+def _iter_pairs(pairs):
+    """Yields the (chat id, alias id) pairs of a feed, packed into one int or kept in an array"""
+    if isinstance(pairs, int):
+        yield _unpack(pairs)
+    else:
+        yield from zip(pairs[::2], pairs[1::2])
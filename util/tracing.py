@@ -0,0 +1,155 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+
+# Phases of a feed update in the order they happen. Name resolution happens while connecting and is part of
+# connect, a reused connection doesn't connect at all
+PHASES = ("connect", "ttfb", "download", "parse", "fanout", "db")
+
+
+class FeedTrace(object):
+    """Seconds one feed spent in each phase of its update during a polling cycle"""
+
+    __slots__ = ("url", "result", "total", "timings", "_started", "_marks")
+
+    def __init__(self, url):
+        self.url = url
+        self.result = "ok"
+        self.total = 0.0
+        self.timings = {}
+        self._started = time.perf_counter()
+        self._marks = {}
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        """Adds the seconds the block took to the phase"""
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    async def on_http_event(self, name, info):
+        """Receives the trace events of httpcore, see the "trace" request extension of httpx"""
+        now = time.perf_counter()
+        step, _, state = name.rpartition(".")
+        if state == "started":
+            self._marks[step] = now
+        elif state == "complete":
+            if step in ("connection.connect_tcp", "connection.start_tls"):
+                self.add("connect", now - self._marks.pop(step, now))
+            elif step.endswith(".send_request_headers"):
+                self._marks["request"] = self._marks.get(step, now)
+            elif step.endswith(".receive_response_headers"):
+                self.add("ttfb", now - self._marks.pop("request", now))
+
+    def finish(self):
+        self.total = time.perf_counter() - self._started
+
+    def to_dict(self):
+        record = {"url": self.url, "result": self.result, "total": round(self.total, 6)}
+        for phase in PHASES:
+            record[phase] = round(self.timings.get(phase, 0.0), 6)
+        return record
+
+
+class Tracer(object):
+
+    def __init__(self, path=None, top=10):
+        """Opt-in instrumentation of the poller. Records the phases of every feed update, appends them to a
+        JSON-lines file and prints the slowest feeds after each polling cycle
+
+        Args:
+            path (str): The JSON-lines file the traces are appended to, None only prints the summary.
+            top (int): The number of slowest feeds printed after a cycle.
+        """
+        self.path = path
+        self.top = int(top)
+        self.cycle = 0
+        self.traces = []
+
+    def start_cycle(self):
+        self.cycle += 1
+        self.traces = []
+
+    def trace(self, url):
+        """Returns the FeedTrace of a feed updated in the current cycle"""
+        trace = FeedTrace(url)
+        self.traces.append(trace)
+        return trace
+
+    def slowest(self, count=None):
+        count = self.top if count is None else count
+        return sorted(self.traces, key=lambda trace: trace.total, reverse=True)[:count]
+
+    def finish_cycle(self):
+        """Writes the traces of the cycle and returns the summary of its slowest feeds"""
+        if self.path is not None:
+            now = time.time()
+            with open(self.path, "a", encoding="utf-8") as file:
+                for trace in self.traces:
+                    record = trace.to_dict()
+                    record["cycle"] = self.cycle
+                    record["time"] = now
+                    file.write(json.dumps(record) + "\n")
+
+        lines = ["Slowest feeds of cycle %d:" % self.cycle]
+        for trace in self.slowest():
+            phases = " ".join("%s %.3f" % (phase, trace.timings[phase]) for phase in PHASES
+                              if phase in trace.timings)
+            lines.append("%9.3fs %-12s %s %s" % (trace.total, trace.result, trace.url, phases))
+        return "\n".join(lines)
+
+
+class Profiler(object):
+
+    def __init__(self, directory="."):
+        """Captures one polling cycle with cProfile when requested, e.g. from a signal handler
+
+        Args:
+            directory (str): The directory the profiles are saved in.
+        """
+        self.directory = directory
+        self.requested = False
+        self.profile = None
+
+    def request(self):
+        """Profiles the next polling cycle"""
+        self.requested = True
+
+    def start(self):
+        if self.requested and self.profile is None:
+            self.requested = False
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        """Saves the profile of the cycle, if one was captured
+
+        Returns:
+            str: The path of the saved profile, None if the cycle was not profiled.
+        """
+        if self.profile is None:
+            return None
+
+        profile, self.profile = self.profile, None
+        profile.disable()
+        path = os.path.join(self.directory, "cycle-%s.prof" % time.strftime("%Y%m%d-%H%M%S"))
+        profile.dump_stats(path)
+
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(20)
+        print("Profile of the polling cycle saved to " + path + "\n" + output.getvalue())
+        return path
+
+
+def span(trace, phase):
+    """Returns trace.span(phase), or a context manager doing nothing if the feed is not traced"""
+    return trace.span(phase) if trace is not None else contextlib.nullcontext()
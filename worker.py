@@ -0,0 +1,76 @@
+# /bin/bash/python
+# encoding: utf-8
+"""
+Polls one shard of the feeds in a process of its own, so polling scales over processes and machines. Start the
+bot with EXTERNAL_WORKERS=true and any number of workers sharing its database:
+
+    python worker.py
+
+Workers renew a lease in the database, the feeds are spread over the live workers by a stable hash of their
+url and rebalanced when a worker joins or leaves. News are written to the outbox, the bot delivers them.
+"""
+import asyncio
+import os
+import signal
+import socket
+
+from robotrss import load_setting
+from util import metrics
+from util.database import DatabaseHandler
+from util.feedhandler import FeedHandler
+from util.fetcher import Fetcher, MAX_BODY_SIZE
+from util.filehandler import FileHandler
+from util.processing import BatchProcess
+from util.sharding import ShardLease
+from util.tracing import Tracer
+
+
+async def run(processing):
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+
+    # Stop polling and give up the lease, so the other workers take over right away
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    # kill -USR1 <pid> profiles the next polling cycle
+    loop.add_signal_handler(signal.SIGUSR1, processing.profiler.request)
+
+    try:
+        await processing.run()
+    except asyncio.CancelledError:
+        pass
+
+
+if __name__ == '__main__':
+    fh = FileHandler("..")
+    credentials = {}
+    if fh.file_exists("resources/credentials.json"):
+        credentials = fh.load_json("resources/credentials.json")
+
+    metrics_port = int(load_setting(credentials, "metrics_port", 0))
+    trace_file = load_setting(credentials, "trace_file")
+    if metrics_port:
+        metrics.start_server(metrics_port)
+
+    db = DatabaseHandler("resources/datastore.db")
+    worker_id = load_setting(credentials, "worker_id", "%s-%d" % (socket.gethostname(), os.getpid()))
+
+    FeedHandler.fetcher = Fetcher(timeout=float(load_setting(credentials, "fetch_timeout", 30)),
+                                  per_host=int(load_setting(credentials, "fetch_per_host", 4)),
+                                  max_body_size=int(load_setting(credentials, "max_feed_size", MAX_BODY_SIZE)))
+
+    processing = BatchProcess(
+        database=db,
+        update_interval=int(load_setting(credentials, "update_interval", 300)),
+        concurrency=int(load_setting(credentials, "fetch_concurrency", 10)),
+        min_interval=int(load_setting(credentials, "min_interval", 60)),
+        max_interval=int(load_setting(credentials, "max_interval", 86400)),
+        max_failures=int(load_setting(credentials, "max_failures", 5)),
+        parse_workers=int(load_setting(credentials, "parse_workers", 0)),
+        lease=ShardLease(database=db, worker_id=worker_id),
+        tracer=Tracer(path=trace_file, top=int(load_setting(credentials, "trace_top", 10))) if trace_file else None)
+
+    print("Worker " + worker_id + " started")
+    asyncio.run(run(processing))
+    FeedHandler.fetcher.close()
+    db.close()